@@ -10,6 +10,8 @@ def main():
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument('config_file')
     arg_parser.add_argument('--debug', action='store_true')
+    arg_parser.add_argument('--profile', action='store_true',
+                            help='Profile from startup until exit')
     args = arg_parser.parse_args()
 
     if args.debug:
@@ -26,7 +28,7 @@ def main():
     # Using 'spawn' to avoid safe forking multithreaded process issue
     multiprocessing.set_start_method('spawn')
 
-    app = App(config)
+    app = App(config, config_path=args.config_file, profile=args.profile)
     app.run()
 
 
@@ -1,23 +1,77 @@
+import asyncio
+import json
+import logging
 import queue
+import signal
 
-from chatbot383.bot import Bot
+from chatbot383.bot import Bot, InboundMessageSession
 from chatbot383.client import Client, ClientThread
-from chatbot383.features import Features, Database
+from chatbot383.clientpool import ClientPool
+from chatbot383.database import Database
+from chatbot383.features import Features
+from chatbot383.outbound import AccountRateLimiter, TWITCH_JOIN_LIMIT
+from chatbot383.profiling import Profiler
+import chatbot383.metrics
+
+_logger = logging.getLogger(__name__)
+
+# How often the threaded runtime checks for signals received
+SIGNAL_CHECK_INTERVAL = 0.5
 
 
 class App(object):
-    def __init__(self, config):
+    def __init__(self, config, config_path=None, profile=False):
         self._config = config
-        inbound_queue = queue.Queue(100)
-        self._main_client = Client(
-            inbound_queue=inbound_queue,
-            twitch_char_limit='.twitch.tv:' in config['main_server'])
-        self._main_client_thread = ClientThread(self._main_client)
+        self._config_path = config_path
+        self._profile_on_start = profile
+        self._profiler = Profiler(
+            output_dir=config.get('profile_dir', '.'),
+            slow_threshold=config.get('slow_call_threshold'),
+            sample_interval=config.get('profile_sample_interval', 0.005))
+        self._runtime = config.get('runtime', 'threaded')
+        self._signal_funcs = {}
+        self._pending_signals = set()
+
+        if self._runtime == 'asyncio':
+            self._event_loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._event_loop)
+            inbound_queue = asyncio.Queue()
+        elif self._runtime == 'threaded':
+            self._event_loop = None
+            inbound_queue = queue.Queue(100)
+        else:
+            raise ValueError('Unknown runtime {}'.format(self._runtime))
+
+        # All connections are for the same account so they share limits
+        rate_limiter = AccountRateLimiter()
+        self._main_clients = [
+            Client(
+                inbound_queue=inbound_queue,
+                twitch_char_limit='.twitch.tv:' in config['main_server'],
+                event_loop=self._event_loop,
+                rate_limiter=rate_limiter,
+                coalesce_outbound=config.get('coalesce_outbound', False),
+                name='main{}'.format(index) if index else 'main')
+            for index in range(config.get('connections', 1))
+        ]
+        self._main_client_threads = [
+            ClientThread(client) for client in self._main_clients
+        ]
+
+        if len(self._main_clients) > 1:
+            self._main_client = ClientPool(
+                self._main_clients,
+                hash_method=config.get('connection_hash', 'rendezvous'))
+        else:
+            self._main_client = self._main_clients[0]
 
         if 'discord_gateway_server' in config:
             self._discord_client = Client(
                 inbound_queue=inbound_queue,
-                twitch_char_limit=True)
+                twitch_char_limit=True,
+                event_loop=self._event_loop,
+                coalesce_outbound=config.get('coalesce_outbound', False),
+                name='discord')
             self._discord_client_thread = ClientThread(self._discord_client)
         else:
             self._discord_client = None
@@ -28,11 +82,29 @@ class App(object):
                         inbound_queue,
                         ignored_users=self._config.get('ignored_users'),
                         lurk_channels=self._config.get('lurk_channels'),
-                        discord_client=self._discord_client
+                        discord_client=self._discord_client,
+                        command_workers=self._config.get('command_workers', 4),
+                        command_worker_queue_size=self._config.get(
+                            'command_worker_queue_size', 20),
+                        join_rate=self._config.get(
+                            'join_rate', TWITCH_JOIN_LIMIT.rate),
+                        join_confirm_timeout=self._config.get(
+                            'join_confirm_timeout', 20.0),
+                        profiler=self._profiler
                         )
-        database = Database(self._config['database'])
+        self._database = Database(
+            self._config['database'],
+            num_readers=self._config.get('database_readers', 2),
+            archive_path=self._config.get('database_archive'))
         self._features = Features(self._bot, self._config['help_text'],
-                                  database, self._config)
+                                  self._database, self._config)
+
+        self._bot.register_command(
+            r'(?i)!reloadconfig($|\s.*)', self._reload_config_command,
+            ignore_rate_limit=True)
+        self._bot.register_command(
+            r'(?i)!profile($|\s.*)', self._profile_command,
+            ignore_rate_limit=True)
 
     def run(self):
         username = self._config['username']
@@ -43,12 +115,14 @@ class App(object):
         main_connect_factory = Client.new_connect_factory(
             hostname=main_address[0], use_ssl=self._config.get('ssl'))
 
-        self._main_client.async_connect(
-            main_address[0], main_address[1], username, password=password,
-            connect_factory=main_connect_factory
-        )
+        for client, client_thread in zip(self._main_clients,
+                                         self._main_client_threads):
+            client.async_connect(
+                main_address[0], main_address[1], username, password=password,
+                connect_factory=main_connect_factory
+            )
 
-        self._main_client_thread.start()
+            self._start_client(client, client_thread)
 
         if 'discord_gateway_server' in self._config:
             discord_password = self._config['discord_token']
@@ -59,6 +133,132 @@ class App(object):
                 password=discord_password,
             )
 
-            self._discord_client_thread.start()
+            self._start_client(self._discord_client,
+                               self._discord_client_thread)
+
+        self._install_signal_handlers()
+
+        if self._config.get('metrics_port'):
+            chatbot383.metrics.start_http_server(self._config['metrics_port'])
+
+        if self._config.get('metrics_file'):
+            self._write_metrics_sched()
+
+        if self._config.get('slow_call_threshold'):
+            self._profiler.start_monitor()
+
+        if self._profile_on_start:
+            self._profiler.start()
+
+        try:
+            if self._event_loop:
+                self._event_loop.run_until_complete(self._bot.run_async())
+            else:
+                self._bot.run()
+        finally:
+            self._profiler.stop()
+            self._database.close()
+
+    def _write_metrics_sched(self):
+        metrics_file = self._config.get('metrics_file')
+
+        if not metrics_file:
+            return
+
+        try:
+            chatbot383.metrics.write_file(metrics_file)
+        except OSError:
+            _logger.exception('Could not write metrics file')
+
+        self._bot.scheduler.enter(
+            self._config.get('metrics_interval', 15), 0,
+            self._write_metrics_sched)
+
+    def _install_signal_handlers(self):
+        handlers = []
+
+        if self._config_path and hasattr(signal, 'SIGHUP'):
+            handlers.append((signal.SIGHUP, self.reload_config))
 
-        self._bot.run()
+        if hasattr(signal, 'SIGUSR1'):
+            handlers.append((signal.SIGUSR1, self._profiler.toggle))
+
+        for signal_number, func in handlers:
+            if self._event_loop:
+                self._event_loop.add_signal_handler(signal_number, func)
+            else:
+                self._signal_funcs[signal_number] = func
+                signal.signal(signal_number, self._signal_handler)
+
+        if self._signal_funcs:
+            self._check_signals_sched()
+
+    def _signal_handler(self, signal_number, frame):
+        # Only note the signal. It may have interrupted the scheduler or a
+        # queue in the middle of changing itself, so the bot loop runs
+        # the handler later.
+        self._pending_signals.add(signal_number)
+
+    def _check_signals_sched(self):
+        while self._pending_signals:
+            self._signal_funcs[self._pending_signals.pop()]()
+
+        self._bot.scheduler.enter(
+            SIGNAL_CHECK_INTERVAL, 0, self._check_signals_sched)
+
+    def reload_config(self) -> bool:
+        """Read the config file again and apply the settings that can be
+        changed while running.
+
+        Must be called from the bot thread.
+        """
+        _logger.info('Reloading config from %s', self._config_path)
+
+        try:
+            with open(self._config_path, 'r') as file:
+                config = json.load(file)
+
+            channels = config['channels']
+            help_text = config['help_text']
+        except (OSError, ValueError, KeyError):
+            _logger.exception('Could not reload config')
+            return False
+
+        self._config = config
+        self._bot.update_channels(
+            channels,
+            lurk_channels=config.get('lurk_channels') or (),
+            ignored_users=config.get('ignored_users')
+        )
+        self._features.reload_config(help_text, config)
+
+        return True
+
+    def _reload_config_command(self, session: InboundMessageSession):
+        if session.message['username'] not in self._config.get('admin_users', ()):
+            return
+
+        if not self._config_path:
+            return
+
+        if self.reload_config():
+            session.reply('Config reloaded.')
+        else:
+            session.reply('Config reload failed.')
+
+    def _profile_command(self, session: InboundMessageSession):
+        if session.message['username'] not in self._config.get('admin_users', ()):
+            return
+
+        if self._profiler.enabled:
+            paths = self._profiler.stop()
+            session.reply('Profiling stopped. Wrote {} files.'.format(len(paths)))
+        else:
+            self._profiler.start()
+            session.reply('Profiling started.')
+
+    def _start_client(self, client: Client, client_thread: ClientThread):
+        if self._event_loop:
+            client.start_event_loop_processing()
+        else:
+            client_thread.start()
@@ -0,0 +1,556 @@
+"""Drive the Bot and Features with recorded or synthetic chat.
+
+Usage::
+
+    python -m chatbot383.benchmark --messages 20000 --channels 50
+    python -m chatbot383.benchmark --replay chat.log --rate 500
+    python -m chatbot383.benchmark --mail-rows 2000000
+
+Replay files contain raw IRC lines, optionally with IRCv3 tags, as
+received from the server. Only PRIVMSG lines are used.
+
+With --mail-rows, a mail table of that size is generated instead and
+random old mail lookups are timed against the legacy query.
+"""
+import argparse
+import collections
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import random
+import re
+import resource
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from chatbot383.bot import Bot
+from chatbot383.database import Database, split_sender
+from chatbot383.events import ChatMessageEvent, lower_identity
+from chatbot383.features import Features
+from chatbot383.profiling import Profiler
+from chatbot383.ratelimit import Limiter
+from chatbot383.util import percentile
+
+_logger = logging.getLogger(__name__)
+
+IRC_PRIVMSG_PATTERN = re.compile(
+    r'^(?:@(\S+) )?:([^!\s]+)(?:!\S+)? PRIVMSG (\S+) :(.*)$')
+
+TAG_VALUE_ESCAPES = {'\\:': ';', '\\s': ' ', '\\\\': '\\', '\\r': '\r',
+                     '\\n': '\n'}
+
+DEFAULT_COMMAND_MIX = (
+    (90, '{chat}'),
+    (2, '!caw'),
+    (1, '!mail benchmark mail {word}'),
+    (1, '!mailstatus'),
+    (2, '!pick {word} {word} {word}'),
+    (2, '!reverse {chat}'),
+    (1, '!sort {chat}'),
+    (1, '!shuffle {chat}'),
+)
+
+WORDS = (
+    'groudon', 'kappa', 'caw', 'hello', 'democracy', 'anarchy', 'helix',
+    'start9', 'pogchamp', 'biblethump', 'bird', 'jesus', 'dome', 'lol',
+)
+
+
+class _FakeConnection(object):
+    server_address = ('benchmark', 0)
+    connected = True
+
+    def get_nickname(self):
+        return 'BenchBot'
+
+
+class BenchmarkClient(object):
+    """Stands in for Client and counts what would have been sent."""
+    twitch_char_limit = True
+    name = 'benchmark'
+
+    def __init__(self, inbound_queue):
+        self.inbound_queue = inbound_queue
+        self.connection = _FakeConnection()
+        self.event_loop = None
+        self.outbound_counts = collections.Counter()
+        self._lock = threading.Lock()
+
+    def get_nickname(self, lower=False):
+        if lower:
+            return lower_identity(self.connection.get_nickname())
+        else:
+            return self.connection.get_nickname()
+
+    def _count(self, message_type):
+        with self._lock:
+            self.outbound_counts[message_type] += 1
+
+        return True
+
+    def privmsg(self, target, text, action=False, **kwargs):
+        return self._count('privmsg')
+
+    def join(self, channel):
+        return self._count('join')
+
+    def part(self, channel):
+        return self._count('part')
+
+
+class LatencyRecorder(Profiler):
+    """Records the latency of every command and handler call.
+
+    The bot wraps those calls with its profiler, so this is passed as the
+    profiler. Message processing as a whole is timed by the benchmark.
+    """
+    def __init__(self):
+        super().__init__()
+        self.latencies = collections.defaultdict(list)
+        self._latencies_lock = threading.Lock()
+
+    def call(self, name: str, func, *args):
+        start_time = time.perf_counter()
+
+        try:
+            return super().call(name, func, *args)
+        finally:
+            duration = time.perf_counter() - start_time
+
+            if name != 'Bot._process_message':
+                with self._latencies_lock:
+                    self.latencies[name].append(duration)
+
+
+class BenchmarkBot(Bot):
+    def __init__(self, *args, rate_limits: bool=True, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        if not rate_limits:
+            self._user_limiter = Limiter(min_interval=0)
+            self._channel_spam_limiter = Limiter(min_interval=0)
+
+
+def parse_irc_line(line: str):
+    """Return (channel, nick, text, raw_tags) or None."""
+    match = IRC_PRIVMSG_PATTERN.match(line.rstrip('\r\n'))
+
+    if not match:
+        return None
+
+    tags_text, nick, channel, text = match.groups()
+    raw_tags = []
+
+    if tags_text:
+        for tag in tags_text.split(';'):
+            key, dummy, value = tag.partition('=')
+            value = re.sub(r'\\.', lambda match: TAG_VALUE_ESCAPES.get(
+                match.group(0), match.group(0)[1:]), value)
+            raw_tags.append({'key': key, 'value': value or None})
+
+    return channel, nick, text, raw_tags
+
+
+def replay_messages(path: str):
+    with open(path, encoding='utf-8', errors='replace') as file:
+        for line in file:
+            message = parse_irc_line(line)
+
+            if message:
+                yield message
+
+
+def synthetic_messages(num_channels: int, num_users: int, command_mix,
+                       seed: int=0):
+    rng = random.Random(seed)
+    channels = ['#bench{}'.format(index) for index in range(num_channels)]
+    weights = [weight for weight, dummy in command_mix]
+    templates = [template for dummy, template in command_mix]
+
+    def chat():
+        return ' '.join(rng.choice(WORDS) for dummy in range(rng.randint(1, 12)))
+
+    while True:
+        template = rng.choices(templates, weights)[0]
+        text = re.sub(
+            r'\{(chat|word)\}',
+            lambda match: chat() if match.group(1) == 'chat' else rng.choice(WORDS),
+            template)
+        user_index = rng.randrange(num_users)
+        nick = 'User{}'.format(user_index)
+        raw_tags = [
+            {'key': 'display-name', 'value': nick},
+            {'key': 'user-id', 'value': str(1000 + user_index)},
+        ]
+
+        yield rng.choice(channels), nick, text, raw_tags
+
+
+def parse_command_mix(values):
+    command_mix = []
+
+    for value in values:
+        weight, dummy, template = value.partition(':')
+        command_mix.append((float(weight), template))
+
+    return command_mix
+
+
+def run_benchmark(messages, num_messages: int, rate: float=0,
+                  database_path: str=':memory:', trace_memory: bool=False,
+                  rate_limits: bool=True, config: dict=None) -> dict:
+    """Feed messages through the bot and return a report dict.
+
+    `rate` is the target messages per second. Zero sends as fast as
+    possible.
+    """
+    messages = list(itertools.islice(messages, num_messages))
+    channels = sorted(set(lower_identity(message[0]) for message in messages))
+
+    inbound_queue = queue.Queue()
+    client = BenchmarkClient(inbound_queue)
+    latency_recorder = LatencyRecorder()
+    bot = BenchmarkBot(channels, client, inbound_queue,
+                       rate_limits=rate_limits, profiler=latency_recorder)
+
+    config = dict(config or {})
+    config.setdefault('mail_disabled_channels', [])
+    database = Database(database_path)
+    features = Features(bot, 'Benchmark help text', database, config)
+
+    if trace_memory:
+        tracemalloc.start()
+
+    processing_times = []
+    start_time = time.perf_counter()
+
+    for index, (channel, nick, text, raw_tags) in enumerate(messages):
+        if rate:
+            delay = start_time + index / rate - time.perf_counter()
+
+            if delay > 0:
+                time.sleep(delay)
+
+        event = ChatMessageEvent(
+            client, 'pubmsg', username=lower_identity(nick), text=text,
+            source_nick=nick, raw_tags=raw_tags,
+            channel=lower_identity(channel))
+
+        message_start_time = time.perf_counter()
+        bot._process_inbound_item(event)
+        processing_times.append(time.perf_counter() - message_start_time)
+
+    # Wait for commands still running on the worker pool
+    bot._command_worker_pool.shutdown(wait=True)
+
+    # Replies from blocking commands are released through callbacks
+    while True:
+        try:
+            item = inbound_queue.get_nowait()
+        except queue.Empty:
+            break
+        else:
+            bot._process_inbound_item(item)
+
+    elapsed = time.perf_counter() - start_time
+
+    if trace_memory:
+        dummy, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    else:
+        peak_memory = None
+
+    processing_times.sort()
+    command_report = {}
+
+    for command_name, latencies in sorted(
+            latency_recorder.latencies.items()):
+        latencies.sort()
+        command_report[command_name] = {
+            'count': len(latencies),
+            'p50': percentile(latencies, 0.5),
+            'p99': percentile(latencies, 0.99),
+        }
+
+    del features
+    database.close()
+
+    return {
+        'messages': len(messages),
+        'channels': len(channels),
+        'elapsed': elapsed,
+        'messages_per_second': len(messages) / elapsed if elapsed else 0.0,
+        'p50': percentile(processing_times, 0.5),
+        'p99': percentile(processing_times, 0.99),
+        'max': processing_times[-1] if processing_times else 0.0,
+        'commands': command_report,
+        'outbound': dict(client.outbound_counts),
+        'peak_traced_memory': peak_memory,
+        'max_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def format_report(report: dict) -> str:
+    lines = [
+        'Messages: {messages} in {channels} channels'.format(**report),
+        'Elapsed: {elapsed:.3f} s ({messages_per_second:.1f} msg/s)'
+        .format(**report),
+        'Processing latency: p50 {:.3f} ms, p99 {:.3f} ms, max {:.3f} ms'
+        .format(report['p50'] * 1000, report['p99'] * 1000,
+                report['max'] * 1000),
+        'Outbound: {}'.format(', '.join(
+            '{} {}'.format(count, message_type)
+            for message_type, count in sorted(report['outbound'].items())
+        ) or 'none'),
+    ]
+
+    if report['peak_traced_memory'] is not None:
+        lines.append('Peak traced memory: {:.1f} KiB'.format(
+            report['peak_traced_memory'] / 1024))
+
+    lines.append('Max RSS: {} KiB'.format(report['max_rss_kib']))
+    lines.append('Commands:')
+
+    for command_name, stats in report['commands'].items():
+        lines.append('  {}: {} calls, p50 {:.3f} ms, p99 {:.3f} ms'.format(
+            command_name, stats['count'], stats['p50'] * 1000,
+            stats['p99'] * 1000))
+
+    return '\n'.join(lines)
+
+
+def _legacy_get_old_mail(con: sqlite3.Connection, rng: random.Random,
+                         skip_username=None, skip_user_id=None, channel=None):
+    # The retry loop over random IDs that ReadMailIndex replaced
+    max_id = con.execute('''SELECT max(id) FROM mail''').fetchone()[0]
+    min_id = 0
+
+    if channel:
+        row = con.execute('SELECT min(id) FROM mail WHERE channel = ?',
+                          (channel,)).fetchone()
+        min_id = row[0] or 0
+
+    for dummy in range(10):
+        query = ['SELECT username, text, timestamp, channel FROM mail',
+                 'WHERE status = ? AND id > ?']
+        params = ['read', rng.randint(min_id, max_id)]
+
+        if skip_username:
+            query.append('AND username != ?')
+            params.append(skip_username)
+
+        if skip_user_id:
+            query.append("AND username NOT LIKE '%!' || ?")
+            params.append(skip_user_id)
+
+        if channel:
+            query.append('AND channel = ?')
+            params.append(channel)
+
+        query.append('LIMIT 1')
+
+        row = con.execute(' '.join(query), params).fetchone()
+
+        if row:
+            return row
+
+
+def run_mail_benchmark(database_path: str, num_rows: int,
+                       num_queries: int=1000, num_channels: int=20,
+                       num_users: int=50000, seed: int=0) -> dict:
+    """Time random old mail lookups against a generated mail table."""
+    rng = random.Random(seed)
+    Database(database_path).close()
+
+    con = sqlite3.connect(database_path)
+
+    num_retired_channels = max(1, num_channels // 4)
+
+    def rows():
+        # A few busy channels and many quiet ones, some channels that only
+        # have old mail, and only the newest mail unread like a full mailbag
+        for mail_id in range(1, num_rows + 1):
+            user_index = rng.randrange(num_users)
+
+            if mail_id < num_rows // 10 and rng.random() < 0.1:
+                channel = '#retired{}'.format(
+                    rng.randrange(num_retired_channels))
+            else:
+                channel = '#bench{}'.format(min(
+                    int(rng.paretovariate(1.0)) - 1, num_channels - 1))
+
+            username = 'user{0}!{0}@twitch'.format(user_index)
+
+            yield (
+                mail_id, 1500000000 + mail_id, username,
+                'benchmark mail {}'.format(mail_id),
+                'read' if mail_id <= num_rows - 500 else 'unread',
+                channel
+            ) + split_sender(username)
+
+    with con:
+        con.executemany(
+            '''INSERT INTO mail (id, timestamp, username, text, status, channel,
+            sender_username, sender_user_id, sender_platform)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''', rows())
+
+    start_time = time.perf_counter()
+    database = Database(database_path)
+
+    while not database.read_mail_index_loaded:
+        time.sleep(0.01)
+
+    load_time = time.perf_counter() - start_time
+
+    queries = []
+
+    for dummy in range(num_queries):
+        user_index = rng.randrange(num_users)
+        channel_roll = rng.random()
+
+        if channel_roll < 0.2:
+            channel = '#bench{}'.format(rng.randrange(num_channels))
+        elif channel_roll < 0.3:
+            channel = '#retired{}'.format(
+                rng.randrange(num_retired_channels))
+        else:
+            channel = None
+        queries.append(('user{0}!{0}@twitch'.format(user_index),
+                        '{}@twitch'.format(user_index), channel))
+
+    def time_queries(func):
+        latencies = []
+        empty_count = 0
+
+        for skip_username, skip_user_id, channel in queries:
+            query_start_time = time.perf_counter()
+            result = func(skip_username, skip_user_id, channel)
+            latencies.append(time.perf_counter() - query_start_time)
+
+            if not result:
+                empty_count += 1
+
+        latencies.sort()
+
+        return {
+            'p50': percentile(latencies, 0.5),
+            'p99': percentile(latencies, 0.99),
+            'max': latencies[-1] if latencies else 0.0,
+            'empty': empty_count,
+        }
+
+    indexed = time_queries(
+        lambda *args: database.get_old_mail(*args).result())
+    database.close()
+
+    legacy = time_queries(
+        lambda *args: _legacy_get_old_mail(con, rng, *args))
+    con.close()
+
+    return {
+        'rows': num_rows,
+        'queries': num_queries,
+        'index_load_time': load_time,
+        'indexed': indexed,
+        'legacy': legacy,
+    }
+
+
+def format_mail_report(report: dict) -> str:
+    lines = [
+        'Mail rows: {rows}, queries: {queries}'.format(**report),
+        'Read mail index load: {:.3f} s'.format(report['index_load_time']),
+    ]
+
+    for name in ('indexed', 'legacy'):
+        stats = report[name]
+        lines.append(
+            '{}: p50 {:.3f} ms, p99 {:.3f} ms, max {:.3f} ms, '
+            '{} empty'.format(
+                name.title(), stats['p50'] * 1000, stats['p99'] * 1000,
+                stats['max'] * 1000, stats['empty']))
+
+    return '\n'.join(lines)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    arg_parser.add_argument('--replay', help='File of raw IRC lines')
+    arg_parser.add_argument('--messages', type=int, default=10000)
+    arg_parser.add_argument('--channels', type=int, default=20)
+    arg_parser.add_argument('--users', type=int, default=2000)
+    arg_parser.add_argument('--rate', type=float, default=0,
+                            help='Messages per second, 0 for unlimited')
+    arg_parser.add_argument(
+        '--command', action='append', metavar='WEIGHT:TEXT',
+        help='Synthetic message template. {chat} and {word} are replaced '
+             'by random words. Can be given multiple times.')
+    arg_parser.add_argument('--seed', type=int, default=0)
+    arg_parser.add_argument('--database',
+                            help='Database path. Defaults to a temporary file')
+    arg_parser.add_argument('--no-rate-limits', action='store_true',
+                            help='Run every command instead of applying the '
+                                 'per-user and per-channel command limits')
+    arg_parser.add_argument('--trace-memory', action='store_true',
+                            help='Report peak memory with tracemalloc (slow)')
+    arg_parser.add_argument('--mail-rows', type=int,
+                            help='Benchmark old mail lookups on a generated '
+                                 'mail table of this many rows')
+    arg_parser.add_argument('--mail-queries', type=int, default=1000)
+    arg_parser.add_argument('--json', action='store_true')
+    arg_parser.add_argument('--debug', action='store_true')
+    args = arg_parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.WARNING,
+        format='%(asctime)s - %(levelname)s - %(message)s')
+
+    multiprocessing.set_start_method('spawn')
+
+    if args.mail_rows:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            report = run_mail_benchmark(
+                args.database or os.path.join(temp_dir, 'mail.db'),
+                args.mail_rows, num_queries=args.mail_queries,
+                num_channels=args.channels, num_users=args.users,
+                seed=args.seed)
+
+        if args.json:
+            json.dump(report, sys.stdout, indent=2)
+            print()
+        else:
+            print(format_mail_report(report))
+
+        return
+
+    if args.replay:
+        messages = replay_messages(args.replay)
+    else:
+        command_mix = parse_command_mix(args.command) if args.command \
+            else DEFAULT_COMMAND_MIX
+        messages = synthetic_messages(
+            args.channels, args.users, command_mix, seed=args.seed)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        database_path = args.database or os.path.join(temp_dir, 'bench.db')
+        report = run_benchmark(
+            messages, args.messages, rate=args.rate,
+            database_path=database_path, trace_memory=args.trace_memory,
+            rate_limits=not args.no_rate_limits)
+
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        print(format_report(report))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+import itertools
+import unittest
+
+from chatbot383.benchmark import parse_irc_line, synthetic_messages, \
+    run_benchmark, format_report
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_parse_irc_line(self):
+        self.assertEqual(
+            ('#chan', 'nick', '!caw hi', [
+                {'key': 'display-name', 'value': 'Nick'},
+                {'key': 'msg', 'value': 'a b;c'},
+                {'key': 'empty', 'value': None},
+            ]),
+            parse_irc_line(
+                '@display-name=Nick;msg=a\\sb\\:c;empty= '
+                ':nick!nick@nick.tmi.twitch.tv PRIVMSG #chan :!caw hi\r\n')
+        )
+        self.assertEqual(
+            ('#chan', 'nick', 'hello', []),
+            parse_irc_line(':nick PRIVMSG #chan :hello')
+        )
+        self.assertIsNone(parse_irc_line(':nick JOIN #chan'))
+
+    def test_synthetic_messages(self):
+        messages = list(itertools.islice(
+            synthetic_messages(3, 10, [(1, '!pick {word} {word}')]), 20))
+
+        self.assertEqual(20, len(messages))
+        self.assertTrue(all(
+            text.startswith('!pick ') and '{' not in text
+            for dummy, dummy, text, dummy in messages))
+        self.assertEqual(messages, list(itertools.islice(
+            synthetic_messages(3, 10, [(1, '!pick {word} {word}')]), 20)))
+
+    def test_run_benchmark(self):
+        messages = synthetic_messages(2, 50, [(1, '!caw'), (1, 'hello')])
+        report = run_benchmark(messages, 100, rate_limits=False)
+
+        self.assertEqual(100, report['messages'])
+        self.assertEqual(2, report['channels'])
+        self.assertGreater(report['outbound']['privmsg'], 0)
+        self.assertEqual(report['outbound']['privmsg'],
+                         report['commands']['Features._caw_command']['count'])
+        self.assertIn('msg/s', format_report(report))
+
+    def test_blocking_commands_counted(self):
+        messages = synthetic_messages(2, 50, [(1, '!mailstatus')])
+        report = run_benchmark(messages, 20, rate_limits=False)
+
+        self.assertEqual(
+            20, report['commands']['Features._mail_status_command']['count'])
+        self.assertEqual(20, report['outbound']['privmsg'])
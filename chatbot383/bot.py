@@ -1,33 +1,46 @@
+import asyncio
 import logging
 import queue
-import random
 import re
 import itertools
 import sched
 import time
 
 import collections
+import functools
 import irc.strings
-from typing import Optional
+from typing import Optional, Union
 
 from chatbot383.client import Client
+from chatbot383.clientpool import ClientPool
+from chatbot383.dispatch import CommandDispatcher
+from chatbot383.events import InboundEvent, ChatMessageEvent, CallbackEvent, \
+    MembershipEvent, lower_identity
+from chatbot383.joins import JoinManager
+from chatbot383.outbound import TWITCH_JOIN_LIMIT
+from chatbot383.profiling import Profiler
+from chatbot383.ratelimit import Limiter
+from chatbot383.workers import CommandWorkerPool, ReplySequencer, \
+    WorkerPoolFullError
 from chatbot383.util import split_utf8, grouper
 import chatbot383.discord.gateway
+import chatbot383.metrics
 import chatbot383.util
 
 _logger = logging.getLogger(__name__)
 
 
 class InboundMessageSession(object):
-    def __init__(self, message: dict, bot: 'Bot', client: Client):
+    def __init__(self, message: InboundEvent, bot: 'Bot', client: Client):
         self._message = message
         self._bot = bot
         self._client = client
         self.match = None
         self.skip_rate_limit = False
+        self.reply_buffer = None
 
     @property
-    def message(self) -> dict:
+    def message(self) -> InboundEvent:
         return self._message
 
     @property
@@ -38,13 +51,20 @@ class InboundMessageSession(object):
     def client(self) -> Client:
         return self._client
 
+    def _send(self, func, *args, **kwargs):
+        if self.reply_buffer is not None:
+            self.reply_buffer.calls.append(
+                functools.partial(func, *args, **kwargs))
+        else:
+            func(*args, **kwargs)
+
     def reply(self, text, me=False, multiline=False, escape_links=False):
         if self.get_platform_name() == 'discord':
             reply_to = self._message['user_id']
         else:
             reply_to = self._message['nick']
 
-        self._bot.send_text(self._message['channel'], text, me=me,
+        self._send(self._bot.send_text, self._message['channel'], text, me=me,
                             reply_to=reply_to,
                             multiline=multiline,
                             discord_reply=self.get_platform_name() == 'discord',
@@ -53,15 +73,14 @@ class InboundMessageSession(object):
 
     def whisper(self, text):
         if self.get_platform_name() == 'discord':
-            self._bot.send_discord_private_message(
-                self._message['user_id'], text
-            )
+            self._send(self._bot.send_discord_private_message,
+                       self._message['user_id'], text)
         else:
-            self._bot.send_whisper(self._message['username'], text)
+            self._send(self._bot.send_whisper, self._message['username'], text)
 
     def say(self, text, me=False, multiline=False):
-        self._bot.send_text(self._message['channel'], text, me=me,
-                            multiline=multiline)
+        self._send(self._bot.send_text, self._message['channel'], text,
+                   me=me, multiline=multiline)
 
     def get_platform_name(self) -> str:
         if self.message['channel'].startswith(chatbot383.discord.gateway.CHANNEL_PREFIX):
@@ -72,16 +91,20 @@ class InboundMessageSession(object):
 
 RegisteredCommandInfo = collections.namedtuple(
     'RegisteredCommandInfo', [
-        'command_regex', 'func', 'ignore_rate_limit'
+        'command_regex', 'func', 'ignore_rate_limit', 'blocking'
     ]
 )
 
 
 class Bot(object):
-    def __init__(self, channels, main_client: Client,
+    def __init__(self, channels, main_client: Union[Client, ClientPool],
                  inbound_queue: queue.Queue,
                  ignored_users=None, lurk_channels=(),
-                 discord_client: Optional[Client]=None):
+                 discord_client: Optional[Client]=None,
+                 command_workers: int=4, command_worker_queue_size: int=20,
+                 join_rate: float=TWITCH_JOIN_LIMIT.rate,
+                 join_confirm_timeout: float=20.0,
+                 profiler: Optional[Profiler]=None):
         self._channels = frozenset(irc.strings.lower(channel) for channel in channels)
         self._lurk_channels = frozenset(irc.strings.lower(channel) for channel in lurk_channels)
         self._main_client = main_client
@@ -91,19 +114,43 @@ class Bot(object):
         self._user_limiter = Limiter(min_interval=3)
         self._channel_spam_limiter = Limiter(min_interval=0.2)
         self._scheduler = sched.scheduler()
-
-        self._commands = []
-        self._message_handlers = []
+        self._event_loop = None
+        self._command_worker_pool = CommandWorkerPool(
+            command_workers, command_worker_queue_size)
+        self._reply_sequencer = ReplySequencer()
+        self._join_manager = JoinManager(
+            rate=join_rate, confirm_timeout=join_confirm_timeout,
+            priority_key=self._get_join_priority)
+        self._join_event = None
+        self._profiler = profiler
+
+        self._command_dispatcher = CommandDispatcher()
+        self._message_handlers = collections.defaultdict(list)
 
         self.register_message_handler('welcome', self._join_channels)
+        self.register_message_handler('disconnect', self._connection_lost)
+        self.register_message_handler('join', self._join_seen)
+        self.register_message_handler('part', self._part_seen)
 
         assert self._main_client.inbound_queue == inbound_queue
 
-    def register_command(self, command_regex, func, ignore_rate_limit=False):
-        self._commands.append(RegisteredCommandInfo(command_regex, func, ignore_rate_limit))
+        chatbot383.metrics.QUEUE_DEPTH.labels('inbound').set_function(
+            inbound_queue.qsize)
+        chatbot383.metrics.QUEUE_DEPTH.labels('command_workers').set_function(
+            lambda: self._command_worker_pool.pending)
+
+    def register_command(self, command_regex, func, ignore_rate_limit=False,
+                         blocking=False):
+        # Blocking commands are run on a worker pool. They must not use
+        # state that isn't safe to access from another thread.
+        self._command_dispatcher.add(
+            command_regex,
+            RegisteredCommandInfo(command_regex, func, ignore_rate_limit,
+                                  blocking)
+        )
 
     def register_message_handler(self, event_type, func):
-        self._message_handlers.append((event_type, func))
+        self._message_handlers[event_type].append(func)
 
     @property
     def scheduler(self) -> sched.scheduler:
@@ -113,6 +160,14 @@ class Bot(object):
     def is_group_chat(cls, channel_name: str) -> bool:
         return channel_name.startswith('#_')
 
+    @property
+    def profiler(self) -> Optional[Profiler]:
+        return self._profiler
+
+    @property
+    def join_manager(self) -> JoinManager:
+        return self._join_manager
+
     @property
     def user_limiter(self) -> 'Limiter':
         return self._user_limiter
@@ -155,14 +210,51 @@ class Bot(object):
             except queue.Empty:
                 continue
             else:
-                client = item['client']
-                _logger.debug('Process inbound queue item %s %s',
-                              client.connection.server_address, item)
-                self._process_message(item, client)
+                self._process_inbound_item(item)
+
+    async def run_async(self):
+        self._event_loop = asyncio.get_event_loop()
+
+        # Sleeps until either an inbound item arrives or the next
+        # scheduled event is due
+        while True:
+            delay = self._scheduler.run(blocking=False)
+
+            try:
+                item = await asyncio.wait_for(self._inbound_queue.get(), delay)
+            except asyncio.TimeoutError:
+                continue
+            else:
+                self._process_inbound_item(item)
+
+    def call_from_thread(self, func):
+        if self._event_loop:
+            self._event_loop.call_soon_threadsafe(func)
+        else:
+            self._inbound_queue.put(CallbackEvent(func))
+
+    def _process_inbound_item(self, item: InboundEvent):
+        if item.event_type == 'callback':
+            item.callback()
+            return
+
+        client = item.client
+        _logger.debug('Process inbound queue item %s %s',
+                      client.connection.server_address, item)
+        chatbot383.metrics.MESSAGES_PROCESSED.labels(item.event_type).inc()
+        self._call_profiled('Bot._process_message', self._process_message,
+                            item, client)
+
+    def _call_profiled(self, name: str, func, *args):
+        if self._profiler:
+            return self._profiler.call(name, func, *args)
+        else:
+            return func(*args)
 
     def send_text(self, channel, text, me=False, reply_to=None,
-                  multiline=False, discord_reply=False, escape_links=False):
-        channel = irc.strings.lower(channel)
+                  multiline=False, discord_reply=False, escape_links=False,
+                  lane='reply'):
+        channel = lower_identity(channel)
 
         if self._discord_client and self.get_platform_name(channel) == 'discord':
             client = self._discord_client
@@ -208,34 +300,42 @@ class Bot(object):
                     channel not in self._channels:
                 _logger.info('Discarded message %s %s',
                              ascii(channel), ascii(line))
+                chatbot383.metrics.LINES_DISCARDED.labels('unsafe').inc()
                 return
 
-            client.privmsg(channel, line, action=me)
+            if not client.privmsg(channel, line, action=me, lane=lane,
+                                  max_length=max_length,
+                                  max_byte_length=max_byte_length):
+                chatbot383.metrics.LINES_DISCARDED.labels('queue_full').inc()
+                return
 
     def send_whisper(self, username, text, allow_command_prefix=False):
         text = self.strip_unsafe_chars(text)
 
         if not self.is_text_safe(text, allow_command_prefix=allow_command_prefix):
             _logger.info('Discarded message %s %s', ascii(username), ascii(text))
+            chatbot383.metrics.LINES_DISCARDED.labels('unsafe').inc()
             return
 
         text = '/w {} {}'.format(username, text)
 
-        self._main_client.privmsg('#jtv', text)
+        self._main_client.privmsg('#jtv', text, lane='whisper')
 
     def send_discord_private_message(self, username, text, allow_command_prefix=False):
         text = self.strip_unsafe_chars(text)
 
         if not self.is_text_safe(text, allow_command_prefix=allow_command_prefix):
             _logger.info('Discarded message %s %s', ascii(username), ascii(text))
+            chatbot383.metrics.LINES_DISCARDED.labels('unsafe').inc()
             return
 
-        self._discord_client.privmsg(username, text)
+        self._discord_client.privmsg(username, text, lane='whisper')
 
     def set_discord_presence(self, game_text: str):
         if self._discord_client:
             self._discord_client.privmsg(
-                chatbot383.discord.gateway.PRESENCE_CHANNEL, game_text)
+                chatbot383.discord.gateway.PRESENCE_CHANNEL, game_text,
+                lane='announcement')
 
     @classmethod
     def split_multiline(cls, text, max_length=400, split_bytes=True):
@@ -252,27 +352,84 @@ class Bot(object):
 
     def join(self, channel):
         if self.get_platform_name(channel) == 'discord':
-            client = self._discord_client
+            self._discord_client.join(channel)
+            return
+
+        channels = [name for name in channel.split(',') if name]
+
+        if isinstance(self._main_client, ClientPool):
+            for client, names in self._main_client.assign(channels).items():
+                self._join_manager.add(client, names)
         else:
-            client = self._main_client
+            self._join_manager.add(self._main_client, channels)
+
+        self._process_joins()
+
+    def part(self, channel):
+        if self.get_platform_name(channel) == 'discord':
+            self._discord_client.part(channel)
+            return
+
+        self._join_manager.remove(channel)
+        self._main_client.part(channel)
+
+    def update_channels(self, channels, lurk_channels=(), ignored_users=None):
+        """Replace the channel and user sets and join or part the
+        channels that changed."""
+        channels = frozenset(irc.strings.lower(channel) for channel in channels)
+        lurk_channels = frozenset(irc.strings.lower(channel) for channel in lurk_channels)
+        ignored_users = frozenset(ignored_users or ())
 
-        client.join(channel)
+        old_channels = self._channels | self._lurk_channels
+        new_channels = channels | lurk_channels
 
-    def _process_message(self, message, client):
+        # Each set is replaced as a whole so worker threads never see
+        # a partially updated set
+        self._channels = channels
+        self._lurk_channels = lurk_channels
+        self._ignored_users = ignored_users
+
+        removed_channels = sorted(old_channels - new_channels)
+        added_channels = sorted(new_channels - old_channels,
+                                key=self._get_join_priority)
+
+        _logger.info('Channels updated. Joining %s, parting %s',
+                     len(added_channels), len(removed_channels))
+
+        for channel in removed_channels:
+            self.part(channel)
+
+        discord_channels = [
+            channel for channel in added_channels
+            if self.get_platform_name(channel) == 'discord'
+        ]
+        twitch_channels = [
+            channel for channel in added_channels
+            if self.get_platform_name(channel) == 'twitch'
+        ]
+
+        if discord_channels and self._discord_client:
+            for channel in discord_channels:
+                self._discord_client.join(channel)
+
+        if twitch_channels:
+            self.join(','.join(twitch_channels))
+
+    def _process_message(self, message: InboundEvent, client):
         session = InboundMessageSession(message, self, client)
 
         self._process_message_handlers(session)
 
-        event_type = message['event_type']
+        event_type = message.event_type
 
         if event_type in ('pubmsg', 'action'):
             self._process_text_commands(session)
 
     def _process_text_commands(self, session: InboundMessageSession):
-        message = session.message
-        text = message['text']
-        username = message['username']
-        channel = message['channel']
+        message = session.message  # type: ChatMessageEvent
+        text = message.text
+        username = message.username
+        channel = message.channel
         our_username = session.client.get_nickname(lower=True)
 
         if username in self._ignored_users:
@@ -284,34 +441,119 @@ class Bot(object):
         if username == our_username:
             return
 
-        for registered_command_info in self._commands:
-            pattern = registered_command_info.command_regex
-            command_func = registered_command_info.func
-            ignore_rate_limit = registered_command_info.ignore_rate_limit
-            match = re.match(pattern, text)
+        result = self._command_dispatcher.match(text)
+
+        _logger.debug('Tested %s of %s command patterns',
+                      result.num_tested, len(self._command_dispatcher))
+        chatbot383.metrics.DISPATCH_PATTERNS_TESTED.observe(result.num_tested)
+
+        if not result.match:
+            return
+
+        registered_command_info = result.value
+        command_func = functools.partial(
+            self._run_timed_command, registered_command_info.func)
+        ignore_rate_limit = registered_command_info.ignore_rate_limit
 
-            if match:
-                if not ignore_rate_limit:
-                    if not self._user_limiter.is_ok(username):
-                        return
-                    if not self._channel_spam_limiter.is_ok(channel):
-                        return
+        if not ignore_rate_limit:
+            if not self._user_limiter.is_ok(username):
+                return
+            if not self._channel_spam_limiter.is_ok(channel):
+                return
+
+        session.match = result.match
+
+        if registered_command_info.blocking:
+            try:
+                self._run_blocking_command(
+                    command_func, session, not ignore_rate_limit)
+            except WorkerPoolFullError:
+                _logger.warning('Command worker pool full. Dropped %s %s',
+                                ascii(channel), ascii(text))
+                chatbot383.metrics.COMMANDS_DROPPED.inc()
+
+            return
+
+        if self._reply_sequencer.has_pending(channel):
+            reply_buffer = self._reply_sequencer.open(channel)
+            session.reply_buffer = reply_buffer
 
-                session.match = match
+            try:
                 command_func(session)
+            finally:
+                self._reply_sequencer.close(channel, reply_buffer)
+        else:
+            command_func(session)
 
-                if not session.skip_rate_limit and not ignore_rate_limit:
-                    self._user_limiter.update(username)
-                    self._channel_spam_limiter.update(channel)
+        if not session.skip_rate_limit and not ignore_rate_limit:
+            self._user_limiter.update(username)
+            self._channel_spam_limiter.update(channel)
 
-                break
+    @classmethod
+    def _get_func_name(cls, func) -> str:
+        return getattr(func, '__qualname__', None) or repr(func)
+
+    def _run_timed_command(self, command_func, session: InboundMessageSession):
+        command_name = self._get_func_name(command_func)
+        start_time = time.perf_counter()
+
+        try:
+            self._call_profiled(command_name, command_func, session)
+        except Exception:
+            chatbot383.metrics.COMMAND_ERRORS.labels(command_name).inc()
+            raise
+        finally:
+            chatbot383.metrics.COMMAND_LATENCY.labels(command_name).observe(
+                time.perf_counter() - start_time)
+            chatbot383.metrics.COMMANDS_BY_CHANNEL.labels(
+                session.message['channel']).inc()
+
+    def _run_blocking_command(self, command_func, session: InboundMessageSession,
+                              rate_limit: bool=True):
+        channel = session.message['channel']
+        username = session.message['username']
+        reply_buffer = self._reply_sequencer.open(channel)
+        session.reply_buffer = reply_buffer
+
+        # Taken now so more commands can't pass the limits while this one
+        # runs, and given back if the command turns out not to count
+        if rate_limit:
+            self._user_limiter.update(username)
+            self._channel_spam_limiter.update(channel)
+
+        def refund():
+            if rate_limit:
+                self._user_limiter.refund(username)
+                self._channel_spam_limiter.refund(channel)
+
+        def finish():
+            self._reply_sequencer.close(channel, reply_buffer)
+
+            if session.skip_rate_limit:
+                refund()
+
+        def done_callback():
+            self.call_from_thread(finish)
+
+        try:
+            self._command_worker_pool.submit(
+                command_func, session, done_callback=done_callback)
+        except WorkerPoolFullError:
+            self._reply_sequencer.close(channel, reply_buffer)
+            refund()
+            raise
 
     def _process_message_handlers(self, session: InboundMessageSession):
-        event_type = session.message['event_type']
+        event_type = session.message.event_type
 
-        for command_event_type, command_func in self._message_handlers:
-            if event_type == command_event_type:
-                command_func(session)
+        for command_func in self._message_handlers.get(event_type, ()):
+            handler_name = self._get_func_name(command_func)
+            start_time = time.perf_counter()
+
+            self._call_profiled(handler_name, command_func, session)
+
+            chatbot383.metrics.HANDLER_LATENCY.labels(handler_name).observe(
+                time.perf_counter() - start_time)
 
     def _join_channels(self, session: InboundMessageSession):
         channels = self._channels | self._lurk_channels
@@ -321,44 +563,80 @@ class Bot(object):
                 lambda chan: self.get_platform_name(chan) == 'discord',
                 channels
             )
-        else:
-            channels = filter(
-                lambda chan: self.get_platform_name(chan) == 'twitch',
-                channels
+
+            grouped_channels = (
+                ','.join(channel for channel in group if channel)
+                for group in grouper(channels, 10)
             )
 
-        grouped_channels = (
-            ','.join(channel for channel in group if channel)
-            for group in grouper(channels, 10)
-        )
+            for channel in grouped_channels:
+                session.bot.join(channel)
 
-        for channel in grouped_channels:
-            session.bot.join(channel)
+            return
 
-    @classmethod
-    def get_platform_name(cls, channel: str) -> str:
-        if channel.startswith(chatbot383.discord.gateway.CHANNEL_PREFIX):
-            return 'discord'
-        else:
-            return 'twitch'
+        channels = [
+            channel for channel in channels
+            if self.get_platform_name(channel) == 'twitch'
+        ]
 
+        if isinstance(self._main_client, ClientPool):
+            channels = self._main_client.connection_welcomed(
+                session.client, channels)
 
-class Limiter(object):
-    def __init__(self, min_interval: float=5):
-        self._min_interval = min_interval
-        self._table = {}
+        self._join_manager.connection_ready(session.client)
+        self._join_manager.add(session.client, channels)
+        self._process_joins()
 
-    def is_ok(self, key) -> bool:
-        if key not in self._table:
-            return True
+    def _connection_lost(self, session: InboundMessageSession):
+        if session.client == self._discord_client:
+            return
+
+        self._join_manager.connection_lost(session.client)
+
+        if isinstance(self._main_client, ClientPool):
+            moves = self._main_client.connection_lost(session.client)
+
+            for client, channels in moves.items():
+                self._join_manager.add(client, channels)
+
+            self._process_joins()
+
+    def _join_seen(self, session: InboundMessageSession):
+        message = session.message  # type: MembershipEvent
+
+        if message.username == session.client.get_nickname(lower=True):
+            self._join_manager.confirm(session.client, message.channel)
 
-        time_now = time.time()
+    def _part_seen(self, session: InboundMessageSession):
+        message = session.message  # type: MembershipEvent
 
-        return time_now - self._table[key] > self._min_interval
+        if message.username == session.client.get_nickname(lower=True):
+            self._join_manager.parted(session.client, message.channel)
+            self._process_joins()
 
-    def update(self, key, offset=0.0):
-        self._table[key] = time.time() + offset
+    def _get_join_priority(self, channel: str):
+        # Channels we talk in before the ones we only watch
+        return channel not in self._channels, channel
 
-        if len(self._table) > 500:
-            key = random.choice(self._table)
-            del self._table[key]
+    def _process_joins(self):
+        if self._join_event:
+            try:
+                self._scheduler.cancel(self._join_event)
+            except ValueError:
+                pass
+
+            self._join_event = None
+
+        delay = self._join_manager.process(
+            lambda client, channel: client.join(channel))
+
+        if delay is not None:
+            self._join_event = self._scheduler.enter(
+                delay, 0, self._process_joins)
+
+    @classmethod
+    def get_platform_name(cls, channel: str) -> str:
+        if channel.startswith(chatbot383.discord.gateway.CHANNEL_PREFIX):
+            return 'discord'
+        else:
+            return 'twitch'
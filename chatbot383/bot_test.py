@@ -0,0 +1,138 @@
+import asyncio
+import queue
+import threading
+import time
+import unittest
+
+from chatbot383.bot import Bot
+from chatbot383.events import ChatMessageEvent
+
+
+class _FakeConnection(object):
+    server_address = ('test', 0)
+    connected = True
+
+    def get_nickname(self):
+        return 'TestBot'
+
+
+class FakeClient(object):
+    twitch_char_limit = True
+    name = 'test'
+
+    def __init__(self, inbound_queue):
+        self.inbound_queue = inbound_queue
+        self.connection = _FakeConnection()
+        self.sent = []
+
+    def get_nickname(self, lower=False):
+        nickname = self.connection.get_nickname()
+        return nickname.lower() if lower else nickname
+
+    def privmsg(self, target, text, action=False, **kwargs):
+        self.sent.append((target, text))
+        return True
+
+    def join(self, channel):
+        return True
+
+    def part(self, channel):
+        return True
+
+
+def make_message(client, text, username='user1', channel='#test'):
+    return ChatMessageEvent(client, 'pubmsg', username, text, username,
+                            channel=channel)
+
+
+class TestBlockingCommand(unittest.TestCase):
+    def setUp(self):
+        self.inbound_queue = queue.Queue()
+        self.client = FakeClient(self.inbound_queue)
+        self.bot = Bot(['#test'], self.client, self.inbound_queue)
+        self.skip = threading.Event()
+
+        def command(session):
+            if self.skip.is_set():
+                session.skip_rate_limit = True
+            else:
+                session.reply('done')
+
+        self.bot.register_command(r'!slow', command, blocking=True)
+
+        self.release = threading.Event()
+        self.started = []
+
+        def waiting_command(session):
+            self.started.append(session.message['text'])
+            self.release.wait(5)
+
+        self.bot.register_command(r'!wait.*', waiting_command, blocking=True)
+
+    def _run_command(self):
+        self.bot._process_inbound_item(make_message(self.client, '!slow'))
+        # Wait for the done callback posted back to the bot thread
+        self.bot._process_inbound_item(self.inbound_queue.get(timeout=5))
+
+    def test_rate_limited(self):
+        self._run_command()
+
+        self.assertEqual([('#test', '@user1, done')], self.client.sent)
+        self.assertFalse(self.bot.user_limiter.is_ok('user1'))
+
+    def test_skip_rate_limit(self):
+        self.skip.set()
+        self._run_command()
+
+        self.assertEqual([], self.client.sent)
+        self.assertTrue(self.bot.user_limiter.is_ok('user1'))
+        self.assertTrue(self.bot.channel_spam_limiter.is_ok('#test'))
+
+    def test_limited_while_running(self):
+        self.bot._process_inbound_item(make_message(self.client, '!wait 1'))
+        self.bot._process_inbound_item(make_message(self.client, '!wait 2'))
+        self.release.set()
+        self.bot._process_inbound_item(self.inbound_queue.get(timeout=5))
+        self.bot._command_worker_pool.shutdown(wait=True)
+
+        self.assertEqual(['!wait 1'], self.started)
+        self.assertFalse(self.bot.user_limiter.is_ok('user1'))
+
+
+class TestRunAsync(unittest.TestCase):
+    def test_command_and_scheduled_callback(self):
+        async def run():
+            inbound_queue = asyncio.Queue()
+            client = FakeClient(inbound_queue)
+            bot = Bot(['#test', '#other'], client, inbound_queue)
+            scheduled = asyncio.Event()
+
+            bot.register_command(r'!hi', lambda session: session.reply('hi'))
+            bot.register_command(
+                r'!slow', lambda session: session.reply('slow'), blocking=True)
+            bot.scheduler.enter(0.05, 0, scheduled.set)
+
+            task = asyncio.ensure_future(bot.run_async())
+
+            try:
+                await inbound_queue.put(make_message(client, '!hi'))
+                await inbound_queue.put(
+                    make_message(client, '!slow', username='user2',
+                                 channel='#other'))
+                await asyncio.wait_for(scheduled.wait(), 5)
+
+                # The blocking command's reply comes back through the loop
+                deadline = time.monotonic() + 5
+
+                while len(client.sent) < 2 and time.monotonic() < deadline:
+                    await asyncio.sleep(0.01)
+            finally:
+                task.cancel()
+                bot._command_worker_pool.shutdown(wait=True)
+
+            return client.sent
+
+        sent = asyncio.run(run())
+
+        self.assertEqual(
+            [('#test', '@user1, hi'), ('#other', '@user2, slow')], sent)
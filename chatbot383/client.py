@@ -1,18 +1,25 @@
 import logging
 import queue
+import select
+import socket
 import ssl
 import threading
 import functools
 import re
 
 import irc.client
-import irc.strings
 import irc.connection
 
+from chatbot383.events import WelcomeEvent, DisconnectEvent, \
+    ChatMessageEvent, ChannelNoticeEvent, MembershipEvent, NamesEvent, \
+    lower_identity
+from chatbot383.outbound import OutboundScheduler, AccountRateLimiter
+import chatbot383.metrics
+
 _logger = logging.getLogger(__name__)
 
-IRC_RATE_LIMIT = (20 - 0.5) / 30
 RECONNECT_INTERVAL = 60 * 2
+EVENT_LOOP_TIMER_INTERVAL = 1.0
 
 
 class InvalidTextError(ValueError):
@@ -20,14 +27,31 @@ class InvalidTextError(ValueError):
 
 
 class Client(irc.client.SimpleIRCClient):
-    def __init__(self, inbound_queue=None, twitch_char_limit=False):
+    def __init__(self, inbound_queue=None, twitch_char_limit=False,
+                 event_loop=None, rate_limiter: AccountRateLimiter=None,
+                 coalesce_outbound=False, name: str='main'):
         super().__init__()
 
         irc.client.ServerConnection.buffer_class.errors = 'replace'
-        self.connection.set_rate_limit(IRC_RATE_LIMIT)
         self._running = True
-        self._inbound_queue = inbound_queue or queue.Queue(100)
-        self._outbound_queue = queue.Queue(10)
+        self._event_loop = event_loop
+        self._event_loop_socket = None
+        self._outbound_handle = None
+        self._outbound_scheduler = OutboundScheduler(
+            rate_limiter, coalesce=coalesce_outbound)
+        self.name = name
+
+        chatbot383.metrics.QUEUE_DEPTH.labels('outbound_{}'.format(name)) \
+            .set_function(lambda: len(self._outbound_scheduler))
+
+        if event_loop:
+            self._inbound_queue = inbound_queue
+        else:
+            self._inbound_queue = inbound_queue or queue.Queue(100)
+            # Lets other threads wake up the select() when sending
+            self._wake_up_reader, self._wake_up_writer = socket.socketpair()
+            self._wake_up_reader.setblocking(False)
+            self._wake_up_writer.setblocking(False)
 
         self.twitch_char_limit = twitch_char_limit
         if twitch_char_limit:
@@ -42,8 +66,18 @@ class Client(irc.client.SimpleIRCClient):
         return self._inbound_queue
 
     @property
-    def outbound_queue(self):
-        return self._outbound_queue
+    def outbound_scheduler(self) -> OutboundScheduler:
+        return self._outbound_scheduler
+
+    @property
+    def event_loop(self):
+        return self._event_loop
+
+    def _put_inbound(self, item):
+        if self._event_loop:
+            self._inbound_queue.put_nowait(item)
+        else:
+            self._inbound_queue.put(item)
 
     def _dispatcher(self, connection, event):
         # Override parent class
@@ -78,6 +112,9 @@ class Client(irc.client.SimpleIRCClient):
         except irc.client.ServerConnectionError:
             _logger.exception('Connect failed.')
             self._schedule_reconnect()
+        else:
+            if self._event_loop:
+                self._add_event_loop_reader()
 
     def _schedule_reconnect(self):
         self.reactor.scheduler.execute_after(RECONNECT_INTERVAL, self.autoconnect)
@@ -85,6 +122,11 @@ class Client(irc.client.SimpleIRCClient):
     def _on_disconnect(self, connection, event):
         _logger.info('Disconnected %s!', self.connection.server_address)
 
+        if self._event_loop:
+            self._remove_event_loop_reader()
+
+        self._put_inbound(DisconnectEvent(self))
+
         if self._running:
             self._schedule_reconnect()
 
@@ -93,9 +135,75 @@ class Client(irc.client.SimpleIRCClient):
         self.reactor.disconnect_all()
 
     def process(self):
-        self._process_outbound_messages()
+        wait_time = self._process_outbound_messages()
+
+        if wait_time is None:
+            timeout = 0.2
+        else:
+            timeout = min(0.2, wait_time)
+
+        sockets = self.reactor.sockets
+        readable_sockets = select.select(
+            sockets + [self._wake_up_reader], [], [], timeout)[0]
+
+        if self._wake_up_reader in readable_sockets:
+            readable_sockets.remove(self._wake_up_reader)
+
+            try:
+                self._wake_up_reader.recv(1024)
+            except BlockingIOError:
+                pass
+
+        self.reactor.process_data(readable_sockets)
+        self.reactor.process_timeout()
+
+    def _wake_up(self):
+        if self._event_loop:
+            self._schedule_outbound()
+        else:
+            try:
+                self._wake_up_writer.send(b'\x00')
+            except BlockingIOError:
+                pass
+
+    def start_event_loop_processing(self):
+        assert self._event_loop
+        self._tick_reactor_scheduler()
+
+    def _tick_reactor_scheduler(self):
+        # The reactor scheduler only holds the keep alive and reconnect
+        # timers so a coarse interval is fine
+        self.reactor.process_timeout()
+        self._event_loop.call_later(
+            EVENT_LOOP_TIMER_INTERVAL, self._tick_reactor_scheduler)
+
+    def _add_event_loop_reader(self):
+        self._remove_event_loop_reader()
+        self._event_loop_socket = self.connection.socket
+        self._event_loop.add_reader(
+            self._event_loop_socket, self._on_event_loop_readable)
+
+    def _remove_event_loop_reader(self):
+        if self._event_loop_socket is not None:
+            self._event_loop.remove_reader(self._event_loop_socket)
+            self._event_loop_socket = None
+
+    def _on_event_loop_readable(self):
+        self.reactor.process_data([self._event_loop_socket])
 
-        self.reactor.process_once(0.2)
+    def _schedule_outbound(self, delay=0.0):
+        if self._outbound_handle:
+            self._outbound_handle.cancel()
+
+        self._outbound_handle = self._event_loop.call_later(
+            delay, self._process_outbound_messages_event_loop)
+
+    def _process_outbound_messages_event_loop(self):
+        self._outbound_handle = None
+        wait_time = self._process_outbound_messages()
+
+        if wait_time is not None:
+            self._schedule_outbound(wait_time)
 
     @classmethod
     def validate_text(cls, text):
@@ -108,196 +216,190 @@ class Client(irc.client.SimpleIRCClient):
         self.connection.cap('REQ', 'twitch.tv/commands')
         self.connection.cap('REQ', 'twitch.tv/tags')
 
-        self._inbound_queue.put({
-            'client': self,
-            'event_type': 'welcome'
-        })
+        self._put_inbound(WelcomeEvent(self))
 
     def _on_pubmsg(self, connection, event):
-        channel = irc.strings.lower(event.target)
-        nick = self.tags_to_dict(event.tags).get('display-name') or event.source.nick
-        username = irc.strings.lower(event.source.nick)
-        user_id = self.tags_to_dict(event.tags).get('user-id')
-
-        if not event.arguments:
-            return
-
-        text = event.arguments[0]
-
-        self._inbound_queue.put({
-            'client': self,
-            'event_type': 'pubmsg',
-            'channel': channel,
-            'nick': nick,
-            'username': username,
-            'text': text,
-            'user_id': user_id,
-        })
+        self._put_chat_message_event('pubmsg', event)
 
     def _on_action(self, connection, event):
-        channel = irc.strings.lower(event.target)
-        nick = self.tags_to_dict(event.tags).get('display-name') or event.source.nick
-        username = irc.strings.lower(event.source.nick)
-        user_id = self.tags_to_dict(event.tags).get('user-id')
+        self._put_chat_message_event('action', event)
 
+    def _put_chat_message_event(self, event_type, event):
         if not event.arguments:
             return
 
-        text = event.arguments[0]
-
-        self._inbound_queue.put({
-            'client': self,
-            'event_type': 'action',
-            'channel': channel,
-            'nick': nick,
-            'username': username,
-            'text': text,
-            'user_id': user_id,
-        })
+        self._put_inbound(ChatMessageEvent(
+            self, event_type,
+            channel=lower_identity(event.target),
+            username=lower_identity(event.source.nick),
+            text=event.arguments[0],
+            source_nick=event.source.nick,
+            raw_tags=event.tags
+        ))
 
     def _on_pubnotice(self, connection, event):
-        channel = irc.strings.lower(event.target)
-        text = event.arguments[0]
-
-        self._inbound_queue.put({
-            'client': self,
-            'event_type': 'pubnotice',
-            'channel': channel,
-            'text': text
-        })
+        self._put_inbound(ChannelNoticeEvent(
+            self, 'pubnotice',
+            channel=lower_identity(event.target),
+            text=event.arguments[0]
+        ))
 
     def _on_clearchat(self, connection, event):
-        channel = irc.strings.lower(event.target)
         nick = event.arguments[0] if event.arguments else None
-        username = irc.strings.lower(nick) if nick else None
 
-        self._inbound_queue.put({
-            'client': self,
-            'event_type': 'clearchat',
-            'channel': channel,
-            'nick': nick,
-            'username': username,
-        })
+        self._put_inbound(MembershipEvent(
+            self, 'clearchat',
+            channel=lower_identity(event.target),
+            nick=nick,
+            username=lower_identity(nick) if nick else None
+        ))
 
     def _on_whisper(self, connection, event):
-        nick = event.source.nick
-        username = irc.strings.lower(nick)
-        text = event.arguments[0]
-        user_id = self.tags_to_dict(event.tags).get('user-id')
-
-        self._inbound_queue.put({
-            'client': self,
-            'event_type': 'whisper',
-            'nick': nick,
-            'username': username,
-            'text': text,
-            'user_id': user_id,
-        })
+        self._put_inbound(ChatMessageEvent(
+            self, 'whisper',
+            username=lower_identity(event.source.nick),
+            text=event.arguments[0],
+            source_nick=event.source.nick,
+            raw_tags=event.tags
+        ))
+
+    def _on_userstate(self, connection, event):
+        tags = ChatMessageEvent.tags_to_dict(event.tags)
+        badges = tags.get('badges') or ''
+        moderator = tags.get('mod') == '1' or 'broadcaster/' in badges
+
+        self._outbound_scheduler.rate_limiter.set_moderator(
+            lower_identity(event.target), moderator)
 
     def _on_join(self, connection, event):
-        channel = irc.strings.lower(event.target)
-        nick = event.source.nick
-        username = irc.strings.lower(event.source.nick)
-
-        self._inbound_queue.put({
-            'client': self,
-            'event_type': 'join',
-            'channel': channel,
-            'nick': nick,
-            'username': username,
-        })
+        self._put_inbound(MembershipEvent(
+            self, 'join',
+            channel=lower_identity(event.target),
+            nick=event.source.nick,
+            username=lower_identity(event.source.nick)
+        ))
 
     def _on_part(self, connection, event):
-        channel = irc.strings.lower(event.target)
-        nick = event.source.nick
-        username = irc.strings.lower(event.source.nick)
-
-        self._inbound_queue.put({
-            'client': self,
-            'event_type': 'part',
-            'channel': channel,
-            'nick': nick,
-            'username': username,
-        })
+        self._put_inbound(MembershipEvent(
+            self, 'part',
+            channel=lower_identity(event.target),
+            nick=event.source.nick,
+            username=lower_identity(event.source.nick)
+        ))
+
+    def _on_namreply(self, connection, event):
+        # Arguments are the channel type, channel, and space separated nicks
+        self._put_inbound(NamesEvent(
+            self, 'names',
+            channel=lower_identity(event.arguments[1]),
+            usernames=tuple(
+                lower_identity(nick.lstrip('@+'))
+                for nick in event.arguments[2].split()
+            )
+        ))
+
+    def _on_endofnames(self, connection, event):
+        self._put_inbound(NamesEvent(
+            self, 'names_end', channel=lower_identity(event.arguments[0])))
 
     def _process_outbound_messages(self):
-        for dummy in range(5):
-            try:
-                item = self._outbound_queue.get_nowait()
-            except queue.Empty:
-                break
-
-            if not self.connection.connected:
-                _logger.error('Not connected. Dropping output item %s', item)
-                return
+        # Returns the time until the next item can be sent
+        for dummy in range(20):
+            item, wait_time = self._outbound_scheduler.pop_ready()
 
-            _logger.debug('Process outbound queue item %s %s',
-                          item, self.connection.server_address)
+            if not item:
+                return wait_time
 
-            outbound_message_type = item['message_type']
+            self._process_outbound_item(item)
 
-            if outbound_message_type == 'privmsg':
-                target = item['target']
-                text = item['text']
+        return 0.0
 
-                try:
-                    self.validate_text(target)
-                    self.validate_text(text)
-                except InvalidTextError:
-                    _logger.exception('Skipping messages')
-                    continue
+    def _process_outbound_item(self, item):
+        if not self.connection.connected:
+            _logger.error('Not connected. Dropping output item %s', item)
+            chatbot383.metrics.OUTBOUND_DROPPED.labels(
+                self.name, 'disconnected').inc()
+            return False
 
-                if item['format_action']:
-                    self.connection.action(target, text)
-                else:
-                    self.connection.privmsg(target, text)
+        _logger.debug('Process outbound queue item %s %s',
+                      item, self.connection.server_address)
 
-            elif outbound_message_type == 'join':
-                _logger.info('Join %s', item['channel'])
-                self.connection.join(item['channel'])
+        outbound_message_type = item['message_type']
 
-            elif outbound_message_type == 'part':
-                _logger.info('Part %s', item['channel'])
-                self.connection.part(item['channel'])
+        if outbound_message_type == 'privmsg':
+            target = item['target']
+            text = item['text']
 
+            try:
+                self.validate_text(target)
+                self.validate_text(text)
+            except InvalidTextError:
+                _logger.exception('Skipping messages')
+                return True
+
+            if item['format_action']:
+                self.connection.action(target, text)
             else:
-                raise ValueError('Unknown message type {}'
-                                 .format(outbound_message_type))
+                self.connection.privmsg(target, text)
+
+        elif outbound_message_type == 'join':
+            _logger.info('Join %s', item['channel'])
+            self.connection.join(item['channel'])
+
+        elif outbound_message_type == 'part':
+            _logger.info('Part %s', item['channel'])
+            self.connection.part(item['channel'])
+
+        else:
+            raise ValueError('Unknown message type {}'
+                             .format(outbound_message_type))
+
+        chatbot383.metrics.OUTBOUND_SENT.labels(
+            self.name, outbound_message_type).inc()
+
+        return True
+
+    def _put_outbound(self, item, lane):
+        if not self._outbound_scheduler.enqueue(item, lane):
+            _logger.warning('Outbound %s lane full. Dropped %s', lane, item)
+            chatbot383.metrics.OUTBOUND_DROPPED.labels(self.name, lane).inc()
+            return False
 
-            self.reactor.process_once(0.01)
+        self._wake_up()
+        return True
 
-    def privmsg(self, target, text, action=False):
-        self._outbound_queue.put({
+    def privmsg(self, target, text, action=False, lane='reply',
+                max_length=None, max_byte_length=None) -> bool:
+        return self._put_outbound({
             'message_type': 'privmsg',
             'target': target,
             'text': text,
-            'format_action': action
-        })
+            'format_action': action,
+            'max_length': max_length,
+            'max_byte_length': max_byte_length,
+        }, lane)
 
-    def join(self, channel):
-        self._outbound_queue.put({
+    def join(self, channel) -> bool:
+        return self._put_outbound({
             'message_type': 'join',
             'channel': channel
-        })
+        }, 'control')
 
-    def part(self, channel):
-        self._outbound_queue.put({
+    def part(self, channel) -> bool:
+        return self._put_outbound({
             'message_type': 'part',
             'channel': channel
-        })
+        }, 'control')
 
     def get_nickname(self, lower=False):
         if lower:
-            return irc.strings.lower(self.connection.get_nickname())
+            return lower_identity(self.connection.get_nickname())
         else:
             return self.connection.get_nickname()
 
     @classmethod
     def tags_to_dict(cls, tags):
-        return dict([
-            (item.get('key'), item.get('value'))
-            for item in tags
-        ])
+        return ChatMessageEvent.tags_to_dict(tags)
 
     def _keep_alive(self):
         if self.connection.is_connected():
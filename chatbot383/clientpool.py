@@ -0,0 +1,213 @@
+import logging
+import threading
+import zlib
+
+from chatbot383.client import Client
+from chatbot383.util import grouper
+
+_logger = logging.getLogger(__name__)
+
+HASH_METHODS = ('rendezvous', 'modulo')
+
+
+class ClientPool(object):
+    """Spreads channels over several connections of the same account.
+
+    The pool can be used in place of a Client by the Bot. Messages and
+    JOIN/PART for a channel are sent through the connection that owns it.
+    When a connection is lost, its channels are moved to the remaining
+    connections and moved back when it reconnects.
+    """
+    def __init__(self, clients, hash_method: str='rendezvous'):
+        assert clients
+        assert all(client.inbound_queue == clients[0].inbound_queue
+                   for client in clients)
+
+        if hash_method not in HASH_METHODS:
+            raise ValueError('Unknown hash method {}'.format(hash_method))
+
+        self._clients = tuple(clients)
+        self._hash_method = hash_method
+        self._connected = set()
+        self._channels = set()
+        self._owners = {}
+        self._lock = threading.RLock()
+
+    @property
+    def clients(self):
+        return self._clients
+
+    @property
+    def inbound_queue(self):
+        return self._clients[0].inbound_queue
+
+    @property
+    def event_loop(self):
+        return self._clients[0].event_loop
+
+    @property
+    def twitch_char_limit(self) -> bool:
+        return self._clients[0].twitch_char_limit
+
+    @property
+    def connection(self):
+        return self._get_any_client().connection
+
+    def __contains__(self, client: Client):
+        return client in self._clients
+
+    def get_nickname(self, lower=False):
+        return self._get_any_client().get_nickname(lower=lower)
+
+    def get_owner(self, channel: str) -> Client:
+        with self._lock:
+            index = self._owners.get(channel)
+
+            if index is None:
+                return None
+
+            return self._clients[index]
+
+    def _get_any_client(self) -> Client:
+        for index in sorted(self._connected):
+            return self._clients[index]
+
+        return self._clients[0]
+
+    def _pick_owner(self, channel: str, candidates) -> int:
+        candidates = sorted(candidates)
+
+        if not candidates:
+            return None
+
+        if self._hash_method == 'modulo':
+            channel_hash = zlib.crc32(channel.encode('utf8', 'replace'))
+            return candidates[channel_hash % len(candidates)]
+        else:
+            return max(
+                candidates,
+                key=lambda index: zlib.crc32(
+                    '{}\x00{}'.format(channel, index).encode('utf8', 'replace'))
+            )
+
+    def privmsg(self, target, text, **kwargs) -> bool:
+        client = self.get_owner(target) or self._get_any_client()
+
+        return client.privmsg(target, text, **kwargs)
+
+    def assign(self, channels) -> dict:
+        """Pick owners for new channels.
+
+        Returns a dict of clients to the channels they should join.
+        """
+        to_join = {}
+
+        with self._lock:
+            for channel in channels:
+                self._channels.add(channel)
+
+                if channel in self._owners:
+                    continue
+
+                index = self._pick_owner(channel, self._connected)
+
+                if index is None:
+                    continue
+
+                self._owners[channel] = index
+                to_join.setdefault(self._clients[index], []).append(channel)
+
+        return to_join
+
+    def join(self, channel: str) -> bool:
+        # Channel can be a comma separated list
+        channels = [name for name in channel.split(',') if name]
+        ok = True
+
+        for client, names in self.assign(channels).items():
+            ok &= self._join_on_client(client, names)
+
+        return ok
+
+    def part(self, channel: str) -> bool:
+        with self._lock:
+            self._channels.discard(channel)
+            index = self._owners.pop(channel, None)
+
+        if index is None:
+            return True
+
+        return self._clients[index].part(channel)
+
+    def connection_welcomed(self, client: Client, channels) -> list:
+        """Mark the connection as usable and return channels it should join.
+
+        Channels owned by other connections that now hash to this connection
+        are parted from the other connections.
+        """
+        index = self._clients.index(client)
+        assigned = []
+        to_part = []
+
+        with self._lock:
+            self._connected.add(index)
+            self._channels.update(channels)
+
+            for channel in sorted(self._channels):
+                new_index = self._pick_owner(channel, self._connected)
+                old_index = self._owners.get(channel)
+
+                if new_index != index:
+                    continue
+
+                if old_index is not None and old_index != index:
+                    to_part.append((old_index, channel))
+
+                self._owners[channel] = index
+                assigned.append(channel)
+
+        for old_index, channel in to_part:
+            _logger.info('Moving channel %s from connection %s to %s',
+                         channel, old_index, index)
+            self._clients[old_index].part(channel)
+
+        return assigned
+
+    def connection_lost(self, client: Client) -> dict:
+        """Move the channels of a lost connection to the remaining ones.
+
+        Returns a dict of clients to the channels they should join.
+        """
+        index = self._clients.index(client)
+        to_join = {}
+
+        with self._lock:
+            self._connected.discard(index)
+
+            for channel, owner_index in list(self._owners.items()):
+                if owner_index != index:
+                    continue
+
+                new_index = self._pick_owner(channel, self._connected)
+
+                if new_index is None:
+                    del self._owners[channel]
+                    continue
+
+                self._owners[channel] = new_index
+                to_join.setdefault(self._clients[new_index], []).append(channel)
+
+        for new_client, channels in to_join.items():
+            _logger.info('Moving %s channels from connection %s to %s',
+                         len(channels), index, self._clients.index(new_client))
+
+        return to_join
+
+    @classmethod
+    def _join_on_client(cls, client: Client, channels) -> bool:
+        ok = True
+
+        for group in grouper(channels, 10):
+            ok &= client.join(','.join(channel for channel in group if channel))
+
+        return ok
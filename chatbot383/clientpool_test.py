@@ -0,0 +1,90 @@
+import unittest
+
+from chatbot383.clientpool import ClientPool
+
+
+class FakeClient(object):
+    def __init__(self, name):
+        self.name = name
+        self.inbound_queue = None
+        self.joined = []
+        self.parted = []
+        self.messages = []
+
+    def join(self, channel):
+        self.joined.extend(channel.split(','))
+        return True
+
+    def part(self, channel):
+        self.parted.append(channel)
+        return True
+
+    def privmsg(self, target, text, **kwargs):
+        self.messages.append((target, text))
+        return True
+
+
+class TestClientPool(unittest.TestCase):
+    def setUp(self):
+        self.clients = [FakeClient(index) for index in range(3)]
+        self.pool = ClientPool(self.clients)
+        self.channels = ['#channel{}'.format(index) for index in range(30)]
+
+    def test_spread(self):
+        assigned = []
+
+        for client in self.clients:
+            assigned.append(
+                self.pool.connection_welcomed(client, self.channels))
+
+        all_assigned = [channel for channels in assigned for channel in channels]
+        self.assertEqual(sorted(self.channels), sorted(set(all_assigned)))
+        self.assertTrue(all(assigned))
+
+        for channel in self.channels:
+            owner = self.pool.get_owner(channel)
+            self.assertIn(channel, assigned[self.clients.index(owner)])
+
+    def test_privmsg_routes_to_owner(self):
+        for client in self.clients:
+            self.pool.connection_welcomed(client, self.channels)
+
+        self.pool.privmsg('#channel5', 'hello')
+        owner = self.pool.get_owner('#channel5')
+
+        self.assertEqual([('#channel5', 'hello')], owner.messages)
+
+    def test_connection_lost_and_back(self):
+        for client in self.clients:
+            self.pool.connection_welcomed(client, self.channels)
+
+        lost_client = self.clients[1]
+        lost_channels = [
+            channel for channel in self.channels
+            if self.pool.get_owner(channel) is lost_client
+        ]
+
+        moves = self.pool.connection_lost(lost_client)
+
+        for channel in lost_channels:
+            owner = self.pool.get_owner(channel)
+            self.assertIsNot(lost_client, owner)
+            self.assertIn(channel, moves[owner])
+
+        assigned = self.pool.connection_welcomed(lost_client, self.channels)
+
+        self.assertEqual(sorted(lost_channels), sorted(assigned))
+
+        for channel in lost_channels:
+            self.assertIs(lost_client, self.pool.get_owner(channel))
+
+    def test_join_part(self):
+        self.pool.connection_welcomed(self.clients[0], [])
+        self.pool.join('#a,#b')
+
+        self.assertEqual(['#a', '#b'], self.clients[0].joined)
+
+        self.pool.part('#a')
+
+        self.assertEqual(['#a'], self.clients[0].parted)
+        self.assertIsNone(self.pool.get_owner('#a'))
@@ -0,0 +1,748 @@
+"""Mail and greeting storage.
+
+Writes run in order on a single writer thread. Reads run on a small pool
+of read-only connections, which WAL mode lets proceed while the writer
+is busy. Mail counts and recent greetings are cached in memory and
+updated by every write. Every method returns a
+`concurrent.futures.Future`.
+"""
+import array
+import bisect
+import collections
+import concurrent.futures
+import logging
+import os
+import queue
+import random
+import sqlite3
+import threading
+import time
+import urllib.request
+
+import chatbot383.metrics
+
+_logger = logging.getLogger(__name__)
+_random = random.Random()
+
+
+class MailbagFullError(ValueError):
+    pass
+
+
+class SenderOutboxFullError(MailbagFullError):
+    pass
+
+
+def split_sender(username: str) -> tuple:
+    """Split a packed ``username!user_id@platform`` sender."""
+    name, dummy, address = username.partition('!')
+    user_id, dummy, platform = address.partition('@')
+    return name, user_id, platform
+
+
+def _completed_future(result) -> concurrent.futures.Future:
+    future = concurrent.futures.Future()
+    future.set_result(result)
+    return future
+
+
+class ReadMailIndex(object):
+    """IDs of read mail for picking a random old letter.
+
+    Letters are kept in insertion order with the sender of each. Channels
+    have their own list of sequence numbers, which are positions plus the
+    number of letters dropped from the front. A letter is picked by
+    sampling positions until one isn't from a skipped sender.
+    """
+    MAX_SAMPLES = 32
+
+    def __init__(self):
+        self._mail_ids = array.array('q')
+        self._mail_senders = array.array('i')
+        self._senders = []
+        self._sender_numbers = {}
+        self._channel_positions = {}
+        self._first_sequence = 0
+        self._expired_id = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._mail_ids)
+
+    def add(self, mail_id: int, username: str, channel: str=None):
+        self.add_many([(mail_id, username, channel)])
+
+    def add_many(self, rows):
+        """Add (mail_id, username, channel) rows."""
+        with self._lock:
+            sender_numbers = self._sender_numbers
+            senders = self._senders
+            mail_ids = self._mail_ids
+            mail_senders = self._mail_senders
+            channel_positions = self._channel_positions
+
+            for mail_id, username, channel in rows:
+                # Older than the last archived letter, such as old unread
+                # mail that was read late. It's past retention and goes in
+                # the next archive run, and at the back it would never be
+                # expired from the front.
+                if mail_id <= self._expired_id:
+                    continue
+
+                sender_number = sender_numbers.get(username)
+
+                if sender_number is None:
+                    sender_number = sender_numbers[username] = len(senders)
+                    senders.append(username)
+
+                sequence = self._first_sequence + len(mail_ids)
+                mail_ids.append(mail_id)
+                mail_senders.append(sender_number)
+
+                if channel:
+                    positions = channel_positions.get(channel)
+
+                    if positions is None:
+                        positions = channel_positions[channel] = \
+                            array.array('q')
+
+                    positions.append(sequence)
+
+    def expire_through(self, mail_id: int):
+        """Forget letters with IDs up to `mail_id`, such as archived mail."""
+        with self._lock:
+            self._expired_id = max(self._expired_id, mail_id)
+            mail_ids = self._mail_ids
+            count = 0
+
+            # Letters are mostly in ID order, so expired ones are usually at
+            # the front. Any others are skipped when sampled.
+            while count < len(mail_ids) and mail_ids[count] <= mail_id:
+                count += 1
+
+            if not count:
+                return
+
+            del mail_ids[:count]
+            del self._mail_senders[:count]
+            self._first_sequence += count
+
+            for channel, positions in list(self._channel_positions.items()):
+                del positions[:bisect.bisect_left(
+                    positions, self._first_sequence)]
+
+                if not positions:
+                    del self._channel_positions[channel]
+
+    def sample(self, skip_username: str=None, skip_user_id: str=None,
+               channel: str=None):
+        """Return a uniformly random mail ID not from a skipped sender."""
+        skip_suffix = '!{}'.format(skip_user_id).lower() \
+            if skip_user_id else None
+
+        def is_eligible(sequence):
+            position = sequence - first_sequence
+            username = self._senders[self._mail_senders[position]]
+
+            # Same as the sender_user_id and sender_platform filter in SQL
+            return self._mail_ids[position] > self._expired_id and \
+                username != skip_username and not (
+                    skip_suffix and username.lower().endswith(skip_suffix))
+
+        with self._lock:
+            first_sequence = self._first_sequence
+
+            if channel:
+                sequences = self._channel_positions.get(channel, ())
+            else:
+                sequences = range(
+                    first_sequence, first_sequence + len(self._mail_ids))
+
+            if not sequences:
+                return None
+
+            for dummy in range(self.MAX_SAMPLES):
+                sequence = sequences[_random.randrange(len(sequences))]
+
+                if is_eligible(sequence):
+                    return self._mail_ids[sequence - first_sequence]
+
+            # Most letters are from the skipped sender
+            eligible_sequences = [
+                sequence for sequence in sequences if is_eligible(sequence)
+            ]
+
+            if eligible_sequences:
+                return self._mail_ids[
+                    _random.choice(eligible_sequences) - first_sequence]
+
+
+class _MaintenanceRun(object):
+    def __init__(self, archive_before: int, expire_before: int=None):
+        self.archive_before = archive_before
+        self.expire_before = expire_before
+        self.last_id = 0
+        self.schemas = []
+        self.stats = {'archived': 0, 'expired': 0, 'vacuumed_pages': 0}
+        self.future = concurrent.futures.Future()
+
+
+class Database(object):
+    READ_MAIL_LOAD_CHUNK = 50000
+    GREETING_CACHE_SIZE = 1000
+    MAINTENANCE_BATCH = 100
+    VACUUM_PAGES = 256
+
+    def __init__(self, db_path, num_readers: int=2, archive_path: str=None):
+        """Open the database.
+
+        Archived mail goes to `archive_path`, attached to the writer
+        connection, or to a table in the main database if it's not given.
+        """
+        self._path = db_path
+        self._archive_path = archive_path
+        self._archive_table = 'archive.mail_archive' if archive_path \
+            else 'main.mail_archive'
+        self._read_mail_index = ReadMailIndex()
+        # Kept up to date by the writer so reads and limit checks don't
+        # need aggregate queries
+        self._status_counts = collections.Counter()
+        self._outbox_counts = collections.Counter()
+        self._greetings = collections.OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._commit_callbacks = []
+        self._read_mail_loaded_id = 0
+        self._read_mail_load_end_id = 0
+        self._write_queue = queue.Queue()
+        self._reader_local = threading.local()
+        self._writer_thread = threading.Thread(
+            target=self._writer_loop, daemon=True, name='database-writer')
+        self._writer_thread.start()
+
+        chatbot383.metrics.QUEUE_DEPTH.labels('database_writer') \
+            .set_function(self._write_queue.qsize)
+
+        self._submit_write(self._init_db).result()
+        self._submit_write(self._load_counts).result()
+        self._submit_write(self._load_read_mail_index).result()
+
+        # An in-memory database can't be shared with other connections
+        if db_path == ':memory:' or not num_readers:
+            self._reader_executor = None
+        else:
+            self._reader_executor = concurrent.futures.ThreadPoolExecutor(
+                num_readers, thread_name_prefix='database-reader')
+
+    @property
+    def read_mail_index_loaded(self) -> bool:
+        return self._read_mail_loaded_id >= self._read_mail_load_end_id
+
+    def close(self):
+        if self._reader_executor:
+            self._reader_executor.shutdown()
+
+        self._write_queue.put(None)
+        self._writer_thread.join()
+
+    def _writer_loop(self):
+        con = sqlite3.connect(self._path)
+
+        while True:
+            item = self._write_queue.get()
+
+            if item is None:
+                break
+
+            func, args, future = item
+
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            try:
+                result = self._run_query(func, con, args)
+
+                for callback in self._commit_callbacks:
+                    callback()
+            except Exception as error:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+            finally:
+                self._commit_callbacks.clear()
+
+        con.close()
+
+    def _get_reader_connection(self) -> sqlite3.Connection:
+        con = getattr(self._reader_local, 'con', None)
+
+        if not con:
+            uri = 'file:{}?mode=ro'.format(
+                urllib.request.pathname2url(os.path.abspath(self._path)))
+            con = self._reader_local.con = sqlite3.connect(uri, uri=True)
+
+        return con
+
+    def _read(self, func, args):
+        return self._run_query(func, self._get_reader_connection(), args)
+
+    @classmethod
+    def _run_query(cls, func, con: sqlite3.Connection, args):
+        start_time = time.perf_counter()
+
+        try:
+            with con:
+                return func(con, *args)
+        finally:
+            chatbot383.metrics.DATABASE_QUERY_LATENCY.labels(
+                func.__name__.lstrip('_')
+            ).observe(time.perf_counter() - start_time)
+
+    def _after_commit(self, callback):
+        """Call `callback` on the writer once the current write commits.
+
+        Caches are only changed this way so a failed write can't leave
+        them out of step with the database.
+        """
+        self._commit_callbacks.append(callback)
+
+    def _submit_write(self, func, *args) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+        self._write_queue.put((func, args, future))
+        return future
+
+    def _submit_read(self, func, *args) -> concurrent.futures.Future:
+        if not self._reader_executor:
+            return self._submit_write(func, *args)
+
+        return self._reader_executor.submit(self._read, func, args)
+
+    def _init_db(self, con: sqlite3.Connection):
+        # Only takes effect on a new database; older ones need a VACUUM
+        con.execute('''PRAGMA auto_vacuum=INCREMENTAL''')
+        con.execute('''PRAGMA journal_mode=WAL;''')
+        con.execute('''PRAGMA synchronous=NORMAL''')
+        con.execute('''CREATE TABLE IF NOT EXISTS mail
+        (id INTEGER PRIMARY KEY AUTOINCREMENT,
+        timestamp INTEGER NOT NULL,
+        username TEXT NOT NULL,
+        text TEXT NOT NULL,
+        status TEXT NOT NULL
+        )
+        ''')
+        con.execute('''CREATE TABLE IF NOT EXISTS greetings
+        (channel TEXT PRIMARY KEY,
+        timestamp INTEGER NOT NULL,
+        username TEXT NOT NULL,
+        text TEXT NOT NULL
+        )
+        ''')
+
+        user_version = con.execute('PRAGMA user_version').fetchone()[0]
+
+        if user_version < 1:
+            con.execute(
+                'ALTER TABLE mail ADD COLUMN channel TEXT'
+            )
+
+        if user_version < 2:
+            self._migrate_split_sender(con)
+
+        con.execute('PRAGMA user_version = 2')
+
+        if self._archive_path:
+            con.execute('ATTACH DATABASE ? AS archive', (self._archive_path,))
+            con.execute('''PRAGMA archive.auto_vacuum=INCREMENTAL''')
+            con.execute('''PRAGMA archive.journal_mode=WAL''')
+
+        con.execute('''CREATE TABLE IF NOT EXISTS {}
+        (id INTEGER PRIMARY KEY,
+        timestamp INTEGER NOT NULL,
+        username TEXT NOT NULL,
+        text TEXT NOT NULL,
+        channel TEXT,
+        sender_username TEXT,
+        sender_user_id TEXT,
+        sender_platform TEXT
+        )
+        '''.format(self._archive_table))
+
+    @classmethod
+    def _migrate_split_sender(cls, con: sqlite3.Connection):
+        # Adding nullable columns only changes the schema, so this is quick
+        # even for large tables
+        for column in ('sender_username', 'sender_user_id', 'sender_platform'):
+            con.execute('ALTER TABLE mail ADD COLUMN {} TEXT'.format(column))
+
+        # Every indexed query is on unread mail, which the mailbag limit
+        # keeps small, so partial indexes stay small and quick to build.
+        # Queries must spell out status = 'unread' for them to be used.
+        # Unread queue, in delivery order
+        con.execute('''CREATE INDEX IF NOT EXISTS mail_unread_index
+        ON mail (id) WHERE status = 'unread'
+        ''')
+        # Per-channel unread queue
+        con.execute('''CREATE INDEX IF NOT EXISTS mail_channel_unread_index
+        ON mail (channel, id) WHERE status = 'unread'
+        ''')
+        con.execute('DROP INDEX IF EXISTS mail_status_index')
+        con.execute('DROP INDEX IF EXISTS mail_channel_index')
+
+        # Only unread mail is split. Read mail keeps its packed username,
+        # which is all that reads of old mail use.
+        con.executemany(
+            '''UPDATE mail SET sender_username = ?, sender_user_id = ?,
+            sender_platform = ? WHERE id = ?
+            ''',
+            (split_sender(username) + (mail_id,)
+             for mail_id, username in con.execute(
+                 '''SELECT id, username FROM mail WHERE status = 'unread'
+                 ''').fetchall())
+        )
+        con.execute('''CREATE INDEX IF NOT EXISTS mail_unread_sender_index
+        ON mail (sender_username, sender_user_id, sender_platform)
+        WHERE status = 'unread'
+        ''')
+
+    def _load_counts(self, con: sqlite3.Connection):
+        status_counts = collections.Counter(dict(con.execute(
+            'SELECT status, count(1) FROM mail GROUP BY status')))
+        outbox_counts = collections.Counter()
+
+        for username, count in con.execute(
+                '''SELECT username, count(1) FROM mail
+                WHERE status = 'unread' GROUP BY username'''):
+            outbox_counts[split_sender(username)] += count
+
+        with self._cache_lock:
+            self._status_counts = status_counts
+            self._outbox_counts = outbox_counts
+
+    def _load_read_mail_index(self, con: sqlite3.Connection):
+        max_id = con.execute('SELECT max(id) FROM mail').fetchone()[0]
+        self._read_mail_load_end_id = max_id or 0
+        self._load_read_mail_chunk(con)
+
+    def _load_read_mail_chunk(self, con: sqlite3.Connection):
+        # Loaded in ID ranges so other writes can run in between
+        start_id = self._read_mail_loaded_id
+        end_id = min(start_id + self.READ_MAIL_LOAD_CHUNK,
+                     self._read_mail_load_end_id)
+
+        self._read_mail_index.add_many(con.execute(
+            '''SELECT id, username, channel FROM mail
+            WHERE id > ? AND id <= ? AND status = 'read'
+            ''', (start_id, end_id)))
+        self._read_mail_loaded_id = end_id
+
+        if end_id < self._read_mail_load_end_id:
+            self._submit_write(self._load_read_mail_chunk)
+        else:
+            _logger.debug('Loaded %s read mail', len(self._read_mail_index))
+
+    def run_maintenance(self, retention_days: float,
+                        archive_days: float=None) -> concurrent.futures.Future:
+        """Archive old read mail, expire old archived mail, and compact.
+
+        Read mail older than `retention_days` is moved to the archive, and
+        archived mail older than `archive_days` is deleted. The work is
+        split into short batches on the writer so mail delivery can run in
+        between. The result is a dict of counts.
+        """
+        time_now = time.time()
+        run = _MaintenanceRun(
+            int(time_now - retention_days * 86400),
+            int(time_now - archive_days * 86400)
+            if archive_days is not None else None
+        )
+
+        self._submit_maintenance(run, self._archive_mail_batch)
+
+        return run.future
+
+    def _submit_maintenance(self, run: _MaintenanceRun, func, *args):
+        def done_callback(future):
+            if future.exception():
+                _logger.error('Database maintenance failed',
+                              exc_info=future.exception())
+                run.future.set_exception(future.exception())
+
+        self._submit_write(func, run, *args).add_done_callback(done_callback)
+
+    @classmethod
+    def _take_expired(cls, rows, before: int):
+        # Mail IDs and timestamps increase together, so stop at the first
+        # row that is new enough
+        expired_rows = []
+
+        for row in rows:
+            if row[1] >= before:
+                return expired_rows, True
+
+            expired_rows.append(row)
+
+        return expired_rows, len(rows) < cls.MAINTENANCE_BATCH
+
+    def _archive_mail_batch(self, con: sqlite3.Connection,
+                            run: _MaintenanceRun):
+        rows, finished = self._take_expired(con.execute(
+            '''SELECT id, timestamp, status FROM mail
+            WHERE id > ? ORDER BY id LIMIT ?
+            ''', (run.last_id, self.MAINTENANCE_BATCH)).fetchall(),
+            run.archive_before)
+        read_count = sum(1 for row in rows if row[2] == 'read')
+
+        if read_count:
+            # Every row in the range is old enough. In WAL mode a
+            # transaction across attached databases isn't atomic, so the
+            # copy is committed before the delete starts. A crash in
+            # between leaves copies that the next run ignores.
+            id_range = (run.last_id, rows[-1][0])
+            con.execute(
+                '''INSERT OR IGNORE INTO {}
+                (id, timestamp, username, text, channel,
+                sender_username, sender_user_id, sender_platform)
+                SELECT id, timestamp, username, text, channel,
+                sender_username, sender_user_id, sender_platform
+                FROM mail WHERE id > ? AND id <= ? AND status = 'read'
+                '''.format(self._archive_table), id_range)
+            con.commit()
+            con.execute(
+                '''DELETE FROM mail
+                WHERE id > ? AND id <= ? AND status = 'read'
+                ''', id_range)
+
+            def update_caches(last_id=rows[-1][0]):
+                with self._cache_lock:
+                    self._status_counts['read'] -= read_count
+
+                self._read_mail_index.expire_through(last_id)
+
+            self._after_commit(update_caches)
+            run.stats['archived'] += read_count
+            chatbot383.metrics.DATABASE_MAINTENANCE_ROWS.labels('archived') \
+                .inc(read_count)
+
+        if rows:
+            run.last_id = rows[-1][0]
+
+        if not finished:
+            self._submit_maintenance(run, self._archive_mail_batch)
+        elif run.expire_before is not None:
+            run.last_id = 0
+            self._submit_maintenance(run, self._expire_archive_batch)
+        else:
+            self._submit_maintenance(run, self._start_vacuum)
+
+    def _expire_archive_batch(self, con: sqlite3.Connection,
+                              run: _MaintenanceRun):
+        rows, finished = self._take_expired(con.execute(
+            '''SELECT id, timestamp FROM {}
+            WHERE id > ? ORDER BY id LIMIT ?
+            '''.format(self._archive_table),
+            (run.last_id, self.MAINTENANCE_BATCH)).fetchall(),
+            run.expire_before)
+
+        if rows:
+            con.execute(
+                'DELETE FROM {} WHERE id > ? AND id <= ?'.format(
+                    self._archive_table),
+                (run.last_id, rows[-1][0]))
+            run.last_id = rows[-1][0]
+            run.stats['expired'] += len(rows)
+            chatbot383.metrics.DATABASE_MAINTENANCE_ROWS.labels('expired') \
+                .inc(len(rows))
+
+        if finished:
+            self._submit_maintenance(run, self._start_vacuum)
+        else:
+            self._submit_maintenance(run, self._expire_archive_batch)
+
+    def _start_vacuum(self, con: sqlite3.Connection, run: _MaintenanceRun):
+        for schema in ('main', 'archive') if self._archive_path else ('main',):
+            auto_vacuum = con.execute(
+                'PRAGMA {}.auto_vacuum'.format(schema)).fetchone()[0]
+
+            if auto_vacuum == 2:
+                run.schemas.append(schema)
+            else:
+                _logger.info('Incremental vacuum is off for %s; '
+                             'run VACUUM to turn it on', schema)
+
+        self._vacuum_batch(con, run)
+
+    def _vacuum_batch(self, con: sqlite3.Connection, run: _MaintenanceRun):
+        while run.schemas:
+            schema = run.schemas[0]
+            free_pages = con.execute(
+                'PRAGMA {}.freelist_count'.format(schema)).fetchone()[0]
+
+            if free_pages:
+                # execute() would only step it once, freeing a single page
+                con.executescript('PRAGMA {}.incremental_vacuum({})'.format(
+                    schema, self.VACUUM_PAGES))
+                run.stats['vacuumed_pages'] += free_pages - con.execute(
+                    'PRAGMA {}.freelist_count'.format(schema)).fetchone()[0]
+                self._submit_maintenance(run, self._vacuum_batch)
+                return
+
+            del run.schemas[0]
+
+        con.execute('PRAGMA optimize')
+        _logger.info('Database maintenance done: %s', run.stats)
+        run.future.set_result(run.stats)
+
+    def get_mail(self, skip_username=None, skip_user_id=None, channel=None):
+        return self._submit_write(
+            self._get_mail, skip_username, skip_user_id, channel)
+
+    def _get_mail(self, con: sqlite3.Connection, skip_username, skip_user_id,
+                  channel):
+        query = ['SELECT id, username, text, timestamp, channel FROM mail',
+                 "WHERE status = 'unread'"]
+        params = []
+
+        if skip_username:
+            query.append('AND username != ?')
+            params.append(skip_username)
+
+        if skip_user_id:
+            assert '!' not in skip_user_id
+            user_id, dummy, platform = skip_user_id.partition('@')
+            query.append('AND NOT (sender_user_id = ? COLLATE NOCASE '
+                         'AND sender_platform = ? COLLATE NOCASE)')
+            params.extend((user_id, platform))
+
+        if channel:
+            query.append('AND channel = ?')
+            params.append(channel)
+
+        query.append('ORDER BY id LIMIT 1')
+
+        row = con.execute(' '.join(query), params).fetchone()
+
+        if row:
+            mail_info = {
+                'username': row[1],
+                'text': row[2],
+                'timestamp': row[3],
+                'channel': row[4]
+            }
+            con.execute('''UPDATE mail SET status = ?
+            WHERE id = ?''', ('read', row[0]))
+
+            def update_caches():
+                with self._cache_lock:
+                    self._status_counts['unread'] -= 1
+                    self._status_counts['read'] += 1
+                    sender = split_sender(row[1])
+                    self._outbox_counts[sender] -= 1
+
+                    if self._outbox_counts[sender] <= 0:
+                        del self._outbox_counts[sender]
+
+                # Mail in the range still being loaded is added by the loader
+                if not self._read_mail_loaded_id < row[0] <= \
+                        self._read_mail_load_end_id:
+                    self._read_mail_index.add(row[0], row[1], row[4])
+
+            self._after_commit(update_caches)
+            return mail_info
+
+    def get_old_mail(self, skip_username=None, skip_user_id=None,
+                     channel=None):
+        return self._submit_read(
+            self._get_old_mail, skip_username, skip_user_id, channel)
+
+    def _get_old_mail(self, con: sqlite3.Connection, skip_username,
+                      skip_user_id, channel):
+        mail_id = self._read_mail_index.sample(
+            skip_username, skip_user_id, channel)
+
+        if mail_id is None:
+            return
+
+        row = con.execute(
+            '''SELECT username, text, timestamp, channel FROM mail
+            WHERE id = ?''', (mail_id,)
+        ).fetchone()
+
+        if row:
+            mail_info = {
+                'username': row[0],
+                'text': row[1],
+                'timestamp': row[2],
+                'channel': row[3]
+            }
+            return mail_info
+
+    def put_mail(self, username, text, channel):
+        return self._submit_write(self._put_mail, username, text, channel)
+
+    def _put_mail(self, con: sqlite3.Connection, username, text, channel):
+        sender = split_sender(username)
+
+        # Only the writer changes the counts, and only after a commit, so
+        # they can't go stale between the check and the insert
+        if self._outbox_counts[sender] >= 50:
+            raise SenderOutboxFullError()
+
+        if self._status_counts['unread'] >= 500:
+            raise MailbagFullError()
+
+        con.execute('''INSERT INTO mail
+        (timestamp, username, text, status, channel,
+        sender_username, sender_user_id, sender_platform)
+        VALUES (?, ?, ?, 'unread', ?, ?, ?, ?)
+        ''', (int(time.time()), username, text, channel) + sender)
+
+        def update_caches():
+            with self._cache_lock:
+                self._status_counts['unread'] += 1
+                self._outbox_counts[sender] += 1
+
+        self._after_commit(update_caches)
+
+    def get_status_count(self, status) -> concurrent.futures.Future:
+        with self._cache_lock:
+            return _completed_future(self._status_counts[status])
+
+    def set_greeting(self, channel, username, text):
+        return self._submit_write(self._set_greeting, channel, username, text)
+
+    def _set_greeting(self, con: sqlite3.Connection, channel, username, text):
+        con.execute('''INSERT OR REPLACE INTO greetings
+            (channel, timestamp, username, text) VALUES (?, ?, ?, ?)
+            ''', (channel, int(time.time()), username, text))
+
+        def update_cache():
+            with self._cache_lock:
+                self._cache_greeting(channel, text)
+
+        self._after_commit(update_cache)
+
+    def get_greeting(self, channel):
+        with self._cache_lock:
+            if channel in self._greetings:
+                self._greetings.move_to_end(channel)
+                return _completed_future(self._greetings[channel])
+
+        return self._submit_read(self._get_greeting, channel)
+
+    def _get_greeting(self, con: sqlite3.Connection, channel):
+        row = con.execute('''SELECT text FROM greetings
+        WHERE channel = ? LIMIT 1''', (channel,)).fetchone()
+        text = row[0] if row else None
+
+        with self._cache_lock:
+            # A greeting set while this was reading is newer, so keep it
+            if channel not in self._greetings:
+                self._cache_greeting(channel, text)
+
+        return text
+
+    def _cache_greeting(self, channel, text):
+        self._greetings[channel] = text
+        self._greetings.move_to_end(channel)
+
+        while len(self._greetings) > self.GREETING_CACHE_SIZE:
+            self._greetings.popitem(last=False)
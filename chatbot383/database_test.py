@@ -0,0 +1,415 @@
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+
+import chatbot383.metrics
+from chatbot383.database import Database, MailbagFullError, \
+    SenderOutboxFullError, ReadMailIndex, split_sender
+
+
+class TestSplitSender(unittest.TestCase):
+    def test_split_sender(self):
+        self.assertEqual(('user1', '1', 'twitch'),
+                         split_sender('user1!1@twitch'))
+        self.assertEqual(('user1', '', 'discord'),
+                         split_sender('user1!@discord'))
+        self.assertEqual(('user1', '', ''), split_sender('user1'))
+
+
+class TestReadMailIndex(unittest.TestCase):
+    def test_sample(self):
+        index = ReadMailIndex()
+
+        self.assertIsNone(index.sample())
+
+        index.add(1, 'alice!1@twitch', '#a')
+        index.add(2, 'bob!2@twitch', '#a')
+        index.add(3, 'bob!2@twitch', '#b')
+
+        self.assertEqual(3, len(index))
+        self.assertEqual(
+            {1, 2, 3}, set(index.sample() for dummy in range(200)))
+        self.assertEqual(
+            {1}, set(index.sample(skip_username='bob!2@twitch')
+                     for dummy in range(50)))
+        self.assertEqual(
+            {1}, set(index.sample(skip_user_id='2@TWITCH')
+                     for dummy in range(50)))
+        self.assertEqual(
+            {3}, set(index.sample(channel='#b') for dummy in range(50)))
+        self.assertIsNone(index.sample(skip_user_id='2@twitch', channel='#b'))
+        self.assertIsNone(index.sample(channel='#c'))
+
+    def test_mostly_skipped(self):
+        index = ReadMailIndex()
+
+        for mail_id in range(1000):
+            index.add(mail_id, 'alice!1@twitch')
+
+        index.add(1000, 'bob!2@twitch')
+
+        self.assertEqual(1000, index.sample(skip_user_id='1@twitch'))
+
+    def test_expire_through(self):
+        index = ReadMailIndex()
+
+        index.add(1, 'alice!1@twitch', '#a')
+        index.add(2, 'bob!2@twitch', '#b')
+        index.add(5, 'bob!2@twitch', '#a')
+        # Read late, so it isn't at the front
+        index.add(3, 'carol!3@twitch', '#b')
+
+        index.expire_through(3)
+
+        self.assertEqual(2, len(index))
+        self.assertEqual(
+            {5}, set(index.sample() for dummy in range(50)))
+        self.assertEqual(
+            {5}, set(index.sample(channel='#a') for dummy in range(50)))
+        self.assertIsNone(index.sample(channel='#b'))
+
+        index.add(6, 'alice!1@twitch', '#b')
+
+        self.assertEqual(
+            {6}, set(index.sample(channel='#b') for dummy in range(50)))
+
+    def test_add_expired(self):
+        index = ReadMailIndex()
+
+        index.add(1, 'alice!1@twitch', '#a')
+        index.add(5, 'bob!2@twitch', '#a')
+        index.expire_through(3)
+
+        # Unread mail older than the archived mail, read after archiving
+        index.add(2, 'carol!3@twitch', '#a')
+
+        self.assertEqual(1, len(index))
+        self.assertEqual(
+            {5}, set(index.sample(channel='#a') for dummy in range(50)))
+
+
+class TestDatabase(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.database = Database(os.path.join(self.temp_dir.name, 'test.db'))
+
+    def tearDown(self):
+        self.database.close()
+        self.temp_dir.cleanup()
+
+    def test_mail(self):
+        self.assertIsNone(self.database.get_mail().result())
+        self.assertIsNone(self.database.get_old_mail().result())
+
+        self.database.put_mail('user1!1@twitch', 'hello', '#a').result()
+        self.database.put_mail('user2!2@twitch', 'hi', '#b').result()
+
+        # Reads on another connection see committed writes
+        self.assertEqual(2, self.database.get_status_count('unread').result())
+
+        mail_info = self.database.get_mail(skip_username='user1!1@twitch') \
+            .result()
+
+        self.assertEqual('hi', mail_info['text'])
+        self.assertEqual('#b', mail_info['channel'])
+        self.assertEqual(1, self.database.get_status_count('read').result())
+        self.assertEqual(
+            'hi', self.database.get_old_mail().result()['text'])
+        self.assertIsNone(self.database.get_old_mail(
+            skip_user_id='2@twitch').result())
+        self.assertIsNone(self.database.get_old_mail(channel='#a').result())
+
+    def test_skip_user_id(self):
+        self.database.put_mail('user1!1@twitch', 'first', '#a').result()
+        self.database.put_mail('user1!1@discord', 'second', '#a').result()
+        self.database.put_mail('user2!2@twitch', 'third', '#a').result()
+
+        self.assertEqual('second', self.database.get_mail(
+            skip_user_id='1@TWITCH').result()['text'])
+        # Unread mail is delivered oldest first
+        self.assertEqual('first', self.database.get_mail().result()['text'])
+
+    def test_migrate_v1(self):
+        path = os.path.join(self.temp_dir.name, 'v1.db')
+        con = sqlite3.connect(path)
+
+        with con:
+            con.execute('''CREATE TABLE mail
+            (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp INTEGER NOT NULL,
+            username TEXT NOT NULL,
+            text TEXT NOT NULL,
+            status TEXT NOT NULL,
+            channel TEXT
+            )''')
+            con.execute('CREATE INDEX mail_status_index ON mail (status)')
+            con.executemany(
+                '''INSERT INTO mail (timestamp, username, text, status, channel)
+                VALUES (0, ?, ?, ?, '#a')''',
+                [('user{0}!{0}@twitch'.format(index % 3), str(index),
+                  'unread' if index >= 7 else 'read')
+                 for index in range(10)])
+            con.execute('PRAGMA user_version = 1')
+
+        con.close()
+
+        database = Database(path)
+
+        try:
+            # Unread mail is split before the database is used
+            self.assertEqual('8', database.get_mail(
+                skip_user_id='1@twitch').result()['text'])
+
+            con = sqlite3.connect(path)
+
+            self.assertEqual(
+                [('user1', '1', 'twitch')],
+                con.execute('''SELECT sender_username, sender_user_id,
+                sender_platform FROM mail WHERE status = 'unread'
+                AND username = 'user1!1@twitch' ''').fetchall())
+            self.assertEqual(7, con.execute('''SELECT count(1) FROM mail
+                WHERE sender_username IS NULL''').fetchone()[0])
+            self.assertEqual(2, con.execute('PRAGMA user_version')
+                             .fetchone()[0])
+            self.assertEqual(
+                {'mail_unread_index', 'mail_channel_unread_index',
+                 'mail_unread_sender_index'},
+                {row[0] for row in con.execute(
+                    '''SELECT name FROM sqlite_master WHERE type = 'index'
+                    AND tbl_name = 'mail' AND sql IS NOT NULL''')})
+            con.close()
+        finally:
+            database.close()
+
+    def test_read_mail_index_loaded(self):
+        self.database.put_mail('user1!1@twitch', 'hello', '#a').result()
+        self.database.get_mail().result()
+        self.database.close()
+
+        self.database = Database(
+            os.path.join(self.temp_dir.name, 'test.db'))
+
+        self.assertEqual(
+            'hello', self.database.get_old_mail(channel='#a').result()['text'])
+
+    def test_read_mail_index_chunks(self):
+        for index in range(7):
+            self.database.put_mail('user{}'.format(index), str(index), '#a')
+
+        for index in range(5):
+            self.database.get_mail()
+
+        self.database.close()
+
+        class SmallChunkDatabase(Database):
+            READ_MAIL_LOAD_CHUNK = 2
+
+        self.database = SmallChunkDatabase(
+            os.path.join(self.temp_dir.name, 'test.db'))
+        self.database.get_mail().result()
+        deadline = time.time() + 2
+
+        while not self.database.read_mail_index_loaded and \
+                time.time() < deadline:
+            time.sleep(0.01)
+
+        self.assertTrue(self.database.read_mail_index_loaded)
+        self.assertEqual(6, len(self.database._read_mail_index))
+        self.assertEqual(
+            6, len(set(self.database._read_mail_index._mail_ids)))
+
+    def test_outbox_full(self):
+        for index in range(50):
+            self.database.put_mail('user1!1@twitch', str(index), '#a')
+
+        future = self.database.put_mail('user1!1@twitch', 'more', '#a')
+
+        self.assertRaises(SenderOutboxFullError, future.result)
+
+        for index in range(450):
+            self.database.put_mail('user{}'.format(index), str(index), '#a')
+
+        future = self.database.put_mail('user2!2@twitch', 'more', '#a')
+
+        self.assertRaises(MailbagFullError, future.result)
+
+    def test_outbox_count_after_read(self):
+        for index in range(50):
+            self.database.put_mail('user1!1@twitch', str(index), '#a')
+
+        self.database.get_mail().result()
+        self.database.put_mail('user1!1@twitch', 'more', '#a').result()
+
+        self.assertEqual(50, self.database.get_status_count('unread').result())
+        self.assertEqual(1, self.database.get_status_count('read').result())
+
+    def test_counts_loaded(self):
+        for index in range(3):
+            self.database.put_mail('user1!1@twitch', str(index), '#a')
+
+        self.database.get_mail().result()
+        self.database.close()
+
+        self.database = Database(os.path.join(self.temp_dir.name, 'test.db'))
+
+        self.assertEqual(2, self.database.get_status_count('unread').result())
+        self.assertEqual(1, self.database.get_status_count('read').result())
+        self.assertEqual(
+            {('user1', '1', 'twitch'): 2}, dict(self.database._outbox_counts))
+
+    def test_counts_after_rollback(self):
+        def put_and_fail(con):
+            self.database._put_mail(con, 'user1!1@twitch', 'hello', '#a')
+            self.database._set_greeting(con, '#a', 'user1', 'hello')
+            raise ValueError()
+
+        with self.assertRaises(ValueError):
+            self.database._submit_write(put_and_fail).result()
+
+        self.assertEqual(0, self.database.get_status_count('unread').result())
+        self.assertEqual({}, dict(self.database._outbox_counts))
+        self.assertIsNone(self.database.get_greeting('#a').result())
+        self.assertIsNone(self.database.get_mail().result())
+
+    def test_greeting(self):
+        self.assertIsNone(self.database.get_greeting('#a').result())
+
+        self.database.set_greeting('#a', 'user1', 'hello').result()
+
+        self.assertEqual('hello', self.database.get_greeting('#a').result())
+
+    def test_greeting_cache(self):
+        self.database.set_greeting('#a', 'user1', 'hello').result()
+        self.database.close()
+
+        class SmallCacheDatabase(Database):
+            GREETING_CACHE_SIZE = 2
+
+        self.database = SmallCacheDatabase(
+            os.path.join(self.temp_dir.name, 'test.db'))
+
+        self.assertEqual('hello', self.database.get_greeting('#a').result())
+        self.assertIsNone(self.database.get_greeting('#b').result())
+        self.assertIn('#b', self.database._greetings)
+
+        self.database.set_greeting('#b', 'user1', 'hi').result()
+        self.assertEqual('hi', self.database.get_greeting('#b').result())
+
+        self.database.get_greeting('#c').result()
+        self.assertEqual(['#b', '#c'], list(self.database._greetings))
+        self.assertEqual('hello', self.database.get_greeting('#a').result())
+
+    def test_maintenance(self):
+        self.database.close()
+
+        class SmallBatchDatabase(Database):
+            MAINTENANCE_BATCH = 2
+
+        path = os.path.join(self.temp_dir.name, 'test.db')
+        self.database = SmallBatchDatabase(
+            path, archive_path=os.path.join(self.temp_dir.name, 'archive.db'))
+
+        for index in range(6):
+            self.database.put_mail(
+                'user{0}!{0}@twitch'.format(index), str(index), '#a')
+
+        for index in range(5):
+            self.database.get_mail().result()
+
+        # Mail 1 to 4 are old, and mail 6 is still unread
+        con = sqlite3.connect(path)
+
+        with con:
+            con.execute('''UPDATE mail SET timestamp = ? WHERE id <= 4''',
+                        (int(time.time()) - 86400 * 10,))
+
+        con.close()
+
+        stats = self.database.run_maintenance(5).result()
+
+        self.assertEqual(4, stats['archived'])
+        self.assertEqual(0, stats['expired'])
+        self.assertEqual(1, self.database.get_status_count('read').result())
+        self.assertEqual(1, self.database.get_status_count('unread').result())
+        self.assertEqual(
+            {'4'}, set(self.database.get_old_mail().result()['text']
+                       for dummy in range(20)))
+
+        stats = self.database.run_maintenance(5, archive_days=20).result()
+
+        self.assertEqual(0, stats['archived'])
+        self.assertEqual(0, stats['expired'])
+
+        stats = self.database.run_maintenance(5, archive_days=1).result()
+
+        self.assertEqual(4, stats['expired'])
+
+        self.database.close()
+        self.database = Database(path)
+
+        self.assertEqual(1, self.database.get_status_count('read').result())
+
+    def test_maintenance_interrupted(self):
+        self.database.close()
+
+        path = os.path.join(self.temp_dir.name, 'test.db')
+        archive_path = os.path.join(self.temp_dir.name, 'archive.db')
+        self.database = Database(path, archive_path=archive_path)
+        self.database.put_mail('user1!1@twitch', 'hello', '#a').result()
+        self.database.get_mail().result()
+
+        # A crash after the copy was committed leaves the mail in both
+        con = sqlite3.connect(path)
+        con.execute('ATTACH DATABASE ? AS archive', (archive_path,))
+
+        with con:
+            con.execute('''INSERT INTO archive.mail_archive
+                (id, timestamp, username, text)
+                SELECT id, timestamp, username, text FROM mail''')
+
+        con.close()
+
+        stats = self.database.run_maintenance(-1).result()
+
+        self.assertEqual(1, stats['archived'])
+        self.assertEqual(0, self.database.get_status_count('read').result())
+
+        con = sqlite3.connect(archive_path)
+        self.assertEqual(
+            1, con.execute('SELECT count(1) FROM mail_archive').fetchone()[0])
+        con.close()
+
+    def test_maintenance_archive_table(self):
+        self.database.put_mail('user1!1@twitch', 'hello', '#a').result()
+        self.database.get_mail().result()
+
+        stats = self.database.run_maintenance(-1).result()
+
+        self.assertEqual(1, stats['archived'])
+        self.assertIsNone(self.database.get_old_mail().result())
+        self.assertEqual(
+            'hello', self.database._submit_write(
+                lambda con: con.execute(
+                    'SELECT text FROM mail_archive').fetchone()[0]
+            ).result())
+
+    def test_query_metrics(self):
+        histogram = chatbot383.metrics.DATABASE_QUERY_LATENCY.labels(
+            'get_greeting')
+        old_count = sum(histogram.snapshot()[0])
+
+        self.database.get_greeting('#a').result()
+
+        self.assertEqual(old_count + 1, sum(histogram.snapshot()[0]))
+
+    def test_memory(self):
+        database = Database(':memory:')
+
+        try:
+            database.put_mail('user1', 'hello', '#a').result()
+
+            self.assertEqual(1, database.get_status_count('unread').result())
+        finally:
+            database.close()
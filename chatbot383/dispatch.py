@@ -0,0 +1,210 @@
+import collections
+import logging
+import re
+
+try:
+    import re._parser as sre_parse
+    from re._constants import (
+        LITERAL, SUBPATTERN, BRANCH, IN, MAX_REPEAT, MIN_REPEAT
+    )
+except ImportError:
+    import sre_parse
+    from sre_constants import (
+        LITERAL, SUBPATTERN, BRANCH, IN, MAX_REPEAT, MIN_REPEAT
+    )
+
+_logger = logging.getLogger(__name__)
+
+# Characters that are matched case-insensitively by `re` against ASCII
+# letters but whose str.lower() does not give that letter
+_CASE_FOLD_EXCEPTIONS = {
+    'İ': 'i',
+    'ı': 'i',
+    'ſ': 's',
+}
+
+MAX_PREFIXES = 64
+
+DispatchResult = collections.namedtuple(
+    'DispatchResult', ['value', 'match', 'num_tested']
+)
+
+
+def fold_char(char: str) -> str:
+    folded = _CASE_FOLD_EXCEPTIONS.get(char)
+
+    if folded:
+        return folded
+
+    folded = char.lower()
+
+    if len(folded) == 1:
+        return folded
+    else:
+        return char
+
+
+def literal_prefixes(pattern: str, flags: int=0, max_prefixes: int=MAX_PREFIXES):
+    """Return the set of literal strings that a match must start with.
+
+    An empty string in the result means the pattern can start with anything.
+    """
+    parsed = sre_parse.parse(pattern, flags)
+    ignore_case = bool(parsed.state.flags & re.IGNORECASE)
+
+    results = _expand_sequence(list(parsed), ignore_case, max_prefixes)
+
+    return frozenset(prefix for prefix, dummy in results)
+
+
+def _expand_sequence(items, ignore_case, max_prefixes):
+    # List of (prefix, complete) where complete means every item so far
+    # was consumed as a literal and the prefix may be extended further
+    results = [('', True)]
+
+    for op, av in items:
+        node_results = _expand_node(op, av, ignore_case, max_prefixes)
+        new_results = []
+
+        for prefix, complete in results:
+            if not complete:
+                new_results.append((prefix, False))
+                continue
+
+            for suffix, suffix_complete in node_results:
+                new_results.append((prefix + suffix, suffix_complete))
+
+        new_results = list(collections.OrderedDict.fromkeys(new_results))
+
+        if len(new_results) > max_prefixes:
+            return [(prefix, False) for prefix, dummy in results]
+
+        results = new_results
+
+        if not any(complete for dummy, complete in results):
+            break
+
+    return results
+
+
+def _expand_node(op, av, ignore_case, max_prefixes):
+    if op == LITERAL:
+        char = chr(av)
+
+        if ignore_case and ord(char) > 127:
+            return [('', False)]
+
+        return [(char, True)]
+
+    elif op == IN:
+        chars = []
+
+        for item_op, item_av in av:
+            if item_op != LITERAL:
+                return [('', False)]
+
+            char = chr(item_av)
+
+            if ignore_case and ord(char) > 127:
+                return [('', False)]
+
+            chars.append(char)
+
+        return [(char, True) for char in chars]
+
+    elif op == SUBPATTERN:
+        add_flags, del_flags, subpattern = av[1], av[2], av[3]
+
+        if add_flags or del_flags:
+            return [('', False)]
+
+        return _expand_sequence(list(subpattern), ignore_case, max_prefixes)
+
+    elif op == BRANCH:
+        results = []
+
+        for branch in av[1]:
+            results.extend(
+                _expand_sequence(list(branch), ignore_case, max_prefixes))
+
+        return results
+
+    elif op in (MAX_REPEAT, MIN_REPEAT):
+        min_count, max_count, subpattern = av
+
+        sub_results = _expand_sequence(
+            list(subpattern), ignore_case, max_prefixes)
+
+        if min_count == 0 and max_count == 1:
+            return [('', True)] + sub_results
+        elif min_count >= 1:
+            return [(prefix, False) for prefix, dummy in sub_results]
+
+        return [('', False)]
+
+    else:
+        return [('', False)]
+
+
+class CommandDispatcher(object):
+    """Finds the first registered pattern that matches a message.
+
+    Patterns are indexed in a trie by the literal text they must start
+    with, so a message is only tested against the patterns that could
+    possibly match it. Patterns without a literal prefix are always tested.
+    Registration order is kept so the first registered match wins.
+    """
+    def __init__(self):
+        self._entries = []
+        self._trie = {}
+        self._fallback_indexes = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, pattern: str, value):
+        index = len(self._entries)
+        compiled_pattern = re.compile(pattern)
+        self._entries.append((compiled_pattern, value))
+
+        prefixes = literal_prefixes(pattern)
+
+        if '' in prefixes or not prefixes:
+            _logger.debug('Command pattern %s not indexed', ascii(pattern))
+            self._fallback_indexes.append(index)
+            return
+
+        for prefix in prefixes:
+            node = self._trie
+
+            for char in prefix:
+                node = node.setdefault(fold_char(char), {})
+
+            node.setdefault(None, []).append(index)
+
+    def _find_candidates(self, text: str):
+        candidates = set(self._fallback_indexes)
+        node = self._trie
+
+        for char in text:
+            node = node.get(fold_char(char))
+
+            if node is None:
+                break
+
+            candidates.update(node.get(None, ()))
+
+        return sorted(candidates)
+
+    def match(self, text: str) -> DispatchResult:
+        num_tested = 0
+
+        for index in self._find_candidates(text):
+            pattern, value = self._entries[index]
+            num_tested += 1
+            match = pattern.match(text)
+
+            if match:
+                return DispatchResult(value, match, num_tested)
+
+        return DispatchResult(None, None, num_tested)
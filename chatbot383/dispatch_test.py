@@ -0,0 +1,80 @@
+import re
+import unittest
+
+from chatbot383.dispatch import CommandDispatcher, literal_prefixes
+
+PATTERNS = (
+    r'!?s/(.+/.*)',
+    r'(?i)!caw($|\s.*)',
+    r'(?i)!debugecho\s+(.*)',
+    r'(?i)!double(team)?($|\s.*)',
+    r'(?i)!(set)?greet(ing)?($|\s.*)$',
+    r'(?i)!(groudonger)?(help|commands)($|\s.*)',
+    r'(?i)!groudon(ger)?($|\s.*)',
+    r'(?i)!(mail|post)($|\s.*)$',
+    r'(?i)!(mail|post)status($|\s.*)',
+    r'(?i)!password\s+(.*)',
+    r'(?i)!(word)?(?:shuffle|scramble)($|\s.*)',
+    r'(?i)!racc(?:attack)?($|\s\S*)',
+    r'(?i)!roomsize?($|\s.*)',
+    r'(?i)!gen(?:erate)?match($|\s.*)$',
+    r'.*\b[xX][dD] +MingLee\b.*',
+    r'(?i)(?:has )?(?:just )?donate(?:d|s)? [^0-9]{0,5}([0-9][0-9,.]*)',
+)
+
+TEXTS = (
+    '', 'hello', '!caw', '!CAW hi', '!cawcaw', 's/a/b/', '!s/a/b/g', 'S/a/b',
+    '!double', '!doubleteam x', '!greet', '!SetGreeting hi', '!help',
+    '!groudongerhelp', '!groudonger', '!mail', '!mail hello', '!mailstatus',
+    '!POSTSTATUS', '!password hunter2', '!wordscramble a b', '!shuffle',
+    '!raccattack bob', '!roomsiz', '!roomsize', '!generatematch',
+    'xD MingLee', 'lol xd  MingLee', 'Has just donated $5', 'donates 100',
+    '!ſhuffle', '!paſſword x', '!debugecho', '!debugecho hi', '!nope',
+)
+
+
+def linear_match(text):
+    for index, pattern in enumerate(PATTERNS):
+        match = re.match(pattern, text)
+
+        if match:
+            return index, match.groups()
+
+
+class TestCommandDispatcher(unittest.TestCase):
+    def test_literal_prefixes(self):
+        self.assertEqual({'!s/', 's/'}, literal_prefixes(r'!?s/(.+/.*)'))
+        self.assertEqual({'!caw'}, literal_prefixes(r'(?i)!caw($|\s.*)'))
+        self.assertEqual(
+            {'!mail', '!post'}, literal_prefixes(r'(?i)!(mail|post)($|\s.*)$'))
+        self.assertIn('', literal_prefixes(r'.*\b[xX][dD] +MingLee\b.*'))
+
+    def test_same_as_linear_scan(self):
+        dispatcher = CommandDispatcher()
+
+        for index, pattern in enumerate(PATTERNS):
+            dispatcher.add(pattern, index)
+
+        for text in TEXTS:
+            result = dispatcher.match(text)
+            expected = linear_match(text)
+
+            if expected:
+                self.assertEqual(expected[0], result.value, text)
+                self.assertEqual(expected[1], result.match.groups(), text)
+            else:
+                self.assertIsNone(result.match, text)
+
+    def test_num_tested_does_not_grow(self):
+        dispatcher = CommandDispatcher()
+
+        for index in range(500):
+            dispatcher.add(r'(?i)!command{}($|\s.*)'.format(index), index)
+
+        result = dispatcher.match('just some ordinary chat')
+        self.assertEqual(0, result.num_tested)
+
+        result = dispatcher.match('!command123 hello')
+        self.assertEqual(123, result.value)
+        # Only !command1, !command12 and !command123 share the prefix
+        self.assertEqual(3, result.num_tested)
@@ -0,0 +1,164 @@
+"""Inbound events passed from the clients to the bot.
+
+Events support read access like the dicts they replace, ie,
+``event['channel']`` or ``event.get('stacked')``, so handlers can use
+either form.
+"""
+import functools
+
+import irc.strings
+
+
+@functools.lru_cache(maxsize=8192)
+def lower_identity(name: str) -> str:
+    return irc.strings.lower(name)
+
+
+class InboundEvent(object):
+    __slots__ = ('client', 'event_type')
+    _keys = ('client', 'event_type')
+
+    def __init__(self, client, event_type: str):
+        self.client = client
+        self.event_type = event_type
+
+    def __getitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        if key not in self._keys:
+            raise KeyError(key)
+
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self._keys and hasattr(self, key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [key for key in self._keys if hasattr(self, key)]
+
+    def __repr__(self):
+        return '<{} {}>'.format(
+            self.__class__.__name__,
+            dict((key, self[key]) for key in self.keys() if key != 'client')
+        )
+
+
+class WelcomeEvent(InboundEvent):
+    __slots__ = ()
+
+    def __init__(self, client):
+        super().__init__(client, 'welcome')
+
+
+class DisconnectEvent(InboundEvent):
+    __slots__ = ()
+
+    def __init__(self, client):
+        super().__init__(client, 'disconnect')
+
+
+class ChatMessageEvent(InboundEvent):
+    """A pubmsg, action, or whisper.
+
+    Tags are converted to a dict only when ``nick``, ``user_id``, or
+    ``tags`` is used.
+    """
+    __slots__ = ('channel', 'username', 'text', 'stacked',
+                 '_source_nick', '_raw_tags', '_tags')
+    _keys = ('client', 'event_type', 'channel', 'nick', 'username', 'text',
+             'user_id', 'stacked')
+
+    def __init__(self, client, event_type: str, username: str, text: str,
+                 source_nick: str, raw_tags=None, channel: str=None):
+        super().__init__(client, event_type)
+
+        if channel is not None:
+            self.channel = channel
+
+        self.username = username
+        self.text = text
+        self._source_nick = source_nick
+        self._raw_tags = raw_tags
+        self._tags = None
+
+    @classmethod
+    def tags_to_dict(cls, tags) -> dict:
+        return dict(
+            (item.get('key'), item.get('value'))
+            for item in tags or ()
+        )
+
+    @property
+    def tags(self) -> dict:
+        if self._tags is None:
+            self._tags = self.tags_to_dict(self._raw_tags)
+
+        return self._tags
+
+    @property
+    def nick(self) -> str:
+        if self.event_type == 'whisper':
+            return self._source_nick
+
+        return self.tags.get('display-name') or self._source_nick
+
+    @property
+    def user_id(self):
+        return self.tags.get('user-id')
+
+
+class ChannelNoticeEvent(InboundEvent):
+    __slots__ = ('channel', 'text')
+    _keys = ('client', 'event_type', 'channel', 'text')
+
+    def __init__(self, client, event_type: str, channel: str, text: str):
+        super().__init__(client, event_type)
+        self.channel = channel
+        self.text = text
+
+
+class MembershipEvent(InboundEvent):
+    """A join, part, or clearchat."""
+    __slots__ = ('channel', 'nick', 'username')
+    _keys = ('client', 'event_type', 'channel', 'nick', 'username')
+
+    def __init__(self, client, event_type: str, channel: str, nick: str,
+                 username: str):
+        super().__init__(client, event_type)
+        self.channel = channel
+        self.nick = nick
+        self.username = username
+
+
+class NamesEvent(InboundEvent):
+    """Part of a NAMES reply ('names') or its end ('names_end')."""
+    __slots__ = ('channel', 'usernames')
+    _keys = ('client', 'event_type', 'channel', 'usernames')
+
+    def __init__(self, client, event_type: str, channel: str, usernames=()):
+        super().__init__(client, event_type)
+        self.channel = channel
+        self.usernames = usernames
+
+
+class CallbackEvent(InboundEvent):
+    """Runs a function on the bot thread."""
+    __slots__ = ('callback',)
+    _keys = ('client', 'event_type', 'callback')
+
+    def __init__(self, callback):
+        super().__init__(None, 'callback')
+        self.callback = callback
@@ -0,0 +1,50 @@
+import copy
+import unittest
+
+from chatbot383.events import ChatMessageEvent, MembershipEvent
+
+
+class TestEvents(unittest.TestCase):
+    def test_dict_access(self):
+        event = ChatMessageEvent(
+            None, 'pubmsg', channel='#test', username='someone',
+            text='hello', source_nick='SomeOne',
+            raw_tags=[{'key': 'display-name', 'value': 'SomeOne_'},
+                      {'key': 'user-id', 'value': '123'}]
+        )
+
+        self.assertEqual('#test', event['channel'])
+        self.assertEqual('SomeOne_', event['nick'])
+        self.assertEqual('123', event['user_id'])
+        self.assertIsNone(event.get('stacked'))
+        self.assertNotIn('stacked', event)
+
+        with self.assertRaises(KeyError):
+            event['nonexistent']
+
+        stacked_event = copy.copy(event)
+        stacked_event['text'] = 'goodbye'
+        stacked_event['stacked'] = True
+
+        self.assertEqual('hello', event['text'])
+        self.assertEqual('goodbye', stacked_event['text'])
+        self.assertTrue(stacked_event.get('stacked'))
+
+    def test_whisper(self):
+        event = ChatMessageEvent(
+            None, 'whisper', username='someone', text='hello',
+            source_nick='SomeOne', raw_tags=[]
+        )
+
+        self.assertEqual('SomeOne', event['nick'])
+        self.assertIsNone(event['user_id'])
+
+        with self.assertRaises(KeyError):
+            event['channel']
+
+    def test_membership(self):
+        event = MembershipEvent(None, 'join', '#test', 'SomeOne', 'someone')
+        self.assertEqual(
+            ['client', 'event_type', 'channel', 'nick', 'username'],
+            event.keys()
+        )
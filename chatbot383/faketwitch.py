@@ -0,0 +1,576 @@
+"""Local IRC server that behaves like Twitch chat, for offline testing.
+
+Run the bot against it with ``"main_server": "127.0.0.1:6667"``::
+
+    python -m chatbot383.faketwitch --port 6667 --channel '#test' \\
+        --command '!caw' --interval 2 --count 50
+
+Chat injected with `TwitchServer.send_chat` and every PRIVMSG sent back
+by the bot are timestamped so the end to end latency through the
+client, bot and outbound throttling can be measured.
+"""
+import argparse
+import asyncio
+import collections
+import itertools
+import logging
+import re
+import time
+
+from chatbot383.outbound import TWITCH_CHANNEL_LIMIT
+from chatbot383.ratelimit import TokenBucket
+from chatbot383.util import percentile
+
+_logger = logging.getLogger(__name__)
+
+HOSTNAME = 'tmi.twitch.tv'
+SUPPORTED_CAPABILITIES = frozenset([
+    'twitch.tv/membership', 'twitch.tv/tags', 'twitch.tv/commands'
+])
+
+# The documented server side limits. The client side buckets in
+# chatbot383.outbound are deliberately stricter than these.
+MESSAGE_LIMIT = (20, 30)
+MODERATOR_MESSAGE_LIMIT = (100, 30)
+JOIN_LIMIT = (20, 10)
+WHISPER_LIMITS = ((3, 1), (100, 60))
+# Injected messages not answered within this many seconds are counted as
+# unanswered, so a later reply isn't credited to them
+REPLY_TIMEOUT = 30.0
+
+InjectedMessage = collections.namedtuple(
+    'InjectedMessage', ['message_id', 'channel', 'nick', 'text', 'time'])
+ReceivedMessage = collections.namedtuple(
+    'ReceivedMessage', ['nick', 'target', 'text', 'time', 'reply_to'])
+
+
+class WindowLimit:
+    """Allows `count` events in any `period` seconds."""
+    def __init__(self, count: int, period: float, clock=time.monotonic):
+        self._count = count
+        self._period = period
+        self._clock = clock
+        self._timestamps = collections.deque()
+
+    def can_acquire(self, amount: int=1) -> bool:
+        time_now = self._clock()
+
+        while self._timestamps and \
+                time_now - self._timestamps[0] >= self._period:
+            self._timestamps.popleft()
+
+        return len(self._timestamps) + amount <= self._count
+
+    def try_acquire(self, amount: int=1) -> bool:
+        if not self.can_acquire(amount):
+            return False
+
+        self._timestamps.extend([self._clock()] * amount)
+        return True
+
+
+class TwitchServer:
+    def __init__(self, host: str='127.0.0.1', port: int=0,
+                 enforce_rate_limits: bool=True,
+                 reply_timeout: float=REPLY_TIMEOUT):
+        self._host = host
+        self._port = port
+        self._enforce_rate_limits = enforce_rate_limits
+        self._reply_timeout = reply_timeout
+        self._server = None
+        self._sessions = set()
+        self._moderators = collections.defaultdict(set)
+        self._message_counter = itertools.count(1)
+        self._account_limits = {}
+        self._received_condition = None
+        # Injected messages not replied to yet, oldest first per channel
+        self._unanswered = collections.defaultdict(collections.deque)
+        self.injected = []
+        self.received = []
+        self.dropped = collections.Counter()
+
+    @property
+    def port(self) -> int:
+        return self._server.sockets[0].getsockname()[1]
+
+    @property
+    def enforce_rate_limits(self) -> bool:
+        return self._enforce_rate_limits
+
+    async def start(self) -> int:
+        self._received_condition = asyncio.Condition()
+        self._server = await asyncio.start_server(
+            self._handler, self._host, self._port)
+
+        _logger.info('Fake Twitch server on %s:%s', self._host, self.port)
+
+        return self.port
+
+    async def stop(self):
+        for session in list(self._sessions):
+            session.close()
+
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handler(self, reader: asyncio.StreamReader,
+                       writer: asyncio.StreamWriter):
+        session = TwitchSession(self, reader, writer)
+        self._sessions.add(session)
+
+        try:
+            await session.handle()
+        except ConnectionError:
+            _logger.info('Connection closed.')
+        except Exception:
+            _logger.exception('Session error. Closing.')
+        finally:
+            self._sessions.discard(session)
+            writer.close()
+
+    def get_account_limits(self, nick: str) -> dict:
+        limits = self._account_limits.get(nick)
+
+        if not limits:
+            limits = self._account_limits[nick] = {
+                'privmsg': WindowLimit(*MESSAGE_LIMIT),
+                'moderator_privmsg': WindowLimit(*MODERATOR_MESSAGE_LIMIT),
+                'join': WindowLimit(*JOIN_LIMIT),
+                'whisper': [WindowLimit(*limit) for limit in WHISPER_LIMITS],
+                'channel': collections.defaultdict(
+                    lambda: TokenBucket.from_spec(TWITCH_CHANNEL_LIMIT)),
+            }
+
+        return limits
+
+    def is_moderator(self, channel: str, nick: str) -> bool:
+        return nick in self._moderators[channel]
+
+    def set_moderator(self, channel: str, nick: str, moderator: bool=True):
+        if moderator:
+            self._moderators[channel].add(nick)
+        else:
+            self._moderators[channel].discard(nick)
+
+        for session in self._sessions:
+            if session.nick == nick and channel in session.channels:
+                session.send_userstate(channel)
+
+    def _sessions_in(self, channel: str):
+        return [session for session in self._sessions
+                if channel in session.channels]
+
+    def send_chat(self, channel: str, nick: str, text: str,
+                  tags: dict=None) -> int:
+        """Deliver a chat message from a viewer to sessions in the channel.
+
+        Returns the message ID used to match replies.
+        """
+        message_id = next(self._message_counter)
+        all_tags = {
+            'display-name': nick,
+            'user-id': str(100000 + abs(hash(nick)) % 100000),
+            'id': str(message_id),
+        }
+        all_tags.update(tags or {})
+
+        injected = InjectedMessage(
+            message_id, channel, nick, text, time.monotonic())
+        self.injected.append(injected)
+        self._unanswered[channel].append(injected)
+
+        for session in self._sessions_in(channel):
+            session.send_line(
+                'PRIVMSG', channel, ':' + text, tags=all_tags, source=nick)
+
+        return message_id
+
+    def send_whisper(self, to_nick: str, from_nick: str, text: str):
+        for session in self._sessions:
+            if session.nick == to_nick:
+                session.send_line(
+                    'WHISPER', to_nick, ':' + text,
+                    tags={'display-name': from_nick}, source=from_nick,
+                    capability='twitch.tv/commands')
+
+    def clear_chat(self, channel: str, nick: str=None):
+        for session in self._sessions_in(channel):
+            if nick:
+                session.send_line('CLEARCHAT', channel, ':' + nick,
+                                  capability='twitch.tv/commands')
+            else:
+                session.send_line('CLEARCHAT', channel,
+                                  capability='twitch.tv/commands')
+
+    def send_membership(self, channel: str, nick: str, joined: bool=True):
+        for session in self._sessions_in(channel):
+            session.send_line('JOIN' if joined else 'PART', channel,
+                              source=nick, capability='twitch.tv/membership')
+
+    def _match_reply(self, target: str, text: str, time_now: float):
+        unanswered = self._unanswered[target]
+
+        while unanswered and \
+                time_now - unanswered[0].time > self._reply_timeout:
+            unanswered.popleft()
+
+        if not unanswered:
+            return None
+
+        # Replies mention the sender. Anything else, like a plain "say",
+        # answers the oldest message still waiting.
+        match = re.match(r'@([^,\s]+),', text)
+
+        if not match:
+            return unanswered.popleft()
+
+        mentioned_nick = match.group(1).lower()
+
+        for index, injected in enumerate(unanswered):
+            if injected.nick.lower() == mentioned_nick:
+                del unanswered[index]
+                return injected
+
+        return None
+
+    async def record_privmsg(self, nick: str, target: str, text: str):
+        time_now = time.monotonic()
+        reply_to = self._match_reply(target, text, time_now)
+
+        self.received.append(ReceivedMessage(
+            nick, target, text, time_now, reply_to))
+
+        async with self._received_condition:
+            self._received_condition.notify_all()
+
+        for session in self._sessions_in(target):
+            if session.nick != nick:
+                session.send_line('PRIVMSG', target, ':' + text, source=nick)
+
+    async def wait_for_privmsg(self, target: str=None, timeout: float=10.0,
+                               start_index: int=0) -> ReceivedMessage:
+        """Wait until a PRIVMSG to `target` arrives at or after
+        `start_index` in `received`."""
+        def find():
+            for message in self.received[start_index:]:
+                if target is None or message.target == target:
+                    return message
+
+        async def wait():
+            async with self._received_condition:
+                await self._received_condition.wait_for(find)
+
+        await asyncio.wait_for(wait(), timeout)
+
+        return find()
+
+    def latencies(self) -> list:
+        """Time from each injected message to its reply.
+
+        Each injected message is answered by at most one reply, so
+        messages without one are left out; see `unanswered_count`.
+        """
+        return [
+            message.time - message.reply_to.time
+            for message in self.received if message.reply_to
+        ]
+
+    def unanswered_count(self) -> int:
+        """Number of injected messages that got no reply."""
+        return len(self.injected) - sum(
+            1 for message in self.received if message.reply_to)
+
+
+class TwitchSession:
+    class ClientCommand:
+        def __init__(self, line: str):
+            if line.startswith('@'):
+                dummy, line = line.split(' ', 1)
+
+            self.line = line
+            self.args = line.split(' :', 1)[0].split(' ')
+            self.command = self.args[0].lower()
+            self.text = line.split(' :', 1)[-1] if ' :' in line else ''
+
+    def __init__(self, server: TwitchServer, reader: asyncio.StreamReader,
+                 writer: asyncio.StreamWriter):
+        self._server = server
+        self._reader = reader
+        self._writer = writer
+        self.nick = None
+        self.capabilities = set()
+        self.channels = set()
+        self._logged_in = False
+
+    def close(self):
+        self._writer.close()
+
+    @classmethod
+    def escape_tag_value(cls, text: str) -> str:
+        return text.replace('\\', '\\\\').replace('\r', '\\r')\
+            .replace('\n', '\\n').replace(' ', '\\s').replace(';', '\\:')
+
+    def send_line(self, *args, tags=None, source=None, capability=None):
+        if capability and capability not in self.capabilities:
+            return
+
+        if tags and 'twitch.tv/tags' in self.capabilities:
+            self._writer.write(b'@')
+            self._writer.write(';'.join(
+                '{}={}'.format(key, self.escape_tag_value(value))
+                for key, value in tags.items()
+            ).encode('utf8', 'replace'))
+            self._writer.write(b' ')
+
+        if source:
+            source = '{0}!{0}@{0}.{1}'.format(source, HOSTNAME)
+        else:
+            source = HOSTNAME
+
+        text = ':{} {}'.format(source, ' '.join(str(arg) for arg in args))
+
+        if '\n' in text or '\r' in text:
+            raise ValueError('Naughty newlines found')
+
+        self._writer.write(text.encode('utf8', 'replace'))
+        self._writer.write(b'\r\n')
+
+    def send_userstate(self, channel: str):
+        moderator = self._server.is_moderator(channel, self.nick)
+
+        self.send_line(
+            'USERSTATE', channel,
+            tags={
+                'badges': 'moderator/1' if moderator else '',
+                'display-name': self.nick,
+                'mod': '1' if moderator else '0',
+            },
+            capability='twitch.tv/commands'
+        )
+
+    async def handle(self):
+        while True:
+            line = await self._reader.readline()
+
+            if not line:
+                _logger.info('Disconnected from client.')
+                return
+
+            line = line.decode('utf8', 'replace').strip('\r\n')
+
+            if not line:
+                continue
+
+            command = self.ClientCommand(line)
+
+            if self._logged_in:
+                await self._handle_message_command(command)
+            else:
+                self._handle_login(command)
+
+            await self._writer.drain()
+
+    def _handle_login(self, command: ClientCommand):
+        if command.command == 'cap':
+            self._cap_command(command)
+        elif command.command == 'nick':
+            self.nick = command.args[1].lower()
+        elif command.command in ('pass', 'user'):
+            pass
+        else:
+            self.send_line('421', '*', command.command, ':Unknown command')
+
+        if self.nick and not self._logged_in:
+            self._logged_in = True
+
+            for number, text in (('001', 'Welcome, GLHF!'),
+                                 ('002', 'Your host is ' + HOSTNAME),
+                                 ('003', 'This server is rather new'),
+                                 ('004', '-'), ('375', '-'),
+                                 ('372', 'You are in a maze of twisty passages.'),
+                                 ('376', '>')):
+                self.send_line(number, self.nick, ':' + text)
+
+    async def _handle_message_command(self, command: ClientCommand):
+        command_table = {
+            'cap': self._cap_command,
+            'ping': self._ping_command,
+            'join': self._join_command,
+            'part': self._part_command,
+            'privmsg': self._privmsg_command,
+        }
+
+        func = command_table.get(command.command)
+
+        if not func:
+            self.send_line('421', self.nick, command.command,
+                           ':Unknown command')
+        elif asyncio.iscoroutinefunction(func):
+            await func(command)
+        else:
+            func(command)
+
+    def _cap_command(self, command: ClientCommand):
+        if len(command.args) < 2 or command.args[1].upper() != 'REQ':
+            return
+
+        requested = command.text.split()
+
+        if all(name in SUPPORTED_CAPABILITIES for name in requested):
+            self.capabilities.update(requested)
+            self.send_line('CAP', '*', 'ACK', ':' + ' '.join(requested))
+        else:
+            self.send_line('CAP', '*', 'NAK', ':' + ' '.join(requested))
+
+    def _ping_command(self, command: ClientCommand):
+        self.send_line('PONG', HOSTNAME, ':' + (command.text or HOSTNAME))
+
+    def _check_limit(self, name: str, *limits, amount: int=1) -> bool:
+        if not self._server.enforce_rate_limits:
+            return True
+
+        # Check all first so a rejected message doesn't use up a limit
+        if all(limit.can_acquire(amount) for limit in limits):
+            for limit in limits:
+                limit.try_acquire(amount)
+
+            return True
+
+        _logger.warning('Rate limit exceeded by %s: %s', self.nick, name)
+        self._server.dropped[name] += amount
+        return False
+
+    def _join_command(self, command: ClientCommand):
+        channels = [channel for channel in command.args[1].split(',')
+                    if channel]
+        limits = self._server.get_account_limits(self.nick)
+
+        for channel in channels:
+            # Twitch drops excess JOINs without telling the client
+            if not self._check_limit('join', limits['join']):
+                continue
+
+            self.channels.add(channel)
+            self.send_line('JOIN', channel, source=self.nick)
+            self.send_userstate(channel)
+            self.send_line('ROOMSTATE', channel, tags={'room-id': '1'},
+                           capability='twitch.tv/commands')
+
+            if 'twitch.tv/membership' in self.capabilities:
+                self.send_line('353', self.nick, '=', channel,
+                               ':' + self.nick)
+                self.send_line('366', self.nick, channel,
+                               ':End of /NAMES list')
+
+    def _part_command(self, command: ClientCommand):
+        for channel in command.args[1].split(','):
+            if channel in self.channels:
+                self.channels.discard(channel)
+                self.send_line('PART', channel, source=self.nick)
+
+    async def _privmsg_command(self, command: ClientCommand):
+        target = command.args[1]
+        text = command.text
+        limits = self._server.get_account_limits(self.nick)
+
+        if text.startswith('/w ') or text.startswith('.w '):
+            dummy, to_nick, whisper_text = (text.split(' ', 2) + [''])[:3]
+
+            if self._check_limit('whisper', *limits['whisper']):
+                self._server.send_whisper(to_nick.lower(), self.nick,
+                                          whisper_text)
+            return
+
+        if target not in self.channels:
+            self.send_line('NOTICE', target, ':You are not in that channel',
+                           tags={'msg-id': 'msg_channel_suspended'})
+            return
+
+        if self._server.is_moderator(target, self.nick):
+            ok = self._check_limit('privmsg', limits['moderator_privmsg'])
+        else:
+            ok = self._check_limit(
+                'privmsg', limits['privmsg'], limits['moderator_privmsg'])
+
+            if ok and self._server.enforce_rate_limits and \
+                    not limits['channel'][target].try_consume():
+                ok = False
+                self._server.dropped['channel'] += 1
+
+        if not ok:
+            self.send_line(
+                'NOTICE', target,
+                ':Your message was not sent because you are sending '
+                'messages too quickly.',
+                tags={'msg-id': 'msg_ratelimit'})
+            return
+
+        await self._server.record_privmsg(self.nick, target, text)
+
+
+async def _run_traffic(server: TwitchServer, channels, commands,
+                       interval: float, count: int):
+    # Wait for the bot to join
+    while not all(server._sessions_in(channel) for channel in channels):
+        await asyncio.sleep(0.1)
+
+    _logger.info('Bot joined. Sending traffic.')
+
+    for index in range(count):
+        for channel in channels:
+            server.send_chat(channel, 'viewer{}'.format(index % 10),
+                             commands[index % len(commands)])
+
+        await asyncio.sleep(interval)
+
+    # Give the last replies time to arrive
+    await asyncio.sleep(max(interval, 2))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    arg_parser.add_argument('--host', default='127.0.0.1')
+    arg_parser.add_argument('--port', type=int, default=6667)
+    arg_parser.add_argument('--channel', action='append',
+                            help='Channel to send traffic to')
+    arg_parser.add_argument('--command', action='append',
+                            help='Chat text to send')
+    arg_parser.add_argument('--interval', type=float, default=2.0)
+    arg_parser.add_argument('--count', type=int, default=0,
+                            help='Number of messages per channel. Without '
+                                 'this the server runs until interrupted.')
+    arg_parser.add_argument('--no-rate-limits', action='store_true')
+    args = arg_parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    server = TwitchServer(args.host, args.port,
+                          enforce_rate_limits=not args.no_rate_limits)
+    event_loop = asyncio.get_event_loop()
+    event_loop.run_until_complete(server.start())
+
+    try:
+        if args.count:
+            event_loop.run_until_complete(_run_traffic(
+                server, args.channel or ['#test'], args.command or ['!caw'],
+                args.interval, args.count))
+        else:
+            event_loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        event_loop.run_until_complete(server.stop())
+
+    latencies = sorted(server.latencies())
+
+    print('Injected: {}, received: {}, replied to: {}, unanswered: {}'.format(
+        len(server.injected), len(server.received), len(latencies),
+        server.unanswered_count()))
+    print('Latency: p50 {:.3f} ms, p99 {:.3f} ms'.format(
+        percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000))
+    print('Dropped by rate limits: {}'.format(dict(server.dropped)))
+
+
+if __name__ == '__main__':
+    main()
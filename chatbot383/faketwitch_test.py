@@ -0,0 +1,131 @@
+import asyncio
+import unittest
+
+from chatbot383.faketwitch import TwitchServer, TwitchSession, \
+    WindowLimit
+from chatbot383.testing import FakeClock
+
+
+class TestWindowLimit(unittest.TestCase):
+    def test_window(self):
+        clock = FakeClock()
+        limit = WindowLimit(2, 10, clock=clock)
+
+        self.assertTrue(limit.try_acquire())
+        self.assertTrue(limit.try_acquire())
+        self.assertFalse(limit.try_acquire())
+
+        clock.time = 10
+        self.assertTrue(limit.try_acquire(2))
+        self.assertFalse(limit.try_acquire())
+
+    def test_check_limit(self):
+        clock = FakeClock()
+        short_limit = WindowLimit(3, 1, clock=clock)
+        long_limit = WindowLimit(1, 60, clock=clock)
+        session = TwitchSession.__new__(TwitchSession)
+        session._server = TwitchServer()
+        session.nick = 'user'
+
+        self.assertTrue(session._check_limit(
+            'whisper', short_limit, long_limit))
+        self.assertFalse(session._check_limit(
+            'whisper', short_limit, long_limit))
+
+        # The rejected message didn't use up the short limit
+        self.assertTrue(short_limit.can_acquire(2))
+        self.assertFalse(short_limit.can_acquire(3))
+        self.assertEqual(1, session._server.dropped['whisper'])
+
+
+class TestTwitchServer(unittest.TestCase):
+    def test_session(self):
+        asyncio.run(self._test_session())
+
+    async def _read_until(self, reader, text):
+        while True:
+            line = await asyncio.wait_for(reader.readline(), 5)
+            line = line.decode('utf8').rstrip('\r\n')
+
+            if text in line:
+                return line
+
+    async def _test_session(self):
+        server = TwitchServer()
+        port = await server.start()
+
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b'CAP REQ :twitch.tv/tags twitch.tv/commands\r\n'
+                         b'PASS oauth:x\r\nNICK TestBot\r\nUSER x 0 * :x\r\n')
+
+            await self._read_until(reader, 'CAP * ACK')
+            await self._read_until(reader, ' 376 ')
+
+            writer.write(b'JOIN #a,#b\r\n')
+            await self._read_until(reader, 'JOIN #b')
+
+            self.assertTrue(server._sessions_in('#a'))
+
+            server.send_chat('#a', 'viewer', '!caw')
+            line = await self._read_until(reader, 'PRIVMSG #a')
+
+            self.assertTrue(line.startswith('@display-name=viewer;'))
+            self.assertTrue(line.endswith(':!caw'))
+
+            writer.write(b'PRIVMSG #a :CAW\r\n')
+            received = await server.wait_for_privmsg('#a')
+
+            self.assertEqual('CAW', received.text)
+            self.assertEqual('testbot', received.nick)
+            self.assertEqual(1, len(server.latencies()))
+
+            # The per channel limit only allows one message a second
+            writer.write(b'PRIVMSG #a :CAW again\r\n')
+            line = await self._read_until(reader, 'NOTICE #a')
+
+            self.assertIn('msg-id=msg_ratelimit', line)
+            self.assertEqual(1, server.dropped['channel'])
+
+            server.set_moderator('#a', 'testbot')
+            line = await self._read_until(reader, 'USERSTATE #a')
+            self.assertIn('mod=1', line)
+
+            writer.write(b'PRIVMSG #a :CAW as mod\r\n')
+            received = await server.wait_for_privmsg('#a', start_index=1)
+            self.assertEqual('CAW as mod', received.text)
+
+            writer.close()
+        finally:
+            await server.stop()
+
+    def test_replies_in_flight(self):
+        asyncio.run(self._test_replies_in_flight())
+
+    async def _test_replies_in_flight(self):
+        server = TwitchServer()
+        await server.start()
+
+        try:
+            await server.record_privmsg('testbot', '#a', 'Unsolicited')
+            first = server.send_chat('#a', 'Alice', '!mail')
+            second = server.send_chat('#a', 'Bob', '!mail')
+            third = server.send_chat('#a', 'Carol', '!caw')
+
+            # Answered out of order, and one by a plain message
+            await server.record_privmsg('testbot', '#a', '@bob, no mail')
+            await server.record_privmsg('testbot', '#a', '@alice, no mail')
+            await server.record_privmsg('testbot', '#a', 'CAW')
+            await server.record_privmsg('testbot', '#a', 'CAW')
+
+            self.assertEqual(
+                [None, second, first, third, None],
+                [message.reply_to and message.reply_to.message_id
+                 for message in server.received])
+            self.assertEqual(3, len(server.latencies()))
+            self.assertEqual(0, server.unanswered_count())
+
+            server.send_chat('#a', 'Dave', '!mail')
+            self.assertEqual(1, server.unanswered_count())
+        finally:
+            await server.stop()
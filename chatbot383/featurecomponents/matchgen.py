@@ -3,6 +3,7 @@ import sqlite3
 import collections
 
 import sys
+import threading
 
 COLORS = (
     'black',
@@ -63,7 +64,17 @@ class MatchError(ValueError):
 class MatchGenerator(object):
     def __init__(self, db_path):
         self._path = db_path
-        self._con = sqlite3.connect(db_path)
+        # Match commands run on worker threads so each gets its own connection
+        self._local = threading.local()
+
+    @property
+    def _con(self):
+        con = getattr(self._local, 'con', None)
+
+        if not con:
+            con = self._local.con = sqlite3.connect(self._path)
+
+        return con
 
     def get_match_string(self, args):
         blue_team, red_team = self.pick_teams(args)
@@ -1,3 +1,5 @@
+import threading
+
 import tellnext.store
 import tellnext.model
 import tellnext.generator
@@ -5,9 +7,21 @@ import tellnext.generator
 
 class TellnextGenerator(object):
     def __init__(self, database_path):
-        self._store = tellnext.store.SQLiteStore(path=database_path)
-        self._model = tellnext.model.MarkovModel(store=self._store)
-        self._generator = tellnext.generator.Generator(self._model)
+        self._database_path = database_path
+        # SQLite connections can only be used by the thread that made them
+        self._local = threading.local()
+
+    @property
+    def _generator(self):
+        generator = getattr(self._local, 'generator', None)
+
+        if not generator:
+            store = tellnext.store.SQLiteStore(path=self._database_path)
+            model = tellnext.model.MarkovModel(store=store)
+            generator = self._local.generator = \
+                tellnext.generator.Generator(model)
+
+        return generator
 
     def get_paragraph(self, max_len=300):
         sentences = []
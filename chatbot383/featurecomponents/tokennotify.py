@@ -102,4 +102,4 @@ class TokenNotifier(object):
 
         for channel in self._channels:
             _logger.info('Token notify to %s', channel)
-            bot.send_text(channel, text)
+            bot.send_text(channel, text, lane='announcement')
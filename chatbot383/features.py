@@ -1,5 +1,3 @@
-import collections
-import copy
 import gettext
 import hashlib
 import io
@@ -17,11 +15,17 @@ import requests
 import requests.exceptions
 
 import chatbot383.censor
+import chatbot383.metrics
 from chatbot383.bot import Limiter, Bot, InboundMessageSession
+from chatbot383.database import Database, MailbagFullError, \
+    SenderOutboxFullError
 from chatbot383.featurecomponents.battlebot import BattleBot
 from chatbot383.featurecomponents.matchgen import MatchGenerator, MatchError
 from chatbot383.featurecomponents.tokennotify import TokenNotifier
-from chatbot383.regex import RegexServer, RegexTimeout
+from chatbot383.history import HistoryEntry, HistoryStore
+from chatbot383.membership import MembershipStore
+from chatbot383.regex import RegexServer, RegexTimeout, RegexRejected, \
+    compile_pattern
 from chatbot383.roar import gen_roar
 
 _logger = logging.getLogger(__name__)
@@ -33,187 +37,6 @@ except ImportError:
     _logger.warning('Tellnext feature not available', exc_info=True)
 
 
-class MailbagFullError(ValueError):
-    pass
-
-
-class SenderOutboxFullError(MailbagFullError):
-    pass
-
-
-class Database(object):
-    def __init__(self, db_path):
-        self._path = db_path
-        self._con = sqlite3.connect(db_path)
-
-        self._init_db()
-
-    def _init_db(self):
-        with self._con:
-            self._con.execute('''PRAGMA journal_mode=WAL;''')
-            self._con.execute('''PRAGMA synchronous=NORMAL''')
-            self._con.execute('''CREATE TABLE IF NOT EXISTS mail
-            (id INTEGER PRIMARY KEY AUTOINCREMENT,
-            timestamp INTEGER NOT NULL,
-            username TEXT NOT NULL,
-            text TEXT NOT NULL,
-            status TEXT NOT NULL
-            )
-            ''')
-            self._con.execute('''CREATE INDEX IF NOT EXISTS mail_status_index
-            ON mail (status)
-            ''')
-            self._con.execute('''CREATE TABLE IF NOT EXISTS greetings
-            (channel TEXT PRIMARY KEY,
-            timestamp INTEGER NOT NULL,
-            username TEXT NOT NULL,
-            text TEXT NOT NULL
-            )
-            ''')
-
-            user_version = self._con.execute('PRAGMA user_version').fetchone()[0]
-
-            if user_version < 1:
-                self._con.execute(
-                    'ALTER TABLE mail ADD COLUMN channel TEXT'
-                )
-                self._con.execute(
-                    '''CREATE INDEX IF NOT EXISTS mail_channel_index
-                    ON mail (channel)
-                    ''')
-
-            self._con.execute('PRAGMA user_version = 1')
-
-    def get_mail(self, skip_username=None, skip_user_id=None, channel=None):
-        with self._con:
-            query = ['SELECT id, username, text, timestamp, channel FROM mail',
-                     'WHERE status = ?']
-            params = ['unread']
-
-            if skip_username:
-                query.append('AND username != ?')
-                params.append(skip_username)
-
-            if skip_user_id:
-                assert '!' not in skip_user_id
-                query.append("AND username NOT LIKE '%!' || ?")
-                params.append(skip_user_id)
-
-            if channel:
-                query.append('AND channel = ?')
-                params.append(channel)
-
-            query.append('LIMIT 1')
-
-            row = self._con.execute(' '.join(query), params).fetchone()
-
-            if row:
-                mail_info = {
-                    'username': row[1],
-                    'text': row[2],
-                    'timestamp': row[3],
-                    'channel': row[4]
-                }
-                self._con.execute('''UPDATE mail SET status = ?
-                WHERE id = ?''', ('read', row[0]))
-                return mail_info
-
-    def get_old_mail(self, skip_username=None, skip_user_id=None, channel=None):
-        with self._con:
-            row = self._con.execute('''SELECT max(id) FROM mail''').fetchone()
-
-            max_id = row[0]
-
-            if max_id is None:
-                return
-
-            min_id = 0
-
-            if channel:
-                row = self._con.execute(
-                    '''SELECT min(id) FROM mail WHERE CHANNEL = ?''',
-                    (channel,)
-                ).fetchone()
-                if row[0]:
-                    min_id = row[0]
-
-            for dummy in range(10):
-                # Retry a few times until we get an old one
-                query = ['SELECT username, text, timestamp, channel FROM mail',
-                         'WHERE status = ? AND id > ?']
-                params = ['read', _random.randint(min_id, max_id)]
-
-                if skip_username:
-                    query.append('AND username != ?')
-                    params.append(skip_username)
-
-                if skip_user_id:
-                    assert '!' not in skip_user_id
-                    query.append("AND username NOT LIKE '%!' || ?")
-                    params.append(skip_user_id)
-
-                if channel:
-                    query.append('AND channel = ?')
-                    params.append(channel)
-
-                query.append('LIMIT 1')
-
-                row = self._con.execute(' '.join(query), params).fetchone()
-
-                if row:
-                    mail_info = {
-                        'username': row[0],
-                        'text': row[1],
-                        'timestamp': row[2],
-                        'channel': row[3]
-                    }
-                    return mail_info
-
-    def put_mail(self, username, text, channel):
-        with self._con:
-            row = self._con.execute(
-                '''SELECT count(1) FROM mail
-                WHERE status = 'unread' AND username = ? LIMIT 1
-                ''',
-                (username,)
-            ).fetchone()
-
-            if row[0] >= 50:
-                raise SenderOutboxFullError()
-
-            row = self._con.execute('''SELECT count(1) FROM mail
-            WHERE status = 'unread' LIMIT 1''').fetchone()
-
-            if row[0] >= 500:
-                raise MailbagFullError()
-
-            self._con.execute('''INSERT INTO mail
-            (timestamp, username, text, status, channel)
-            VALUES (?, ?, ?, 'unread', ?)
-            ''', (int(time.time()), username, text, channel))
-
-    def get_status_count(self, status):
-        with self._con:
-            row = self._con.execute('''SELECT count(1) FROM mail
-            WHERE status = ? LIMIT 1''', (status,)).fetchone()
-
-            return row[0]
-
-    def set_greeting(self, channel, username, text):
-        with self._con:
-            self._con.execute('''INSERT OR REPLACE INTO greetings
-                (channel, timestamp, username, text) VALUES (?, ?, ?, ?)
-                ''', (channel, int(time.time()), username, text))
-
-    def get_greeting(self, channel):
-        with self._con:
-            row = self._con.execute('''SELECT text FROM greetings
-            WHERE channel = ? LIMIT 1''', (channel,)).fetchone()
-
-            if row:
-                return row[0]
-
-
 class Features(object):
     DONGER_SONG_TEMPLATE = (
         'I like to raise my {donger} I do it all the time ヽ༼ຈل͜ຈ༽ﾉ '
@@ -243,12 +66,24 @@ class Features(object):
         self._help_text = help_text
         self._database = database
         self._config = config
-        self._recent_messages_for_regex = collections.defaultdict(lambda: collections.deque(maxlen=100))
-        self._last_message = {}
+        self._history = HistoryStore(
+            max_bytes=config.get('history_max_bytes', 50000000),
+            channel_max_lines=config.get('regex_history_size', 2000),
+            channel_max_bytes=config.get('regex_history_max_bytes', 2000000)
+        )
         self._spam_limiter = Limiter(min_interval=10)
         self._password_api_limiter = Limiter(min_interval=2)
-        self._user_list = collections.defaultdict(set)
-        self._regex_server = RegexServer()
+        self._membership = MembershipStore(
+            ttl=config.get('membership_ttl', 21600),
+            max_channel_users=config.get('membership_max_channel_users',
+                                         50000),
+            # It rarely talks, so it would otherwise expire while present
+            exempt_usernames=('pikalaxbot',)
+        )
+        self._regex_server = RegexServer(
+            num_workers=config.get('regex_workers', 2),
+            num_spares=config.get('regex_spare_workers', 1))
+        self._regex_server.start()
         self._token_notifier = TokenNotifier(
             config.get('token_notify_filename'),
             config.get('token_notify_channels'),
@@ -273,22 +108,22 @@ class Features(object):
 
         bot.register_message_handler('pubmsg', self._collect_recent_message)
         bot.register_message_handler('action', self._collect_recent_message)
-        bot.register_command(r'!?s/(.+/.*)', self._regex_command)
+        bot.register_command(r'!?s/(.+/.*)', self._regex_command, blocking=True)
         bot.register_command(r'(?i)!caw($|\s.*)', self._caw_command)
         bot.register_command(r'(?i)!countdown($|\s.*)', self._countdown_command)
         bot.register_command(r'(?i)!debugecho\s+(.*)', self._debug_echo_command)
         bot.register_command(r'(?i)!double(team)?($|\s.*)', self._double_command)
-        bot.register_command(r'(?i)!(set)?greet(ing)?($|\s.*)$', self._greeting_command)
+        bot.register_command(r'(?i)!(set)?greet(ing)?($|\s.*)$', self._greeting_command, blocking=True)
         bot.register_command(r'(?i)!(groudonger)?(help|commands)($|\s.*)', self._help_command)
         bot.register_command(r'(?i)!groudon(ger)?($|\s.*)', self._roar_command)
         bot.register_command(r'(?i)!huffle($|\s.*)', self._huffle_command)
         bot.register_command(r'(?i)!hypestats($|\s.*)', self._hype_stats_command)
         bot.register_command(r'(?i)!klappa($|\s.*)', self._klappa_command)
-        bot.register_command(r'(?i)!(mail|post)($|\s.*)$', self._mail_command)
-        bot.register_command(r'(?i)!(mail|post)status($|\s.*)', self._mail_status_command)
+        bot.register_command(r'(?i)!(mail|post)($|\s.*)$', self._mail_command, blocking=True)
+        bot.register_command(r'(?i)!(mail|post)status($|\s.*)', self._mail_status_command, blocking=True)
         bot.register_command(r'(?i)!mute($|\s.*)', self._mute_command, ignore_rate_limit=True)
         bot.register_command(r'(?i)!normalize($|\s.*)', self._normalize_command)
-        bot.register_command(r'(?i)!password\s+(.*)', self._password_command)
+        bot.register_command(r'(?i)!password\s+(.*)', self._password_command, blocking=True)
         bot.register_command(r'(?i)!pick\s+(.*)', self._pick_command)
         bot.register_command(r'(?i)!praise($|\s.{,100})$', self._praise_command)
         bot.register_command(r'(?i)!schedule($|\s.*)', self._schedule_command)
@@ -303,20 +138,29 @@ class Features(object):
         bot.register_command(r'(?i)!riot($|\s.{,100})$', self._riot_command)
         bot.register_command(r'(?i)!rip($|\s.{,100})$', self._rip_command)
         bot.register_command(r'(?i)!roomsize?($|\s.*)', self._room_size_command)
-        bot.register_command(r'(?i)!gen(?:erate)?match($|\s.*)$', self._generate_match_command)
+        bot.register_command(r'(?i)!gen(?:erate)?match($|\s.*)$', self._generate_match_command, blocking=True)
         bot.register_command(r'(?i)!(xd|minglee)($|\s.*)', self._xd_command)
         # bot.register_command(r'(?i)!(set)?{}($|\s.*)'.format(username), self._username_command)
         # Temporary disabled. interferes with rate limit
         # bot.register_command(r'.*\b[xX][dD] +MingLee\b.*', self._xd_rand_command)
-        bot.register_command(r'(?i)!(wow)($|\s.*)', self._wow_command)
+        bot.register_command(r'(?i)!(wow)($|\s.*)', self._wow_command, blocking=True)
         bot.register_command(r'(?i)(?:has )?(?:just )?donate(?:d|s)? [^0-9]{0,5}([0-9][0-9,.]*)', self._donation_trigger)
 
         bot.register_message_handler('join', self._join_callback)
         bot.register_message_handler('part', self._part_callback)
+        bot.register_message_handler('names', self._names_callback)
+        bot.register_message_handler('names_end', self._names_end_callback)
 
         self._reseed_rng_sched()
         self._token_notify_sched()
         self._discord_presence_sched()
+        self._mail_maintenance_sched()
+
+    def reload_config(self, help_text: str, config: dict):
+        self._help_text = help_text
+        self._config = config
+        self._mail_disabled_channels = config.get('mail_disabled_channels')
+        self._avoid_pikalaxbot = config.get('avoid_pikalaxbot')
 
     def _reseed_rng_sched(self):
         _reseed()
@@ -334,7 +178,29 @@ class Features(object):
         self._bot.scheduler.enter(interval, 0, self._token_notify_sched)
 
     def _discord_presence_sched(self):
-        unread_count = self._database.get_status_count('unread')
+        self._database.get_status_count('unread').add_done_callback(
+            lambda future: self._bot.call_from_thread(
+                lambda: self._set_discord_presence(future)))
+
+        self._bot.scheduler.enter(300, 0, self._discord_presence_sched)
+
+    def _mail_maintenance_sched(self):
+        retention_days = self._config.get('mail_retention_days')
+
+        if retention_days is not None:
+            self._database.run_maintenance(
+                retention_days, self._config.get('mail_archive_days'))
+
+        self._bot.scheduler.enter(
+            self._config.get('mail_maintenance_interval', 3600), 0,
+            self._mail_maintenance_sched)
+
+    def _set_discord_presence(self, future):
+        try:
+            unread_count = future.result()
+        except sqlite3.Error:
+            _logger.exception('Error getting unread count')
+            return
 
         if unread_count:
             game_text = 'Mail Delivery: {} unread'.format(unread_count)
@@ -343,8 +209,6 @@ class Features(object):
 
         self._bot.set_discord_presence(game_text)
 
-        self._bot.scheduler.enter(300, 0, self._discord_presence_sched)
-
     @classmethod
     def is_too_long(cls, text, max_byte_length=400):
         return len(text.encode('utf-8', 'replace')) > max_byte_length
@@ -375,11 +239,13 @@ class Features(object):
             username = session.message['username']
             our_username = session.client.get_nickname(lower=True)
 
-            if username != our_username:
-                self._recent_messages_for_regex[channel].append(session.message)
+            self._membership.seen(channel, username)
 
-                if not session.message['text'].startswith('!'):
-                    self._last_message[channel] = session.message
+            if username != our_username:
+                text = session.message['text']
+                self._history.append(
+                    channel, HistoryEntry(session.message['nick'], text),
+                    last_message=not text.startswith('!'))
 
     def _help_command(self, session: InboundMessageSession):
         session.reply('{} {}'.format(gen_roar(), self._help_text),
@@ -422,7 +288,8 @@ class Features(object):
 
     def _regex_command(self, session: InboundMessageSession):
         channel = session.message['channel']
-        if self._avoid_pikalaxbot and 'pikalaxbot' in self._user_list[channel]:
+        if self._avoid_pikalaxbot and \
+                self._membership.contains(channel, 'pikalaxbot'):
             session.skip_rate_limit = True
             return
 
@@ -445,62 +312,60 @@ class Features(object):
             count = 0
 
         try:
-            pattern = re.compile(search_pattern, flags)
+            # Only messages containing the pattern's literals are candidates
+            literals = compile_pattern(search_pattern, flags).literals
+            history_messages = [
+                history_message for history_message
+                in self._history.get(channel).search(literals)
+                if not history_message.text.startswith('s/') and
+                not history_message.text.startswith('!s/')
+            ]
+            index, new_text = self._regex_server.substitute(
+                search_pattern, flags, replacement,
+                [history_message.text for history_message in history_messages],
+                count=count
+            )
+        except RegexRejected:
+            session.reply('{} Your pattern is too complex!'.format(gen_roar()))
+            return
+        except RegexTimeout:
+            _logger.warning(
+                'Regex DoS by %s on %s', session.message['username'],
+                session.message['channel'])
+            session.reply(gen_roar().upper())
+            return
         except re.error as error:
             session.reply('{} {}!'.format(gen_roar(), error.args[0].title()))
             return
 
-        for history_message in reversed(self._recent_messages_for_regex[session.message['channel']]):
-            text = history_message['text']
-            channel = session.message['channel']
-
-            if text.startswith('s/') or text.startswith('!s/'):
-                continue
-
-            try:
-                matched = self._regex_server.search(pattern, text)
-            except RegexTimeout:
-                _logger.warning(
-                    'Regex DoS by %s on %s', session.message['username'],
-                    session.message['channel'])
-                session.reply(gen_roar().upper())
-                return
-
-            if matched:
-                try:
-                    new_text = pattern.sub(replacement, text, count=count)
-                except re.error as error:
-                    session.reply('{} {}!'.format(gen_roar(), error.args[0].title()))
-                    return
-
-                if _random.random() < 0.05:
-                    new_text = gen_roar()
-                    fake_out = True
-                else:
-                    fake_out = False
-
-                formatted_text = '{user} wishes to {stacked}correct ' \
-                    '{target_user}: {text}'.format(
-                        user=session.message['nick'],
-                        target_user=history_message['nick'],
-                        text=new_text,
-                        stacked='re' if history_message.get('stacked') else '',
-                )
+        if index is None:
+            session.reply('{} Your request does not apply to any recent messages!'
+                          .format(gen_roar()))
+            return
 
-                ok = self._try_say_or_reply_too_long(formatted_text, session)
-                if not ok:
-                    return
+        history_message = history_messages[index]
 
-                if not fake_out:
-                    stacked_message = copy.copy(history_message)
-                    stacked_message['text'] = new_text
-                    stacked_message['stacked'] = True
-                    self._recent_messages_for_regex[channel].append(stacked_message)
+        if _random.random() < 0.05:
+            new_text = gen_roar()
+            fake_out = True
+        else:
+            fake_out = False
+
+        formatted_text = '{user} wishes to {stacked}correct ' \
+            '{target_user}: {text}'.format(
+                user=session.message['nick'],
+                target_user=history_message.nick,
+                text=new_text,
+                stacked='re' if history_message.stacked else '',
+        )
 
-                return
+        ok = self._try_say_or_reply_too_long(formatted_text, session)
+        if not ok:
+            return
 
-        session.reply('{} Your request does not apply to any recent messages!'
-                      .format(gen_roar()))
+        if not fake_out:
+            self._history.append(channel, HistoryEntry(
+                history_message.nick, new_text, stacked=True))
 
     def _caw_command(self, session: InboundMessageSession):
         words = session.match.group(1).split()
@@ -571,12 +436,13 @@ class Features(object):
 
     def _double_command(self, session: InboundMessageSession):
         text = session.match.group(2).strip()
-        last_message = self._last_message.get(session.message['channel'])
+        last_message = self._history.get_last_message(
+            session.message['channel'])
 
         if not text and (session.match.group(1) or not last_message):
             text = 'ヽ༼ຈل͜ຈ༽ﾉ DOUBLE TEAM ヽ༼ຈل͜ຈ༽ﾉ'
         elif not text:
-            text = last_message['text']
+            text = last_message.text
 
         double_text = ''.join(char * 2 for char in text)
         formatted_text = '{} Doubled! {}'.format(gen_roar(), double_text)
@@ -592,10 +458,11 @@ class Features(object):
                 session.message['channel'],
                 session.message['user_id'] or session.message['username'],
                 text
-            )
+            ).result()
             session.reply('{} Greeting saved'.format(gen_roar()))
         else:
-            greeting = self._database.get_greeting(session.message['channel'])
+            greeting = self._database.get_greeting(
+                session.message['channel']).result()
 
             if greeting:
                 formatted_text = '{} {}'.format(gen_roar(), greeting)
@@ -611,10 +478,11 @@ class Features(object):
 
     def _normalize_command(self, session: InboundMessageSession):
         text = session.match.group(1).strip()
-        last_message = self._last_message.get(session.message['channel'])
+        last_message = self._history.get_last_message(
+            session.message['channel'])
 
         if not text and last_message:
-            text = last_message['text']
+            text = last_message.text
         elif not text:
             text = 'Groudonger'
 
@@ -630,10 +498,9 @@ class Features(object):
         if not text:
             text = 'Groudonger'
 
-        if not self._password_api_limiter.is_ok('password'):
+        if not self._password_api_limiter.try_update('password'):
             time.sleep(2)
-
-        self._password_api_limiter.update('password')
+            self._password_api_limiter.update('password')
 
         hasher = hashlib.sha1()
         hasher.update(text.encode('utf8', 'replace'))
@@ -702,10 +569,11 @@ class Features(object):
     def _shuffle_command(self, session: InboundMessageSession):
         word_shuffle = bool(session.match.group(1))
         text = session.match.group(2).strip()
-        last_message = self._last_message.get(session.message['channel'])
+        last_message = self._history.get_last_message(
+            session.message['channel'])
 
         if not text and last_message:
-            text = last_message['text']
+            text = last_message.text
         elif not text:
             text = 'Groudonger'
 
@@ -747,10 +615,11 @@ class Features(object):
 
     def _sort_command(self, session: InboundMessageSession):
         text = session.match.group(1).strip()
-        last_message = self._last_message.get(session.message['channel'])
+        last_message = self._history.get_last_message(
+            session.message['channel'])
 
         if not text and last_message:
-            text = last_message['text']
+            text = last_message.text
         elif not text:
             text = 'Groudonger'
 
@@ -811,10 +680,11 @@ class Features(object):
 
     def _rand_case_command(self, session: InboundMessageSession):
         text = session.match.group(1).strip()
-        last_message = self._last_message.get(session.message['channel'])
+        last_message = self._history.get_last_message(
+            session.message['channel'])
 
         if not text and last_message:
-            text = last_message['text']
+            text = last_message.text
         elif not text:
             text = 'Groudonger'
 
@@ -828,10 +698,11 @@ class Features(object):
 
     def _reverse_command(self, session: InboundMessageSession):
         text = session.match.group(1).strip()
-        last_message = self._last_message.get(session.message['channel'])
+        last_message = self._history.get_last_message(
+            session.message['channel'])
 
         if not text and last_message:
-            text = last_message['text']
+            text = last_message.text
         elif not text:
             text = 'Groudonger'
 
@@ -884,7 +755,8 @@ class Features(object):
     def _room_size_command(self, session: InboundMessageSession):
         formatted_text = \
             '{} {} users in chat room.'.format(
-                gen_roar(), len(self._user_list[session.message['channel']])
+                gen_roar(),
+                self._membership.count(session.message['channel'])
             )
 
         self._try_say_or_reply_too_long(formatted_text, session)
@@ -991,7 +863,7 @@ class Features(object):
                 platform_name
             )
             self._database.put_mail(username, mail_text,
-                                    session.message['channel'])
+                                    session.message['channel']).result()
         except SenderOutboxFullError:
             session.reply(
                 '{} How embarrassing! Your outbox is full!'
@@ -1028,15 +900,15 @@ class Features(object):
             mail_info = self._database.get_old_mail(
                 skip_username=skip_username, skip_user_id=skip_user_id,
                 channel=channel
-            )
+            ).result()
 
         if not mail_info:
             mail_info = self._database.get_mail(
                 skip_username=skip_username, skip_user_id=skip_user_id
-            )
+            ).result()
 
             if not mail_info and _random.random() < 0.6:
-                mail_info = self._database.get_old_mail()
+                mail_info = self._database.get_old_mail().result()
 
         if not mail_info:
             session.reply(
@@ -1071,8 +943,10 @@ class Features(object):
             )
 
     def _mail_status_command(self, session: InboundMessageSession):
-        unread_count = self._database.get_status_count('unread')
-        read_count = self._database.get_status_count('read')
+        unread_future = self._database.get_status_count('unread')
+        read_future = self._database.get_status_count('read')
+        unread_count = unread_future.result()
+        read_count = read_future.result()
 
         channel = session.message['channel']
 
@@ -1111,16 +985,24 @@ class Features(object):
             session.reply('{} An error occurred when generating a match!'.format(gen_roar()))
 
     def _join_callback(self, session: InboundMessageSession):
-        usernames = self._user_list[session.message['channel']]
-        username = session.message['username']
-        usernames.add(username)
+        self._membership.seen(
+            session.message['channel'], session.message['username'])
 
     def _part_callback(self, session: InboundMessageSession):
-        usernames = self._user_list[session.message['channel']]
+        channel = session.message['channel']
         username = session.message['username']
 
-        if username in usernames:
-            usernames.remove(username)
+        if username == session.client.get_nickname(lower=True):
+            self._membership.clear(channel)
+        else:
+            self._membership.part(channel, username)
+
+    def _names_callback(self, session: InboundMessageSession):
+        self._membership.add_names(
+            session.message['channel'], session.message['usernames'])
+
+    def _names_end_callback(self, session: InboundMessageSession):
+        self._membership.end_names(session.message['channel'])
 
     def _censor_text(self, session: InboundMessageSession, text: str,
                      extra_censor: bool=False) -> str:
@@ -0,0 +1,231 @@
+"""Per-channel chat history for corrections and text commands."""
+import array
+import collections
+import logging
+import sys
+import threading
+
+import chatbot383.metrics
+
+_logger = logging.getLogger(__name__)
+
+# Rough costs used to estimate memory use
+ENTRY_OVERHEAD = 120
+POSTING_OVERHEAD = 8
+TRIGRAM_OVERHEAD = 200
+
+# Postings dropped from the front are only removed from the array once
+# they are at least this many and half of it
+POSTING_COMPACT_MIN = 32
+
+
+def trigrams(text: str) -> frozenset:
+    return frozenset(text[index:index + 3] for index in range(len(text) - 2))
+
+
+class HistoryEntry(object):
+    __slots__ = ('nick', 'text', 'stacked')
+
+    def __init__(self, nick: str, text: str, stacked: bool=False):
+        self.nick = sys.intern(nick)
+        self.text = text
+        self.stacked = stacked
+
+    def __repr__(self):
+        return 'HistoryEntry({!r}, {!r}, {!r})'.format(
+            self.nick, self.text, self.stacked)
+
+
+class MessageHistory(object):
+    """Ring buffer of recent messages with a trigram index over the text.
+
+    The oldest messages are dropped when there are more than `max_lines`
+    or the estimated size exceeds `max_bytes`.
+    """
+    def __init__(self, max_lines: int=2000, max_bytes: int=2000000):
+        self._max_lines = max_lines
+        self._max_bytes = max_bytes
+        self._ring = []
+        self._first_sequence = 0
+        self._next_sequence = 0
+        self._postings = {}
+        # Number of dropped postings at the front of each array
+        self._posting_starts = {}
+        self._size = 0
+        self._lock = threading.Lock()
+        self.last_message = None
+
+    def __len__(self):
+        return self._next_sequence - self._first_sequence
+
+    @property
+    def memory_usage(self) -> int:
+        """Estimated bytes used by the messages and index."""
+        return self._size
+
+    def append(self, entry: HistoryEntry):
+        text_trigrams = trigrams(entry.text)
+
+        with self._lock:
+            if len(self) == self._max_lines:
+                self._pop_oldest()
+
+            sequence = self._next_sequence
+            index = sequence % self._max_lines
+
+            # Grow the ring lazily so quiet channels stay small
+            if index == len(self._ring):
+                self._ring.append(None)
+
+            self._ring[index] = entry
+            self._next_sequence += 1
+
+            for trigram in text_trigrams:
+                postings = self._postings.get(trigram)
+
+                if postings is None:
+                    postings = self._postings[trigram] = array.array('Q')
+                    self._size += TRIGRAM_OVERHEAD
+
+                postings.append(sequence)
+
+            self._size += ENTRY_OVERHEAD + len(entry.text) + \
+                POSTING_OVERHEAD * len(text_trigrams)
+
+            while self._size > self._max_bytes and len(self) > 1:
+                self._pop_oldest()
+
+    def _pop_oldest(self):
+        index = self._first_sequence % self._max_lines
+        entry = self._ring[index]
+        self._ring[index] = None
+        text_trigrams = trigrams(entry.text)
+
+        # The oldest message is always at the front of its postings.
+        # Deleting from the front of an array moves the rest, so only the
+        # start offset moves until there is enough to compact at once.
+        for trigram in text_trigrams:
+            postings = self._postings[trigram]
+            start = self._posting_starts.pop(trigram, 0) + 1
+
+            if start == len(postings):
+                del self._postings[trigram]
+                self._size -= TRIGRAM_OVERHEAD
+            elif start >= POSTING_COMPACT_MIN and start * 2 >= len(postings):
+                del postings[:start]
+            else:
+                self._posting_starts[trigram] = start
+
+        self._first_sequence += 1
+        self._size -= ENTRY_OVERHEAD + len(entry.text) + \
+            POSTING_OVERHEAD * len(text_trigrams)
+
+    def search(self, literals=()) -> list:
+        """Return entries containing all `literals`, newest first."""
+        query_trigrams = set()
+
+        for literal in literals:
+            query_trigrams.update(trigrams(literal))
+
+        with self._lock:
+            if query_trigrams:
+                shortest_postings = None
+                shortest_start = 0
+
+                for trigram in query_trigrams:
+                    postings = self._postings.get(trigram)
+
+                    if not postings:
+                        return []
+
+                    start = self._posting_starts.get(trigram, 0)
+
+                    if shortest_postings is None or len(postings) - start < \
+                            len(shortest_postings) - shortest_start:
+                        shortest_postings = postings
+                        shortest_start = start
+
+                sequences = reversed(shortest_postings[shortest_start:])
+            else:
+                sequences = range(self._next_sequence - 1,
+                                  self._first_sequence - 1, -1)
+
+            entries = [
+                self._ring[sequence % self._max_lines]
+                for sequence in sequences
+            ]
+
+        return [
+            entry for entry in entries
+            if all(literal in entry.text for literal in literals)
+        ]
+
+
+class HistoryStore(object):
+    """Message histories of all channels.
+
+    Channels not used recently are evicted when the estimated size of all
+    histories exceeds `max_bytes`.
+    """
+    def __init__(self, max_bytes: int=50000000, channel_max_lines: int=2000,
+                 channel_max_bytes: int=2000000):
+        self._max_bytes = max_bytes
+        self._channel_max_lines = channel_max_lines
+        self._channel_max_bytes = channel_max_bytes
+        self._histories = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._histories)
+
+    def __contains__(self, channel: str):
+        return channel in self._histories
+
+    @property
+    def memory_usage(self) -> int:
+        return self._size
+
+    def get(self, channel: str) -> MessageHistory:
+        with self._lock:
+            return self._get(channel)
+
+    def _get(self, channel: str) -> MessageHistory:
+        history = self._histories.get(channel)
+
+        if history is None:
+            history = self._histories[channel] = MessageHistory(
+                self._channel_max_lines, self._channel_max_bytes)
+            chatbot383.metrics.HISTORY_BYTES.labels(channel) \
+                .set_function(lambda: history.memory_usage)
+        else:
+            self._histories.move_to_end(channel)
+
+        return history
+
+    def get_last_message(self, channel: str) -> HistoryEntry:
+        with self._lock:
+            history = self._histories.get(channel)
+
+        if history is not None:
+            return history.last_message
+
+    def append(self, channel: str, entry: HistoryEntry,
+               last_message: bool=False):
+        with self._lock:
+            history = self._get(channel)
+            old_size = history.memory_usage
+
+            history.append(entry)
+
+            if last_message:
+                history.last_message = entry
+
+            self._size += history.memory_usage - old_size
+
+            while self._size > self._max_bytes and len(self._histories) > 1:
+                evicted_channel, evicted_history = \
+                    self._histories.popitem(last=False)
+                self._size -= evicted_history.memory_usage
+                chatbot383.metrics.HISTORY_BYTES.remove(evicted_channel)
+                _logger.debug('Evicted history of %s', evicted_channel)
@@ -0,0 +1,104 @@
+import unittest
+
+from chatbot383.history import MessageHistory, HistoryEntry, HistoryStore, \
+    ENTRY_OVERHEAD
+
+
+def _texts(entries):
+    return [entry.text for entry in entries]
+
+
+class TestMessageHistory(unittest.TestCase):
+    def test_search(self):
+        history = MessageHistory(max_lines=10)
+
+        for text in ('hello world', 'goodbye world', 'hello there', 'hi'):
+            history.append(HistoryEntry('User', text))
+
+        self.assertEqual(
+            ['hi', 'hello there', 'goodbye world', 'hello world'],
+            _texts(history.search()))
+        self.assertEqual(
+            ['hello there', 'hello world'], _texts(history.search(['hello'])))
+        self.assertEqual(
+            ['hello world'], _texts(history.search(['hello', 'wor'])))
+        self.assertEqual([], history.search(['zzz']))
+        # Literals shorter than a trigram are checked directly
+        self.assertEqual(['hi'], _texts(history.search(['hi'])))
+
+    def test_max_lines(self):
+        history = MessageHistory(max_lines=3)
+
+        for index in range(10):
+            history.append(HistoryEntry('User', 'message {}'.format(index)))
+
+        self.assertEqual(3, len(history))
+        self.assertEqual(
+            ['message 9', 'message 8', 'message 7'],
+            _texts(history.search(['message'])))
+        self.assertEqual(['message 8'], _texts(history.search(['ge 8'])))
+        self.assertEqual([], history.search(['ge 5']))
+
+    def test_postings_compacted(self):
+        history = MessageHistory(max_lines=50)
+
+        for index in range(1000):
+            history.append(HistoryEntry('User', 'message {}'.format(index)))
+
+        self.assertEqual(
+            ['message 999', 'message 998'],
+            _texts(history.search(['message'])[:2]))
+        self.assertEqual(50, len(history.search(['message'])))
+        self.assertEqual(['message 960'], _texts(history.search(['ge 960'])))
+        self.assertLessEqual(len(history._postings['mes']), 100)
+
+    def test_max_bytes(self):
+        history = MessageHistory(max_lines=100,
+                                 max_bytes=ENTRY_OVERHEAD * 4 + 1000)
+
+        for index in range(20):
+            history.append(HistoryEntry('User', 'x' * 100))
+
+        self.assertLess(len(history), 20)
+        self.assertLessEqual(history.memory_usage, ENTRY_OVERHEAD * 4 + 1000)
+
+        while len(history) > 1:
+            history._pop_oldest()
+
+        history._pop_oldest()
+        self.assertEqual(0, history.memory_usage)
+        self.assertEqual({}, history._postings)
+
+    def test_interned(self):
+        entry_1 = HistoryEntry(''.join(['Us', 'er']), 'a')
+        entry_2 = HistoryEntry(''.join(['Use', 'r']), 'b')
+
+        self.assertIs(entry_1.nick, entry_2.nick)
+
+
+class TestHistoryStore(unittest.TestCase):
+    def test_last_message(self):
+        store = HistoryStore()
+
+        self.assertIsNone(store.get_last_message('#a'))
+
+        store.append('#a', HistoryEntry('User', 'hello'), last_message=True)
+        store.append('#a', HistoryEntry('User', '!command'))
+
+        self.assertEqual('hello', store.get_last_message('#a').text)
+        self.assertEqual(2, len(store.get('#a')))
+
+    def test_evict(self):
+        store = HistoryStore(max_bytes=ENTRY_OVERHEAD * 10)
+
+        store.append('#a', HistoryEntry('User', 'a'))
+        store.append('#b', HistoryEntry('User', 'b'))
+        store.get('#a')
+
+        for index in range(8):
+            store.append('#c', HistoryEntry('User', str(index)))
+
+        self.assertNotIn('#b', store)
+        self.assertIn('#a', store)
+        self.assertIn('#c', store)
+        self.assertLessEqual(store.memory_usage, ENTRY_OVERHEAD * 10)
@@ -0,0 +1,236 @@
+import heapq
+import itertools
+import logging
+import time
+
+from chatbot383.outbound import TWITCH_JOIN_LIMIT
+from chatbot383.ratelimit import TokenBucket
+
+_logger = logging.getLogger(__name__)
+
+
+class _ChannelJoin(object):
+    __slots__ = ('channel', 'client', 'priority', 'attempts', 'sent_time',
+                 'confirmed', 'queued', 'given_up')
+
+    def __init__(self, channel: str, client, priority):
+        self.channel = channel
+        self.client = client
+        self.priority = priority
+        self.attempts = 0
+        self.sent_time = None
+        self.confirmed = False
+        self.queued = False
+        self.given_up = False
+
+
+class JoinManager(object):
+    """Paces JOINs and retries channels that were not confirmed.
+
+    Each wanted channel is assigned to a client. Channels are joined
+    in the order given by `priority_key` at no more than `rate` channels
+    per second. A channel counts as joined once the server echoes our
+    JOIN; if that doesn't happen within `confirm_timeout`, the JOIN is
+    sent again, up to `max_attempts` times.
+
+    The manager doesn't run on its own. Call `process()` and call it again
+    after the returned delay.
+    """
+    def __init__(self, rate: float=TWITCH_JOIN_LIMIT.rate,
+                 burst: int=TWITCH_JOIN_LIMIT.capacity,
+                 batch_size: int=10, confirm_timeout: float=20.0,
+                 max_attempts: int=5, priority_key=None,
+                 clock=time.monotonic):
+        self._bucket = TokenBucket(burst, rate, clock=clock)
+        self._batch_size = batch_size
+        self._confirm_timeout = confirm_timeout
+        self._max_attempts = max_attempts
+        self._priority_key = priority_key or (lambda channel: channel)
+        self._clock = clock
+        self._channels = {}
+        self._pending = []
+        self._awaiting = {}
+        self._connected = set()
+        self._counter = itertools.count()
+
+    def __contains__(self, channel: str):
+        return channel in self._channels
+
+    def is_confirmed(self, channel: str) -> bool:
+        record = self._channels.get(channel)
+        return bool(record and record.confirmed)
+
+    def get_unconfirmed(self) -> list:
+        return sorted(
+            channel for channel, record in self._channels.items()
+            if not record.confirmed
+        )
+
+    def _push(self, record: _ChannelJoin):
+        if record.queued or record.confirmed:
+            return
+
+        record.queued = True
+        record.sent_time = None
+        self._awaiting.pop(record.channel, None)
+        heapq.heappush(
+            self._pending,
+            (record.priority, next(self._counter), record)
+        )
+
+    def connection_ready(self, client):
+        """Mark the client as connected and requeue its channels.
+
+        The server has forgotten our channels if the client reconnected,
+        so all channels of the client are joined again.
+        """
+        self._connected.add(client)
+
+        for record in self._channels.values():
+            if record.client is client:
+                record.confirmed = False
+                record.attempts = 0
+                record.given_up = False
+                self._push(record)
+
+    def connection_lost(self, client):
+        self._connected.discard(client)
+
+        for record in self._channels.values():
+            if record.client is client:
+                record.confirmed = False
+                self._awaiting.pop(record.channel, None)
+
+    def add(self, client, channels):
+        """Join the channels on the given client.
+
+        Channels already assigned to another client are moved.
+        """
+        for channel in channels:
+            record = self._channels.get(channel)
+
+            if record and record.client is client:
+                continue
+
+            if record:
+                record.queued = False
+                self._awaiting.pop(channel, None)
+
+            record = self._channels[channel] = _ChannelJoin(
+                channel, client, self._priority_key(channel))
+            self._push(record)
+
+    def remove(self, channel: str):
+        record = self._channels.pop(channel, None)
+
+        if record:
+            record.queued = False
+            self._awaiting.pop(channel, None)
+
+    def confirm(self, client, channel: str):
+        record = self._channels.get(channel)
+
+        if not record or record.client is not client:
+            return
+
+        if not record.confirmed:
+            _logger.debug('Join confirmed %s after %s attempts',
+                          ascii(channel), record.attempts)
+
+        record.confirmed = True
+        record.queued = False
+        self._awaiting.pop(channel, None)
+
+    def parted(self, client, channel: str):
+        # We were removed from a channel we still want
+        record = self._channels.get(channel)
+
+        if record and record.client is client and record.confirmed:
+            _logger.info('Parted from %s unexpectedly. Rejoining.',
+                         ascii(channel))
+            record.confirmed = False
+            record.attempts = 0
+            self._push(record)
+
+    def process(self, join_func) -> float:
+        """Send JOINs that are due.
+
+        `join_func(client, channels)` is called with a comma separated
+        channel list and returns False if it could not be queued.
+
+        Returns the number of seconds until the next call or None if there
+        is nothing left to do.
+        """
+        time_now = self._clock()
+
+        self._check_timeouts(time_now)
+
+        batches = {}
+
+        while self._pending and self._bucket.tokens >= 1:
+            dummy, dummy, record = heapq.heappop(self._pending)
+
+            if not record.queued or \
+                    self._channels.get(record.channel) is not record:
+                continue
+
+            record.queued = False
+
+            if record.client not in self._connected:
+                continue
+
+            self._bucket.consume(1)
+            record.attempts += 1
+            record.sent_time = time_now
+            self._awaiting[record.channel] = record
+
+            batch = batches.setdefault(record.client, [])
+            batch.append(record)
+
+            if len(batch) >= self._batch_size:
+                self._send_batch(join_func, batches.pop(record.client))
+
+        for batch in batches.values():
+            self._send_batch(join_func, batch)
+
+        return self._next_delay(time_now)
+
+    def _send_batch(self, join_func, records):
+        client = records[0].client
+
+        if not join_func(client, ','.join(record.channel for record in records)):
+            _logger.warning('Could not queue JOIN for %s channels',
+                            len(records))
+
+            for record in records:
+                record.attempts -= 1
+                self._push(record)
+
+    def _check_timeouts(self, time_now: float):
+        for record in list(self._awaiting.values()):
+            if time_now - record.sent_time < self._confirm_timeout:
+                continue
+
+            del self._awaiting[record.channel]
+
+            if record.attempts >= self._max_attempts:
+                _logger.warning('Giving up joining %s after %s attempts',
+                                ascii(record.channel), record.attempts)
+                record.given_up = True
+            else:
+                _logger.info('Join %s not confirmed. Retrying.',
+                             ascii(record.channel))
+                self._push(record)
+
+    def _next_delay(self, time_now: float) -> float:
+        delays = []
+
+        if self._pending:
+            delays.append(self._bucket.time_until_available(1))
+
+        if self._awaiting:
+            delays.append(max(0.0, min(
+                record.sent_time for record in self._awaiting.values()
+            ) + self._confirm_timeout - time_now))
+
+        return min(delays, default=None)
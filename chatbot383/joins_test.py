@@ -0,0 +1,102 @@
+import unittest
+
+from chatbot383.joins import JoinManager
+from chatbot383.testing import FakeClock
+
+
+class TestJoinManager(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.sent = []
+
+    def join_func(self, client, channels):
+        self.sent.append((client, channels))
+        return True
+
+    def sent_channels(self):
+        return [
+            channel for dummy, channels in self.sent
+            for channel in channels.split(',')
+        ]
+
+    def test_pacing(self):
+        manager = JoinManager(rate=1, burst=4, batch_size=2, clock=self.clock)
+        manager.connection_ready('client')
+        manager.add('client', ['#a', '#b', '#c', '#d', '#e', '#f'])
+
+        delay = manager.process(self.join_func)
+
+        self.assertEqual(
+            [('client', '#a,#b'), ('client', '#c,#d')], self.sent)
+        self.assertAlmostEqual(1.0, delay)
+
+        self.clock.time += 1
+        manager.process(self.join_func)
+
+        self.assertEqual(['#a', '#b', '#c', '#d', '#e'], self.sent_channels())
+
+    def test_priority(self):
+        lurk = {'#a', '#b'}
+        manager = JoinManager(rate=1, burst=2, clock=self.clock,
+                              priority_key=lambda channel: (channel in lurk, channel))
+        manager.connection_ready('client')
+        manager.add('client', ['#a', '#b', '#c', '#d'])
+        manager.process(self.join_func)
+
+        self.assertEqual(['#c', '#d'], self.sent_channels())
+
+    def test_retry(self):
+        manager = JoinManager(rate=10, burst=10, confirm_timeout=5,
+                              max_attempts=2, clock=self.clock)
+        manager.connection_ready('client')
+        manager.add('client', ['#a', '#b'])
+        manager.process(self.join_func)
+        manager.confirm('client', '#a')
+
+        self.assertTrue(manager.is_confirmed('#a'))
+        self.assertEqual(['#b'], manager.get_unconfirmed())
+
+        self.clock.time += 5
+        manager.process(self.join_func)
+
+        self.assertEqual(['#a', '#b', '#b'], self.sent_channels())
+
+        self.clock.time += 5
+        delay = manager.process(self.join_func)
+
+        self.assertEqual(['#a', '#b', '#b'], self.sent_channels())
+        self.assertIsNone(delay)
+
+    def test_reconnect(self):
+        manager = JoinManager(rate=10, burst=10, clock=self.clock)
+        manager.connection_ready('client')
+        manager.add('client', ['#a', '#b'])
+        manager.process(self.join_func)
+        manager.confirm('client', '#a')
+        manager.confirm('client', '#b')
+
+        manager.connection_lost('client')
+        manager.process(self.join_func)
+
+        self.assertEqual(['#a', '#b'], manager.get_unconfirmed())
+        self.assertEqual(1, len(self.sent))
+
+        manager.connection_ready('client')
+        manager.process(self.join_func)
+
+        self.assertEqual(['#a', '#b', '#a', '#b'], self.sent_channels())
+
+    def test_move(self):
+        manager = JoinManager(rate=10, burst=10, clock=self.clock)
+        manager.connection_ready('client1')
+        manager.connection_ready('client2')
+        manager.add('client1', ['#a'])
+        manager.add('client2', ['#a'])
+        manager.process(self.join_func)
+
+        self.assertEqual([('client2', '#a')], self.sent)
+
+        manager.confirm('client1', '#a')
+        self.assertFalse(manager.is_confirmed('#a'))
+        manager.confirm('client2', '#a')
+        self.assertTrue(manager.is_confirmed('#a'))
@@ -0,0 +1,208 @@
+"""Who is in each channel, as far as JOIN, PART, NAMES, and chat tell us."""
+import collections
+import logging
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+
+class MembershipStore(object):
+    """Channel members keyed by small integer user IDs.
+
+    Usernames are mapped to IDs shared by all channels and freed when no
+    channel references them. Members not seen for `ttl` seconds are
+    expired, so a missed PART doesn't keep a user forever.
+
+    Users in `exempt_usernames`, such as bots that rarely talk, don't
+    expire and only leave on PART or a NAMES reply without them.
+    """
+    def __init__(self, ttl: float=21600, max_channel_users: int=50000,
+                 exempt_usernames=(), clock=time.monotonic):
+        self._ttl = ttl
+        self._exempt_usernames = frozenset(exempt_usernames)
+        self._max_channel_users = max_channel_users
+        self._clock = clock
+        self._user_ids = {}
+        self._usernames = []
+        self._reference_counts = []
+        self._free_ids = []
+        self._channels = {}
+        self._pending_names = {}
+        # Channel to a dict of exempt username to last seen time
+        self._exempt_members = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        """Number of distinct users tracked."""
+        exempt_usernames = set()
+
+        for exempt_members in self._exempt_members.values():
+            exempt_usernames.update(exempt_members)
+
+        return len(self._user_ids) + len(exempt_usernames)
+
+    def _get_user_id(self, username: str) -> int:
+        user_id = self._user_ids.get(username)
+
+        if user_id is not None:
+            return user_id
+
+        if self._free_ids:
+            user_id = self._free_ids.pop()
+            self._usernames[user_id] = username
+            self._reference_counts[user_id] = 0
+        else:
+            user_id = len(self._usernames)
+            self._usernames.append(username)
+            self._reference_counts.append(0)
+
+        self._user_ids[username] = user_id
+
+        return user_id
+
+    def _release_user_id(self, user_id: int):
+        self._reference_counts[user_id] -= 1
+
+        if not self._reference_counts[user_id]:
+            del self._user_ids[self._usernames[user_id]]
+            self._usernames[user_id] = None
+            self._free_ids.append(user_id)
+
+    def _touch(self, channel: str, username: str, time_now: float):
+        if username in self._exempt_usernames:
+            self._exempt_members.setdefault(channel, {})[username] = time_now
+            return
+
+        members = self._channels.get(channel)
+
+        if members is None:
+            members = self._channels[channel] = collections.OrderedDict()
+
+        user_id = self._get_user_id(username)
+
+        if user_id in members:
+            members.move_to_end(user_id)
+        else:
+            self._reference_counts[user_id] += 1
+
+        # Ordered by last seen, so expired members are at the front
+        members[user_id] = time_now
+
+        self._expire(members, time_now, limit=8)
+
+        while len(members) > self._max_channel_users:
+            self._release_user_id(members.popitem(last=False)[0])
+
+    def _expire(self, members: collections.OrderedDict, time_now: float,
+                limit: int=None):
+        deadline = time_now - self._ttl
+        count = 0
+
+        while members and (limit is None or count < limit):
+            user_id, last_seen = next(iter(members.items()))
+
+            if last_seen > deadline:
+                break
+
+            del members[user_id]
+            self._release_user_id(user_id)
+            count += 1
+
+    def seen(self, channel: str, username: str):
+        """Record a JOIN or message from the user."""
+        with self._lock:
+            self._touch(channel, username, self._clock())
+
+    def part(self, channel: str, username: str):
+        with self._lock:
+            exempt_members = self._exempt_members.get(channel)
+
+            if exempt_members and username in exempt_members:
+                del exempt_members[username]
+                return
+
+            members = self._channels.get(channel)
+            user_id = self._user_ids.get(username)
+
+            if members is None or user_id is None or user_id not in members:
+                return
+
+            del members[user_id]
+            self._release_user_id(user_id)
+
+    def clear(self, channel: str):
+        with self._lock:
+            members = self._channels.pop(channel, None)
+            self._pending_names.pop(channel, None)
+            self._exempt_members.pop(channel, None)
+
+            for user_id in members or ():
+                self._release_user_id(user_id)
+
+    def add_names(self, channel: str, usernames):
+        """Add users from a NAMES reply (353)."""
+        with self._lock:
+            time_now = self._clock()
+            self._pending_names.setdefault(channel, time_now)
+
+            for username in usernames:
+                self._touch(channel, username, time_now)
+
+    def end_names(self, channel: str):
+        """Finish a NAMES reply (366).
+
+        Members not listed and not seen since the reply started are
+        dropped.
+        """
+        with self._lock:
+            start_time = self._pending_names.pop(channel, None)
+            members = self._channels.get(channel)
+            exempt_members = self._exempt_members.get(channel)
+
+            if start_time is None:
+                return
+
+            for username, last_seen in list((exempt_members or {}).items()):
+                if last_seen < start_time:
+                    del exempt_members[username]
+
+            if not members:
+                return
+
+            while members:
+                user_id, last_seen = next(iter(members.items()))
+
+                if last_seen >= start_time:
+                    break
+
+                del members[user_id]
+                self._release_user_id(user_id)
+
+    def contains(self, channel: str, username: str) -> bool:
+        with self._lock:
+            if username in self._exempt_usernames:
+                return username in self._exempt_members.get(channel, ())
+
+            members = self._channels.get(channel)
+            user_id = self._user_ids.get(username)
+
+            if members is None or user_id is None:
+                return False
+
+            last_seen = members.get(user_id)
+
+            return last_seen is not None and \
+                last_seen > self._clock() - self._ttl
+
+    def count(self, channel: str) -> int:
+        with self._lock:
+            members = self._channels.get(channel)
+            exempt_count = len(self._exempt_members.get(channel, ()))
+
+            if not members:
+                return exempt_count
+
+            self._expire(members, self._clock())
+
+            return len(members) + exempt_count
@@ -0,0 +1,93 @@
+import unittest
+
+from chatbot383.membership import MembershipStore
+
+
+class TestMembershipStore(unittest.TestCase):
+    def setUp(self):
+        self.time_now = 1000.0
+        self.store = MembershipStore(ttl=60, max_channel_users=5,
+                                     clock=lambda: self.time_now)
+
+    def test_join_part(self):
+        self.store.seen('#a', 'user1')
+        self.store.seen('#a', 'user2')
+        self.store.seen('#b', 'user1')
+
+        self.assertEqual(2, self.store.count('#a'))
+        self.assertEqual(1, self.store.count('#b'))
+        self.assertEqual(0, self.store.count('#c'))
+        self.assertTrue(self.store.contains('#a', 'user2'))
+        self.assertEqual(2, len(self.store))
+
+        self.store.part('#a', 'user2')
+        self.store.part('#a', 'nobody')
+
+        self.assertFalse(self.store.contains('#a', 'user2'))
+        self.assertEqual(1, self.store.count('#a'))
+        self.assertEqual(1, len(self.store))
+
+        self.store.clear('#a')
+        self.store.clear('#b')
+
+        self.assertEqual(0, len(self.store))
+
+    def test_ttl(self):
+        self.store.seen('#a', 'user1')
+        self.time_now += 30
+        self.store.seen('#a', 'user2')
+        self.time_now += 40
+
+        self.assertFalse(self.store.contains('#a', 'user1'))
+        self.assertTrue(self.store.contains('#a', 'user2'))
+        self.assertEqual(1, self.store.count('#a'))
+        self.assertEqual(1, len(self.store))
+
+    def test_max_channel_users(self):
+        for index in range(10):
+            self.store.seen('#a', 'user{}'.format(index))
+
+        self.assertEqual(5, self.store.count('#a'))
+        self.assertTrue(self.store.contains('#a', 'user9'))
+        self.assertFalse(self.store.contains('#a', 'user0'))
+
+    def test_user_ids_reused(self):
+        self.store.seen('#a', 'user1')
+        self.store.part('#a', 'user1')
+        self.store.seen('#a', 'user2')
+
+        self.assertEqual(1, len(self.store._usernames))
+
+    def test_names(self):
+        self.store.seen('#a', 'stale')
+        self.time_now += 1
+        self.store.add_names('#a', ['user1', 'user2'])
+        self.store.seen('#a', 'talker')
+        self.store.add_names('#a', ['user3'])
+        self.store.end_names('#a')
+
+        self.assertEqual(4, self.store.count('#a'))
+        self.assertFalse(self.store.contains('#a', 'stale'))
+        self.assertTrue(self.store.contains('#a', 'user3'))
+
+    def test_exempt(self):
+        store = MembershipStore(ttl=60, exempt_usernames=['quietbot'],
+                                clock=lambda: self.time_now)
+        store.seen('#a', 'quietbot')
+        store.seen('#a', 'user1')
+        self.time_now += 3600
+
+        self.assertTrue(store.contains('#a', 'quietbot'))
+        self.assertFalse(store.contains('#a', 'user1'))
+        self.assertEqual(1, store.count('#a'))
+
+        store.add_names('#a', ['user1'])
+        store.end_names('#a')
+
+        self.assertFalse(store.contains('#a', 'quietbot'))
+
+        store.seen('#a', 'quietbot')
+        store.part('#a', 'quietbot')
+
+        self.assertFalse(store.contains('#a', 'quietbot'))
+        self.assertEqual(1, len(store))
@@ -0,0 +1,409 @@
+"""Counters, gauges, and latency histograms in the Prometheus text format.
+
+Metrics are created once at import time and updated with ``inc()``,
+``set()``, or ``observe()`` on a labelled child. The registry can be
+written to a file periodically or served on a local HTTP port.
+"""
+import abc
+import bisect
+import http.server
+import logging
+import math
+import os
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0
+)
+# Label value used for every label once a metric has `max_children`
+OVERFLOW_LABEL = 'other'
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    elif value == -math.inf:
+        return '-Inf'
+    elif value != value:
+        return 'NaN'
+    elif float(value).is_integer():
+        return str(int(value))
+    else:
+        return repr(float(value))
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()) -> str:
+    pairs = list(zip(names, values)) + list(extra)
+
+    if not pairs:
+        return ''
+
+    return '{' + ','.join(
+        '{}="{}"'.format(name, _escape_label_value(str(value)))
+        for name, value in pairs
+    ) + '}'
+
+
+class _CounterChild(object):
+    __slots__ = ('_value', '_lock')
+
+    def __init__(self):
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float=1):
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self) -> float:
+        return self._value
+
+
+class _GaugeChild(object):
+    __slots__ = ('_value', '_function')
+
+    def __init__(self):
+        self._value = 0.0
+        self._function = None
+
+    def set(self, value: float):
+        self._value = value
+
+    def set_function(self, function):
+        """Read the value from `function` when the metrics are collected."""
+        self._function = function
+
+    @property
+    def value(self) -> float:
+        if self._function:
+            try:
+                return self._function()
+            except Exception:
+                _logger.exception('Gauge function failed')
+                return math.nan
+
+        return self._value
+
+
+class _HistogramChild(object):
+    __slots__ = ('_upper_bounds', '_counts', '_sum', '_lock')
+
+    def __init__(self, upper_bounds):
+        self._upper_bounds = upper_bounds
+        self._counts = [0] * (len(upper_bounds) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self._upper_bounds, value)
+
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def time(self) -> '_Timer':
+        return _Timer(self)
+
+    def snapshot(self):
+        with self._lock:
+            return list(self._counts), self._sum
+
+
+class _Timer(object):
+    __slots__ = ('_child', '_start_time')
+
+    def __init__(self, child: _HistogramChild):
+        self._child = child
+        self._start_time = None
+
+    def __enter__(self):
+        self._start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._child.observe(time.perf_counter() - self._start_time)
+
+
+class _Metric(abc.ABC):
+    """A metric with one child per set of label values.
+
+    If `max_children` is given, label values seen after that many
+    children exist are all counted under `OVERFLOW_LABEL`.
+    """
+    metric_type = None
+
+    def __init__(self, name: str, documentation: str, labelnames=(),
+                 max_children: int=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.max_children = max_children
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        if len(values) != len(self.labelnames):
+            raise ValueError('Expected {} label values for {}'
+                             .format(len(self.labelnames), self.name))
+
+        child = self._children.get(values)
+
+        if child is None:
+            with self._lock:
+                child = self._children.get(values)
+
+                if child is None and self.max_children is not None and \
+                        len(self._children) >= self.max_children:
+                    values = (OVERFLOW_LABEL,) * len(values)
+                    child = self._children.get(values)
+
+                if child is None:
+                    child = self._children[values] = self._new_child()
+
+        return child
+
+    def remove(self, *values):
+        with self._lock:
+            self._children.pop(values, None)
+
+    @abc.abstractmethod
+    def _new_child(self):
+        pass
+
+    @abc.abstractmethod
+    def _render_samples(self, label_values, child):
+        pass
+
+    def render(self) -> list:
+        lines = [
+            '# HELP {} {}'.format(self.name, self.documentation),
+            '# TYPE {} {}'.format(self.name, self.metric_type),
+        ]
+
+        with self._lock:
+            children = sorted(self._children.items())
+
+        for label_values, child in children:
+            lines.extend(self._render_samples(label_values, child))
+
+        return lines
+
+
+class Counter(_Metric):
+    metric_type = 'counter'
+
+    def inc(self, amount: float=1):
+        self.labels().inc(amount)
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def _render_samples(self, label_values, child):
+        yield '{}{} {}'.format(
+            self.name, _format_labels(self.labelnames, label_values),
+            _format_value(child.value))
+
+
+class Gauge(_Metric):
+    metric_type = 'gauge'
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def _render_samples(self, label_values, child):
+        yield '{}{} {}'.format(
+            self.name, _format_labels(self.labelnames, label_values),
+            _format_value(child.value))
+
+
+class Histogram(_Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames=(),
+                 buckets=DEFAULT_LATENCY_BUCKETS, max_children: int=None):
+        super().__init__(name, documentation, labelnames, max_children)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def _render_samples(self, label_values, child):
+        counts, total = child.snapshot()
+        cumulative_count = 0
+
+        for upper_bound, count in zip(self.buckets + (math.inf,), counts):
+            cumulative_count += count
+            yield '{}_bucket{} {}'.format(
+                self.name,
+                _format_labels(self.labelnames, label_values,
+                               [('le', _format_value(upper_bound))]),
+                cumulative_count)
+
+        labels = _format_labels(self.labelnames, label_values)
+        yield '{}_sum{} {}'.format(self.name, labels, _format_value(total))
+        yield '{}_count{} {}'.format(self.name, labels, cumulative_count)
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric: _Metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError('Metric {} already registered'
+                                 .format(metric.name))
+
+            self._metrics[metric.name] = metric
+
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames=(),
+                max_children: int=None) -> Counter:
+        return self._register(
+            Counter(name, documentation, labelnames, max_children))
+
+    def gauge(self, name: str, documentation: str, labelnames=(),
+              max_children: int=None) -> Gauge:
+        return self._register(
+            Gauge(name, documentation, labelnames, max_children))
+
+    def histogram(self, name: str, documentation: str, labelnames=(),
+                  buckets=DEFAULT_LATENCY_BUCKETS,
+                  max_children: int=None) -> Histogram:
+        return self._register(
+            Histogram(name, documentation, labelnames, buckets, max_children))
+
+    def get(self, name: str) -> _Metric:
+        return self._metrics[name]
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+
+        lines = []
+
+        for dummy, metric in metrics:
+            lines.extend(metric.render())
+
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+MESSAGES_PROCESSED = REGISTRY.counter(
+    'chatbot_messages_processed_total', 'Inbound events processed.',
+    ['event_type'])
+COMMAND_LATENCY = REGISTRY.histogram(
+    'chatbot_command_seconds', 'Time spent in command handlers.',
+    ['command'])
+COMMAND_ERRORS = REGISTRY.counter(
+    'chatbot_command_errors_total', 'Command handlers that raised.',
+    ['command'])
+# Channels and whisper targets are unbounded, so only the first ones seen
+# get their own series
+COMMANDS_BY_CHANNEL = REGISTRY.counter(
+    'chatbot_channel_commands_total', 'Commands run per channel.',
+    ['channel'], max_children=200)
+HANDLER_LATENCY = REGISTRY.histogram(
+    'chatbot_handler_seconds', 'Time spent in message handlers.',
+    ['handler'])
+DISPATCH_PATTERNS_TESTED = REGISTRY.histogram(
+    'chatbot_dispatch_patterns_tested', 'Command patterns tested per message.',
+    buckets=(0, 1, 2, 4, 8, 16, 32, 64))
+COMMANDS_DROPPED = REGISTRY.counter(
+    'chatbot_commands_dropped_total',
+    'Blocking commands dropped because the worker pool was full.')
+LINES_DISCARDED = REGISTRY.counter(
+    'chatbot_lines_discarded_total', 'Outbound lines discarded by the bot.',
+    ['reason'])
+QUEUE_DEPTH = REGISTRY.gauge(
+    'chatbot_queue_depth', 'Items waiting in a queue.', ['queue'])
+OUTBOUND_SENT = REGISTRY.counter(
+    'chatbot_outbound_sent_total', 'Outbound IRC commands sent.',
+    ['client', 'message_type'])
+OUTBOUND_DROPPED = REGISTRY.counter(
+    'chatbot_outbound_dropped_total',
+    'Outbound items dropped because the lane was full or disconnected.',
+    ['client', 'lane'])
+REGEX_WORKER_KILLS = REGISTRY.counter(
+    'chatbot_regex_worker_kills_total',
+    'Regex sandbox processes killed after a timeout.')
+REGEX_WORKER_RESPAWNS = REGISTRY.counter(
+    'chatbot_regex_worker_respawns_total',
+    'Regex sandbox processes replaced.')
+REGEX_EVALUATIONS = REGISTRY.counter(
+    'chatbot_regex_evaluations_total',
+    'Regex substitutions by where they were evaluated.', ['where'])
+HISTORY_BYTES = REGISTRY.gauge(
+    'chatbot_history_bytes',
+    'Estimated memory used by the correction history.', ['channel'])
+DATABASE_QUERY_LATENCY = REGISTRY.histogram(
+    'chatbot_database_query_seconds', 'Time spent running database queries.',
+    ['query'])
+DATABASE_MAINTENANCE_ROWS = REGISTRY.counter(
+    'chatbot_database_maintenance_rows_total',
+    'Mail rows archived or expired by database maintenance.', ['action'])
+
+
+def write_file(path: str, registry: Registry=REGISTRY):
+    # Write to a temporary file first so readers never see a partial file
+    temp_path = '{}.tmp'.format(path)
+
+    with open(temp_path, 'w') as file:
+        file.write(registry.render())
+
+    os.replace(temp_path, path)
+
+
+class _MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = self.registry.render().encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        _logger.debug(format, *args)
+
+
+def start_http_server(port: int, host: str='127.0.0.1',
+                      registry: Registry=REGISTRY) -> http.server.HTTPServer:
+    """Serve ``/metrics`` from a daemon thread."""
+    handler_class = type('MetricsRequestHandler', (_MetricsRequestHandler,),
+                         {'registry': registry})
+    server = http.server.ThreadingHTTPServer((host, port), handler_class)
+    server.daemon_threads = True
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True,
+                              name='metrics-http')
+    thread.start()
+
+    _logger.info('Serving metrics on http://%s:%s/metrics', host, port)
+
+    return server
@@ -0,0 +1,93 @@
+import os
+import tempfile
+import unittest
+import urllib.request
+
+from chatbot383.metrics import Registry, write_file, start_http_server
+
+
+class TestMetrics(unittest.TestCase):
+    def test_counter_gauge(self):
+        registry = Registry()
+        counter = registry.counter('test_total', 'Test counter.', ['kind'])
+        gauge = registry.gauge('test_depth', 'Test gauge.')
+
+        counter.labels('a').inc()
+        counter.labels('a').inc(2)
+        counter.labels('b"\n').inc()
+        gauge.set(5)
+
+        text = registry.render()
+
+        self.assertIn('# TYPE test_total counter\n', text)
+        self.assertIn('test_total{kind="a"} 3\n', text)
+        self.assertIn('test_total{kind="b\\"\\n"} 1\n', text)
+        self.assertIn('test_depth 5\n', text)
+
+        gauge.labels().set_function(lambda: 7)
+
+        self.assertIn('test_depth 7\n', registry.render())
+
+    def test_histogram(self):
+        registry = Registry()
+        histogram = registry.histogram(
+            'test_seconds', 'Test histogram.', ['command'],
+            buckets=(0.1, 1.0))
+
+        histogram.labels('x').observe(0.05)
+        histogram.labels('x').observe(0.1)
+        histogram.labels('x').observe(0.5)
+        histogram.labels('x').observe(3)
+
+        text = registry.render()
+
+        self.assertIn('test_seconds_bucket{command="x",le="0.1"} 2\n', text)
+        self.assertIn('test_seconds_bucket{command="x",le="1"} 3\n', text)
+        self.assertIn('test_seconds_bucket{command="x",le="+Inf"} 4\n', text)
+        self.assertIn('test_seconds_sum{command="x"} 3.65\n', text)
+        self.assertIn('test_seconds_count{command="x"} 4\n', text)
+
+    def test_label_count(self):
+        registry = Registry()
+        counter = registry.counter('test_total', 'Test counter.', ['kind'])
+
+        self.assertRaises(ValueError, counter.labels)
+        self.assertRaises(ValueError, registry.counter, 'test_total', '')
+
+    def test_max_children(self):
+        registry = Registry()
+        counter = registry.counter('test_total', 'Test counter.', ['channel'],
+                                   max_children=2)
+
+        for channel in ('#a', '#b', '#c', '#d', '#a'):
+            counter.labels(channel).inc()
+
+        text = registry.render()
+
+        self.assertIn('test_total{channel="#a"} 2\n', text)
+        self.assertIn('test_total{channel="#b"} 1\n', text)
+        self.assertIn('test_total{channel="other"} 2\n', text)
+        self.assertNotIn('#c', text)
+
+    def test_export(self):
+        registry = Registry()
+        registry.counter('test_total', 'Test counter.').inc()
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'metrics.prom')
+            write_file(path, registry)
+
+            with open(path) as file:
+                self.assertEqual(registry.render(), file.read())
+
+        server = start_http_server(0, registry=registry)
+
+        try:
+            url = 'http://127.0.0.1:{}/metrics'.format(server.server_address[1])
+
+            with urllib.request.urlopen(url) as response:
+                self.assertEqual(registry.render(),
+                                 response.read().decode('utf-8'))
+        finally:
+            server.shutdown()
+            server.server_close()
@@ -0,0 +1,271 @@
+import collections
+import logging
+import threading
+import time
+
+from chatbot383.ratelimit import BucketSpec, TokenBucket
+
+_logger = logging.getLogger(__name__)
+
+# Twitch allows 20 messages per 30 seconds, or 100 in channels where the
+# account is a moderator. Buckets are sized so that the burst plus the
+# refill over the window stays under the limit.
+TWITCH_NORMAL_LIMIT = BucketSpec(5, (20 - 5 - 1) / 30)
+TWITCH_MODERATOR_LIMIT = BucketSpec(20, (100 - 20 - 2) / 30)
+TWITCH_CHANNEL_LIMIT = BucketSpec(1, 1.0)
+TWITCH_WHISPER_SECOND_LIMIT = BucketSpec(3, 3.0)
+TWITCH_WHISPER_MINUTE_LIMIT = BucketSpec(10, (100 - 10 - 2) / 60)
+TWITCH_JOIN_LIMIT = BucketSpec(10, (20 - 10 - 1) / 10)
+
+LANES = ('control', 'whisper', 'reply', 'announcement')
+COALESCE_LANES = frozenset(['reply', 'announcement'])
+COALESCE_SEPARATOR = ' · '
+
+
+class AccountRateLimiter(object):
+    """Rate limits for one account, shared by all of its connections."""
+    def __init__(self, normal_limit: BucketSpec=TWITCH_NORMAL_LIMIT,
+                 moderator_limit: BucketSpec=TWITCH_MODERATOR_LIMIT,
+                 channel_limit: BucketSpec=TWITCH_CHANNEL_LIMIT,
+                 whisper_limits=(TWITCH_WHISPER_SECOND_LIMIT,
+                                 TWITCH_WHISPER_MINUTE_LIMIT),
+                 join_limit: BucketSpec=TWITCH_JOIN_LIMIT,
+                 clock=time.monotonic):
+        self._clock = clock
+        self._channel_limit = channel_limit
+        self._normal_bucket = TokenBucket.from_spec(normal_limit, clock)
+        self._moderator_bucket = TokenBucket.from_spec(moderator_limit, clock)
+        self._whisper_buckets = tuple(
+            TokenBucket.from_spec(spec, clock) for spec in whisper_limits)
+        self._join_bucket = TokenBucket.from_spec(join_limit, clock)
+        self._channel_buckets = {}
+        self._moderator_channels = set()
+        self._lock = threading.Lock()
+
+    def set_moderator(self, channel: str, moderator: bool):
+        with self._lock:
+            if moderator:
+                self._moderator_channels.add(channel)
+            else:
+                self._moderator_channels.discard(channel)
+
+    def is_moderator(self, channel: str) -> bool:
+        return channel in self._moderator_channels
+
+    @property
+    def max_join_batch(self) -> int:
+        """The most channels one JOIN can name and still be sendable."""
+        return max(1, int(self._join_bucket.capacity))
+
+    def _get_channel_bucket(self, channel: str) -> TokenBucket:
+        bucket = self._channel_buckets.get(channel)
+
+        if not bucket:
+            bucket = self._channel_buckets[channel] = \
+                TokenBucket.from_spec(self._channel_limit, self._clock)
+
+        return bucket
+
+    def _get_buckets(self, item: dict, lane: str):
+        message_type = item['message_type']
+
+        if message_type == 'join':
+            return (self._join_bucket,), item['channel'].count(',') + 1
+        elif message_type != 'privmsg':
+            return (), 1
+        elif lane == 'whisper':
+            return self._whisper_buckets, 1
+
+        target = item['target']
+
+        if target in self._moderator_channels:
+            return (self._moderator_bucket,), 1
+        else:
+            return (self._normal_bucket, self._moderator_bucket,
+                    self._get_channel_bucket(target)), 1
+
+    def acquire(self, item: dict, lane: str) -> float:
+        """Take the tokens needed to send the item.
+
+        Returns 0 if the item can be sent now, otherwise the number of
+        seconds to wait before trying again.
+        """
+        with self._lock:
+            buckets, amount = self._get_buckets(item, lane)
+
+            wait_time = max(
+                (bucket.time_until_available(amount) for bucket in buckets),
+                default=0.0
+            )
+
+            if wait_time > 0:
+                return wait_time
+
+            for bucket in buckets:
+                bucket.consume(amount)
+
+            return 0.0
+
+
+class OutboundScheduler(object):
+    """Queues outbound items in priority lanes and releases them when
+    the rate limits allow.
+
+    Enqueueing never blocks; it returns False when the lane is full.
+
+    If `coalesce` is True, queued chat lines for the same target are
+    joined into one message when they fit within the item's
+    ``max_length`` and ``max_byte_length``.
+    """
+    def __init__(self, rate_limiter: AccountRateLimiter=None,
+                 max_lane_size: int=50, max_scan: int=20,
+                 coalesce: bool=False):
+        self._rate_limiter = rate_limiter or AccountRateLimiter()
+        self._max_lane_size = max_lane_size
+        self._max_scan = max_scan
+        self._coalesce = coalesce
+        self._lanes = collections.OrderedDict(
+            (lane, collections.deque()) for lane in LANES)
+        self._lock = threading.Lock()
+
+    @property
+    def rate_limiter(self) -> AccountRateLimiter:
+        return self._rate_limiter
+
+    def __len__(self):
+        return sum(len(lane_queue) for lane_queue in self._lanes.values())
+
+    def enqueue(self, item: dict, lane: str='reply') -> bool:
+        items = self._split_item(item)
+
+        with self._lock:
+            lane_queue = self._lanes[lane]
+
+            if len(lane_queue) + len(items) > self._max_lane_size:
+                return False
+
+            lane_queue.extend(items)
+            return True
+
+    def _split_item(self, item: dict):
+        # A JOIN costs one token per channel, so a batch larger than the
+        # join bucket could never be sent
+        if item['message_type'] != 'join':
+            return [item]
+
+        channels = item['channel'].split(',')
+        batch_size = self._rate_limiter.max_join_batch
+
+        if len(channels) <= batch_size:
+            return [item]
+
+        items = []
+
+        for index in range(0, len(channels), batch_size):
+            new_item = dict(item)
+            new_item['channel'] = ','.join(channels[index:index + batch_size])
+            items.append(new_item)
+
+        return items
+
+    def pop_ready(self):
+        """Return an item that can be sent now.
+
+        Returns a tuple (item, wait_time). If no item can be sent, item is
+        None and wait_time is the number of seconds until one might be
+        sendable or None if there are no items.
+        """
+        min_wait_time = None
+
+        with self._lock:
+            for lane, lane_queue in self._lanes.items():
+                blocked_targets = set()
+
+                for index, item in enumerate(lane_queue):
+                    if index >= self._max_scan:
+                        break
+
+                    # Keep items to the same target in order
+                    target = item.get('target') or item.get('channel')
+
+                    if target in blocked_targets:
+                        continue
+
+                    wait_time = self._rate_limiter.acquire(item, lane)
+
+                    if not wait_time:
+                        del lane_queue[index]
+
+                        if self._coalesce and lane in COALESCE_LANES:
+                            item = self._coalesce_item(item, lane_queue, index)
+
+                        return item, 0.0
+
+                    blocked_targets.add(target)
+
+                    if min_wait_time is None or wait_time < min_wait_time:
+                        min_wait_time = wait_time
+
+        return None, min_wait_time
+
+    @classmethod
+    def _can_coalesce(cls, item: dict) -> bool:
+        return item['message_type'] == 'privmsg' and \
+            not item['format_action'] and \
+            item.get('max_length') and item.get('max_byte_length')
+
+    def _coalesce_item(self, item: dict, lane_queue: collections.deque,
+                       start_index: int) -> dict:
+        if not self._can_coalesce(item):
+            return item
+
+        target = item['target']
+        texts = [item['text']]
+        text_length = len(item['text'])
+        byte_length = len(item['text'].encode('utf-8', 'replace'))
+        max_length = item['max_length']
+        max_byte_length = item['max_byte_length']
+        separator_byte_length = len(COALESCE_SEPARATOR.encode('utf-8'))
+        index = start_index
+
+        while index < min(len(lane_queue), start_index + self._max_scan):
+            other_item = lane_queue[index]
+
+            if other_item.get('target') != target:
+                index += 1
+                continue
+
+            if not self._can_coalesce(other_item):
+                break
+
+            other_text = other_item['text']
+            new_text_length = \
+                text_length + len(COALESCE_SEPARATOR) + len(other_text)
+            new_byte_length = byte_length + separator_byte_length + \
+                len(other_text.encode('utf-8', 'replace'))
+            new_max_length = min(max_length, other_item['max_length'])
+            new_max_byte_length = min(
+                max_byte_length, other_item['max_byte_length'])
+
+            if new_text_length > new_max_length or \
+                    new_byte_length > new_max_byte_length:
+                break
+
+            texts.append(other_text)
+            text_length = new_text_length
+            byte_length = new_byte_length
+            max_length = new_max_length
+            max_byte_length = new_max_byte_length
+            del lane_queue[index]
+
+        if len(texts) == 1:
+            return item
+
+        _logger.debug('Coalesced %s lines to %s', len(texts), ascii(target))
+
+        item = dict(item)
+        item['text'] = COALESCE_SEPARATOR.join(texts)
+        item['max_length'] = max_length
+        item['max_byte_length'] = max_byte_length
+
+        return item
@@ -0,0 +1,136 @@
+import unittest
+
+from chatbot383.outbound import AccountRateLimiter, OutboundScheduler
+from chatbot383.ratelimit import BucketSpec
+from chatbot383.testing import FakeClock
+
+
+def privmsg(target, text):
+    return {
+        'message_type': 'privmsg',
+        'target': target,
+        'text': text,
+        'format_action': False
+    }
+
+
+class TestOutboundScheduler(unittest.TestCase):
+    def _new_scheduler(self, clock, **kwargs):
+        rate_limiter = AccountRateLimiter(
+            normal_limit=BucketSpec(3, 0.1),
+            channel_limit=BucketSpec(1, 1.0),
+            clock=clock
+        )
+        return OutboundScheduler(rate_limiter, **kwargs)
+
+    def test_channel_limit_keeps_order(self):
+        clock = FakeClock(1000.0)
+        scheduler = self._new_scheduler(clock)
+
+        scheduler.enqueue(privmsg('#a', 'a1'))
+        scheduler.enqueue(privmsg('#a', 'a2'))
+        scheduler.enqueue(privmsg('#b', 'b1'))
+
+        item, wait_time = scheduler.pop_ready()
+        self.assertEqual('a1', item['text'])
+
+        item, wait_time = scheduler.pop_ready()
+        self.assertEqual('b1', item['text'])
+
+        item, wait_time = scheduler.pop_ready()
+        self.assertIsNone(item)
+        self.assertAlmostEqual(1.0, wait_time)
+
+        clock.time += 1
+        item, wait_time = scheduler.pop_ready()
+        self.assertEqual('a2', item['text'])
+
+        item, wait_time = scheduler.pop_ready()
+        self.assertIsNone(item)
+        self.assertIsNone(wait_time)
+
+    def test_priority_lanes(self):
+        clock = FakeClock(1000.0)
+        scheduler = self._new_scheduler(clock)
+
+        scheduler.enqueue(privmsg('#a', 'announce'), lane='announcement')
+        scheduler.enqueue(privmsg('#b', 'reply'), lane='reply')
+        scheduler.enqueue(privmsg('#jtv', '/w someone hi'), lane='whisper')
+
+        texts = [scheduler.pop_ready()[0]['text'] for dummy in range(3)]
+        self.assertEqual(['/w someone hi', 'reply', 'announce'], texts)
+
+    def test_moderator(self):
+        clock = FakeClock(1000.0)
+        scheduler = self._new_scheduler(clock)
+        scheduler.rate_limiter.set_moderator('#a', True)
+
+        for index in range(10):
+            scheduler.enqueue(privmsg('#a', str(index)))
+
+        for index in range(10):
+            item, wait_time = scheduler.pop_ready()
+            self.assertEqual(str(index), item['text'])
+
+    def test_overflow(self):
+        clock = FakeClock(1000.0)
+        scheduler = self._new_scheduler(clock, max_lane_size=2)
+
+        self.assertTrue(scheduler.enqueue(privmsg('#a', '1')))
+        self.assertTrue(scheduler.enqueue(privmsg('#a', '2')))
+        self.assertFalse(scheduler.enqueue(privmsg('#a', '3')))
+        self.assertTrue(scheduler.enqueue(privmsg('#a', '3'), lane='announcement'))
+        self.assertEqual(3, len(scheduler))
+
+    def test_coalesce(self):
+        clock = FakeClock(1000.0)
+        scheduler = self._new_scheduler(clock, coalesce=True)
+
+        def limited_privmsg(target, text, max_length=30):
+            item = privmsg(target, text)
+            item['max_length'] = max_length
+            item['max_byte_length'] = max_length
+            return item
+
+        scheduler.enqueue(limited_privmsg('#a', 'one'))
+        scheduler.enqueue(limited_privmsg('#b', 'other'))
+        scheduler.enqueue(limited_privmsg('#a', 'two'))
+        scheduler.enqueue(limited_privmsg('#a', 'x' * 25))
+        scheduler.enqueue(limited_privmsg('#a', 'three'))
+
+        item, wait_time = scheduler.pop_ready()
+        self.assertEqual('one · two', item['text'])
+
+        item, wait_time = scheduler.pop_ready()
+        self.assertEqual('other', item['text'])
+
+        clock.time += 1
+        item, wait_time = scheduler.pop_ready()
+        self.assertEqual('x' * 25, item['text'])
+        self.assertEqual(1, len(scheduler))
+
+    def test_large_join(self):
+        clock = FakeClock(1000.0)
+        rate_limiter = AccountRateLimiter(
+            join_limit=BucketSpec(3, 1.0), clock=clock)
+        scheduler = OutboundScheduler(rate_limiter)
+        channels = ['#c{}'.format(index) for index in range(7)]
+
+        scheduler.enqueue(
+            {'message_type': 'join', 'channel': ','.join(channels)},
+            lane='control')
+        self.assertEqual(3, len(scheduler))
+
+        joined = []
+
+        for dummy in range(10):
+            item, wait_time = scheduler.pop_ready()
+
+            if item:
+                joined.extend(item['channel'].split(','))
+            elif wait_time is None:
+                break
+            else:
+                clock.time += wait_time
+
+        self.assertEqual(sorted(channels), sorted(joined))
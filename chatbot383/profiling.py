@@ -0,0 +1,280 @@
+"""Profiling of message processing and command handlers.
+
+Calls wrapped with `Profiler.call` are recorded by cProfile while
+profiling is on, and a background thread samples the stacks of all
+threads. Dumps are written as pstats files and as collapsed stacks that
+flamegraph tools accept.
+
+Independently of that, if `slow_threshold` is set, the stack of any
+wrapped call running longer than the threshold is written to the slow
+call log while it is still running.
+"""
+import collections
+import cProfile
+import datetime
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import traceback
+
+_logger = logging.getLogger(__name__)
+
+SLOW_CALL_FILENAME = 'slow_calls.txt'
+
+
+class _InFlightCall(object):
+    __slots__ = ('name', 'start_time', 'reported', 'parent')
+
+    def __init__(self, name: str, start_time: float, parent):
+        self.name = name
+        self.start_time = start_time
+        self.reported = False
+        self.parent = parent
+
+
+class Profiler(object):
+    def __init__(self, output_dir: str='.', slow_threshold: float=None,
+                 sample_interval: float=0.005):
+        self._output_dir = output_dir
+        self._slow_threshold = slow_threshold
+        self._sample_interval = sample_interval
+        self._enabled = False
+        self._profile = None
+        self._profile_lock = threading.Lock()
+        self._thread_local = threading.local()
+        self._stack_counts = collections.Counter()
+        self._stack_lock = threading.Lock()
+        self._in_flight = {}
+        self._monitor_thread = None
+        self._running = False
+
+    @property
+    def enabled(self) -> bool:
+        return self._enabled
+
+    def start_monitor(self):
+        if self._monitor_thread:
+            return
+
+        self._running = True
+        self._monitor_thread = threading.Thread(
+            target=self._monitor_loop, daemon=True, name='profiler')
+        self._monitor_thread.start()
+
+    def stop_monitor(self):
+        self._running = False
+
+        if self._monitor_thread:
+            self._monitor_thread.join()
+            self._monitor_thread = None
+
+    def start(self):
+        """Start collecting cProfile data and stack samples."""
+        if self._enabled:
+            return
+
+        _logger.info('Profiling started')
+
+        with self._profile_lock:
+            self._profile = cProfile.Profile()
+
+        with self._stack_lock:
+            self._stack_counts.clear()
+
+        self._enabled = True
+        self.start_monitor()
+
+    def stop(self) -> list:
+        """Stop profiling and write the dumps.
+
+        Returns the paths of the files written.
+        """
+        if not self._enabled:
+            return []
+
+        self._enabled = False
+
+        with self._profile_lock:
+            profile = self._profile
+            self._profile = None
+
+        if not self._slow_threshold:
+            self.stop_monitor()
+
+        timestamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+        os.makedirs(self._output_dir, exist_ok=True)
+        pstats_path = os.path.join(
+            self._output_dir, 'profile-{}.pstats'.format(timestamp))
+        collapsed_path = os.path.join(
+            self._output_dir, 'profile-{}.collapsed'.format(timestamp))
+        paths = []
+
+        try:
+            pstats.Stats(profile).dump_stats(pstats_path)
+            paths.append(pstats_path)
+        except TypeError:
+            # Stats() raises if nothing was recorded
+            _logger.info('No cProfile data recorded')
+
+        with self._stack_lock:
+            stack_counts = sorted(self._stack_counts.items())
+
+        with open(collapsed_path, 'w') as file:
+            for stack, count in stack_counts:
+                file.write('{} {}\n'.format(stack, count))
+
+        paths.append(collapsed_path)
+
+        _logger.info('Profiling stopped. Wrote %s', ', '.join(paths))
+
+        return paths
+
+    def toggle(self) -> list:
+        if self._enabled:
+            return self.stop()
+        else:
+            self.start()
+            return []
+
+    def call(self, name: str, func, *args):
+        if not self._enabled and not self._slow_threshold:
+            return func(*args)
+
+        thread_id = threading.get_ident()
+        parent = self._in_flight.get(thread_id)
+        self._in_flight[thread_id] = _InFlightCall(
+            name, time.perf_counter(), parent)
+
+        try:
+            if self._enabled:
+                return self._call_cprofile(func, args)
+            else:
+                return func(*args)
+        finally:
+            if parent:
+                self._in_flight[thread_id] = parent
+            else:
+                del self._in_flight[thread_id]
+
+    def _call_cprofile(self, func, args):
+        # A cProfile.Profile can only run on one thread at a time. Other
+        # threads are still covered by the stack sampler.
+        if getattr(self._thread_local, 'profiling', False):
+            return func(*args)
+
+        if not self._profile_lock.acquire(blocking=False):
+            return func(*args)
+
+        try:
+            profile = self._profile
+
+            if not profile:
+                return func(*args)
+
+            self._thread_local.profiling = True
+
+            try:
+                return profile.runcall(func, *args)
+            finally:
+                self._thread_local.profiling = False
+        finally:
+            self._profile_lock.release()
+
+    def _monitor_loop(self):
+        while self._running:
+            if self._enabled:
+                self._sample_stacks()
+                interval = self._sample_interval
+            else:
+                interval = max(0.05, (self._slow_threshold or 1) / 4)
+
+            if self._slow_threshold:
+                self._check_slow_calls()
+
+            time.sleep(interval)
+
+    def _sample_stacks(self):
+        our_thread_id = threading.get_ident()
+        thread_names = dict(
+            (thread.ident, thread.name) for thread in threading.enumerate())
+        samples = []
+
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == our_thread_id:
+                continue
+
+            samples.append(self.collapse_stack(
+                frame, thread_names.get(thread_id, str(thread_id))))
+
+        with self._stack_lock:
+            self._stack_counts.update(samples)
+
+    @classmethod
+    def collapse_stack(cls, frame, root_name: str) -> str:
+        names = []
+
+        while frame:
+            code = frame.f_code
+            names.append('{}:{}'.format(
+                os.path.basename(code.co_filename), code.co_name))
+            frame = frame.f_back
+
+        names.append(root_name)
+        names.reverse()
+
+        return ';'.join(name.replace(';', ':').replace(' ', '_')
+                        for name in names)
+
+    def _check_slow_calls(self):
+        time_now = time.perf_counter()
+        frames = None
+
+        for thread_id, call in list(self._in_flight.items()):
+            # Report the innermost slow call, and only once per stack
+            chain = []
+
+            while call:
+                chain.append(call)
+                call = call.parent
+
+            if any(call.reported for call in chain):
+                continue
+
+            for call in chain:
+                elapsed = time_now - call.start_time
+
+                if elapsed >= self._slow_threshold:
+                    break
+            else:
+                continue
+
+            if frames is None:
+                frames = sys._current_frames()
+
+            frame = frames.get(thread_id)
+
+            if not frame:
+                continue
+
+            call.reported = True
+            self._write_slow_call(call.name, elapsed, frame)
+
+    def _write_slow_call(self, name: str, elapsed: float, frame):
+        _logger.warning('Slow call %s still running after %.3f s',
+                        name, elapsed)
+
+        stack_text = ''.join(traceback.format_stack(frame))
+
+        try:
+            os.makedirs(self._output_dir, exist_ok=True)
+
+            with open(os.path.join(self._output_dir, SLOW_CALL_FILENAME),
+                      'a') as file:
+                file.write('{} {} {:.3f}s\n{}\n'.format(
+                    datetime.datetime.now().isoformat(), name, elapsed,
+                    stack_text))
+        except OSError:
+            _logger.exception('Could not write slow call log')
@@ -0,0 +1,63 @@
+import os
+import pstats
+import tempfile
+import time
+import unittest
+
+from chatbot383.profiling import Profiler, SLOW_CALL_FILENAME
+
+
+def _busy_function():
+    return sum(range(10000))
+
+
+class TestProfiler(unittest.TestCase):
+    def test_profile_dump(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            profiler = Profiler(output_dir=temp_dir, sample_interval=0.001)
+            profiler.start()
+
+            for dummy in range(20):
+                profiler.call('busy', _busy_function)
+
+            time.sleep(0.05)
+            paths = profiler.stop()
+
+            self.assertFalse(profiler.enabled)
+            self.assertEqual(2, len(paths))
+
+            stats = pstats.Stats(paths[0])
+            function_names = [key[2] for key in stats.stats]
+            self.assertIn('_busy_function', function_names)
+
+            with open(paths[1]) as file:
+                lines = file.read().splitlines()
+
+            self.assertTrue(lines)
+            stack, count = lines[0].rsplit(' ', 1)
+            self.assertGreater(int(count), 0)
+
+    def test_slow_call(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            profiler = Profiler(output_dir=temp_dir, slow_threshold=0.05)
+            profiler.start_monitor()
+
+            def inner():
+                time.sleep(0.3)
+
+            try:
+                profiler.call('outer', profiler.call, 'inner', inner)
+            finally:
+                profiler.stop_monitor()
+
+            with open(os.path.join(temp_dir, SLOW_CALL_FILENAME)) as file:
+                text = file.read()
+
+            self.assertIn(' inner ', text)
+            self.assertNotIn(' outer ', text)
+            self.assertIn('in inner', text)
+
+    def test_disabled_passthrough(self):
+        profiler = Profiler()
+
+        self.assertEqual(3, profiler.call('add', lambda a, b: a + b, 1, 2))
@@ -0,0 +1,178 @@
+import collections
+import threading
+import time
+
+BucketSpec = collections.namedtuple('BucketSpec', ['capacity', 'rate'])
+
+
+class TokenBucket(object):
+    """Allows bursts of `capacity` and then `rate` tokens per second."""
+    __slots__ = ('capacity', 'rate', '_tokens', '_timestamp', '_clock')
+
+    def __init__(self, capacity: float, rate: float, clock=time.monotonic):
+        self.capacity = capacity
+        self.rate = rate
+        self._tokens = capacity
+        self._clock = clock
+        self._timestamp = clock()
+
+    @classmethod
+    def from_spec(cls, spec: BucketSpec, clock=time.monotonic) -> 'TokenBucket':
+        return cls(spec.capacity, spec.rate, clock=clock)
+
+    def _refill(self, time_now: float):
+        elapsed = time_now - self._timestamp
+
+        if elapsed > 0:
+            self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+            self._timestamp = time_now
+
+    @property
+    def tokens(self) -> float:
+        self._refill(self._clock())
+        return self._tokens
+
+    def is_full(self) -> bool:
+        return self.tokens >= self.capacity
+
+    def time_until_available(self, amount: float=1) -> float:
+        self._refill(self._clock())
+
+        if self._tokens >= amount:
+            return 0.0
+        elif not self.rate:
+            return float('inf')
+
+        return (amount - self._tokens) / self.rate
+
+    def try_consume(self, amount: float=1) -> bool:
+        self._refill(self._clock())
+
+        if self._tokens >= amount:
+            self._tokens -= amount
+            return True
+        else:
+            return False
+
+    def consume(self, amount: float=1):
+        # Allowed to go negative for penalties
+        self._refill(self._clock())
+        self._tokens -= amount
+
+
+class Limiter(object):
+    """Limits how often an action can be done per key.
+
+    A key is allowed `burst` actions and then one action every
+    `min_interval` seconds. The default burst of 1 allows one action per
+    `min_interval`.
+
+    Only the time at which a key's allowance is full again is stored.
+    Keys are kept in update order and dropped once that time has passed,
+    and the oldest keys are dropped when there are more than `max_size`.
+    """
+    _MAX_EXPIRE_PER_CALL = 8
+
+    def __init__(self, min_interval: float=5, burst: int=1,
+                 max_size: int=10000, clock=time.monotonic):
+        self._min_interval = min_interval
+        self._burst = burst
+        self._max_size = max_size
+        self._clock = clock
+        self._table = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def min_interval(self) -> float:
+        return self._min_interval
+
+    def __len__(self):
+        return len(self._table)
+
+    def is_ok(self, key) -> bool:
+        if self._min_interval <= 0:
+            return True
+
+        full_time = self._table.get(key)
+
+        if full_time is None:
+            return True
+
+        # Tokens missing from a full bucket must leave at least one
+        return full_time - self._clock() <= (self._burst - 1) * self._min_interval
+
+    def update(self, key, offset: float=0.0):
+        """Use up one action for the key.
+
+        A positive `offset` blocks the key for that many extra seconds.
+        Otherwise, calling this while the key is already limited doesn't
+        push it back any further than using up its whole burst now.
+        """
+        if self._min_interval <= 0:
+            return
+
+        with self._lock:
+            self._update(key, offset, self._clock())
+
+    def try_update(self, key) -> bool:
+        """Use up one action for the key if it's allowed.
+
+        Unlike calling `is_ok` and then `update`, no other thread can use
+        the same action in between.
+        """
+        if self._min_interval <= 0:
+            return True
+
+        with self._lock:
+            time_now = self._clock()
+            full_time = self._table.get(key)
+
+            if full_time is not None and full_time - time_now > \
+                    (self._burst - 1) * self._min_interval:
+                return False
+
+            self._update(key, 0.0, time_now)
+
+            return True
+
+    def refund(self, key):
+        """Give back one action used by `update`."""
+        if self._min_interval <= 0:
+            return
+
+        with self._lock:
+            full_time = self._table.get(key)
+
+            if full_time is None:
+                return
+
+            full_time -= self._min_interval
+
+            if full_time <= self._clock():
+                del self._table[key]
+            else:
+                self._table[key] = full_time
+
+    def _update(self, key, offset: float, time_now: float):
+        full_time = self._table.pop(key, time_now)
+        # With the default burst of 1, this is always now + min_interval
+        full_time = min(max(full_time, time_now) + self._min_interval,
+                        time_now + self._burst * self._min_interval)
+
+        self._table[key] = full_time + offset
+        self._expire(time_now)
+
+    def _expire(self, time_now: float):
+        for dummy in range(self._MAX_EXPIRE_PER_CALL):
+            if not self._table:
+                break
+
+            key, full_time = next(iter(self._table.items()))
+
+            if full_time > time_now:
+                break
+
+            del self._table[key]
+
+        while len(self._table) > self._max_size:
+            self._table.popitem(last=False)
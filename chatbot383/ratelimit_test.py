@@ -0,0 +1,162 @@
+import threading
+import unittest
+
+from chatbot383.ratelimit import Limiter, TokenBucket
+from chatbot383.testing import FakeClock
+
+
+class TestLimiter(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock(1000.0)
+
+    def test_min_interval(self):
+        limiter = Limiter(min_interval=3, clock=self.clock)
+
+        self.assertTrue(limiter.is_ok('a'))
+        limiter.update('a')
+        self.assertFalse(limiter.is_ok('a'))
+        self.assertTrue(limiter.is_ok('b'))
+
+        self.clock.time += 2.9
+        self.assertFalse(limiter.is_ok('a'))
+
+        self.clock.time += 0.1
+        self.assertTrue(limiter.is_ok('a'))
+
+    def test_offset(self):
+        limiter = Limiter(min_interval=0.2, clock=self.clock)
+        limiter.update('channel', offset=60)
+
+        self.clock.time += 60
+        self.assertFalse(limiter.is_ok('channel'))
+
+        self.clock.time += 0.2
+        self.assertTrue(limiter.is_ok('channel'))
+
+    def test_update_while_limited(self):
+        limiter = Limiter(min_interval=2, clock=self.clock)
+
+        for dummy in range(5):
+            limiter.update('a')
+
+        # Repeated updates don't build up a debt
+        self.clock.time += 2
+        self.assertTrue(limiter.is_ok('a'))
+
+        limiter = Limiter(min_interval=10, burst=3, clock=self.clock)
+
+        for dummy in range(10):
+            limiter.update('a')
+
+        self.clock.time += 10
+        self.assertTrue(limiter.is_ok('a'))
+
+    def test_try_update(self):
+        limiter = Limiter(min_interval=2, burst=2, clock=self.clock)
+
+        self.assertTrue(limiter.try_update('a'))
+        self.assertTrue(limiter.try_update('a'))
+        self.assertFalse(limiter.try_update('a'))
+
+        self.clock.time += 2
+        self.assertTrue(limiter.try_update('a'))
+        self.assertFalse(limiter.is_ok('a'))
+
+    def test_try_update_threads(self):
+        limiter = Limiter(min_interval=60)
+        results = []
+        barrier = threading.Barrier(8)
+
+        def run():
+            barrier.wait()
+            results.append(limiter.try_update('a'))
+
+        threads = [threading.Thread(target=run) for dummy in range(8)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(1, results.count(True))
+
+    def test_refund(self):
+        limiter = Limiter(min_interval=10, burst=2, clock=self.clock)
+
+        limiter.update('a')
+        limiter.update('a')
+        self.assertFalse(limiter.is_ok('a'))
+
+        limiter.refund('a')
+        self.assertTrue(limiter.is_ok('a'))
+
+        limiter.refund('a')
+        limiter.refund('b')
+        self.assertEqual(0, len(limiter))
+
+    def test_burst(self):
+        limiter = Limiter(min_interval=10, burst=3, clock=self.clock)
+
+        for dummy in range(3):
+            self.assertTrue(limiter.is_ok('a'))
+            limiter.update('a')
+
+        self.assertFalse(limiter.is_ok('a'))
+
+        self.clock.time += 10
+        self.assertTrue(limiter.is_ok('a'))
+        limiter.update('a')
+        self.assertFalse(limiter.is_ok('a'))
+
+        self.clock.time += 30
+        for dummy in range(3):
+            self.assertTrue(limiter.is_ok('a'))
+            limiter.update('a')
+
+        self.assertFalse(limiter.is_ok('a'))
+
+    def test_expire(self):
+        limiter = Limiter(min_interval=3, clock=self.clock)
+
+        for index in range(5):
+            limiter.update(index)
+
+        self.assertEqual(5, len(limiter))
+
+        self.clock.time += 3
+        limiter.update('new')
+
+        self.assertEqual(1, len(limiter))
+
+    def test_max_size(self):
+        limiter = Limiter(min_interval=3, max_size=100, clock=self.clock)
+
+        for index in range(1000):
+            limiter.update(index)
+
+        self.assertEqual(100, len(limiter))
+        self.assertTrue(limiter.is_ok(0))
+        self.assertFalse(limiter.is_ok(999))
+
+    def test_zero_interval(self):
+        limiter = Limiter(min_interval=0, clock=self.clock)
+        limiter.update('a')
+
+        self.assertTrue(limiter.is_ok('a'))
+        self.assertEqual(0, len(limiter))
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_burst_and_refill(self):
+        clock = FakeClock(1000.0)
+        bucket = TokenBucket(2, 0.5, clock=clock)
+
+        self.assertTrue(bucket.try_consume())
+        self.assertTrue(bucket.try_consume())
+        self.assertFalse(bucket.try_consume())
+        self.assertAlmostEqual(2.0, bucket.time_until_available())
+
+        clock.time += 2
+        self.assertTrue(bucket.try_consume())
+        self.assertFalse(bucket.try_consume())
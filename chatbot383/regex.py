@@ -1,52 +1,362 @@
+import functools
+import logging
 import multiprocessing
 import queue
+import re
+import threading
+
+try:
+    from re import _constants as sre_constants, _parser as sre_parse
+except ImportError:
+    import sre_constants
+    import sre_parse
+
+import chatbot383.metrics
+
+_logger = logging.getLogger(__name__)
+
+MAX_REPEAT_COUNT = 1000
+
+_REPEAT_OPS = frozenset(
+    op for op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT,
+                  getattr(sre_constants, 'POSSESSIVE_REPEAT', None))
+    if op is not None)
+_CHARACTER_OPS = frozenset((
+    sre_constants.LITERAL, sre_constants.NOT_LITERAL, sre_constants.ANY,
+    sre_constants.IN, sre_constants.CATEGORY))
 
 
 class RegexTimeout(RuntimeError):
     pass
 
 
-class RegexServer(object):
+class RegexRejected(ValueError):
+    """The pattern is likely to backtrack catastrophically."""
+
+
+class _PatternStats(object):
+    __slots__ = ('unbounded', 'repeats', 'branches', 'compound', 'risky')
+
     def __init__(self):
-        self._request_queue = None
-        self._response_queue = None
-        self._process = None
+        self.unbounded = 0
+        self.repeats = 0
+        self.branches = 0
+        self.compound = False
+        self.risky = False
+
+    def add(self, other: '_PatternStats'):
+        self.unbounded += other.unbounded
+        self.repeats += other.repeats
+        self.branches += other.branches
+        self.compound = self.compound or other.compound
+        self.risky = self.risky or other.risky
+
+
+def _analyze(items) -> _PatternStats:
+    stats = _PatternStats()
+
+    for op, av in items:
+        if op in _REPEAT_OPS:
+            min_count, max_count, item = av
+            unbounded = max_count == sre_constants.MAXREPEAT
+
+            if min_count > MAX_REPEAT_COUNT or \
+                    not unbounded and max_count > MAX_REPEAT_COUNT:
+                raise RegexRejected('Repetition count too large')
+
+            inner_stats = _analyze(item)
+
+            if max_count > 1 and op != getattr(
+                    sre_constants, 'POSSESSIVE_REPEAT', None):
+                if inner_stats.unbounded and (unbounded or max_count > 2):
+                    raise RegexRejected('Nested quantifiers')
+
+                # Repeated alternatives and repeats of repeats are
+                # polynomial at best
+                if inner_stats.repeats or inner_stats.branches:
+                    stats.risky = True
+
+            stats.add(inner_stats)
+            stats.repeats += 1
+
+            if len(item) != 1 or item[0][0] not in _CHARACTER_OPS:
+                stats.compound = True
+            stats.unbounded += 1 if unbounded else 0
+        elif op == sre_constants.SUBPATTERN:
+            stats.add(_analyze(av[-1]))
+        elif op == sre_constants.BRANCH:
+            stats.branches += 1
+
+            for branch in av[1]:
+                stats.add(_analyze(branch))
+        elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            stats.add(_analyze(av[1]))
+        elif op == getattr(sre_constants, 'ATOMIC_GROUP', None):
+            stats.add(_analyze(av))
+        elif op in (sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS,
+                    getattr(sre_constants, 'GROUPREF_IGNORE', None)):
+            stats.risky = True
+
+            if op == sre_constants.GROUPREF_EXISTS:
+                for item in av[1:]:
+                    if item:
+                        stats.add(_analyze(item))
+
+    return stats
 
-    def _launch_process(self):
-        assert not self._request_queue
-        assert not self._response_queue
-        assert not self._process
 
+def _required_literals(items, literals):
+    """Collect literal substrings that every match must contain."""
+    current = []
+
+    for op, av in items:
+        if op == sre_constants.LITERAL:
+            current.append(chr(av))
+            continue
+
+        if current:
+            literals.append(''.join(current))
+            current = []
+
+        if op == sre_constants.SUBPATTERN and not av[1] & re.IGNORECASE:
+            _required_literals(av[-1], literals)
+
+    if current:
+        literals.append(''.join(current))
+
+
+class CompiledPattern(object):
+    __slots__ = ('pattern', 'in_process', 'literals')
+
+    def __init__(self, pattern, in_process: bool, literals):
+        self.pattern = pattern
+        self.in_process = in_process
+        self.literals = literals
+
+    def may_match(self, text: str) -> bool:
+        for literal in self.literals:
+            if literal not in text:
+                return False
+
+        return True
+
+
+@functools.lru_cache(maxsize=256)
+def compile_pattern(pattern_text: str, flags: int=0) -> CompiledPattern:
+    """Compile and classify a user supplied pattern.
+
+    Raises re.error for bad syntax and RegexRejected for patterns prone to
+    exponential backtracking. Only patterns with no repeats, or a single
+    repeat of one character, are safe to run in process. Bounded repeats
+    with large counts backtrack as badly as unbounded ones.
+    """
+    pattern = re.compile(pattern_text, flags)
+    parsed = sre_parse.parse(pattern_text, flags)
+    stats = _analyze(parsed)
+    in_process = not stats.risky and not stats.compound and \
+        stats.repeats <= 1
+    literals = []
+
+    if not pattern.flags & re.IGNORECASE:
+        _required_literals(parsed, literals)
+
+    return CompiledPattern(pattern, in_process, tuple(literals))
+
+
+def _substitute_texts(pattern, replacement: str, texts, count: int):
+    for index, text in enumerate(texts):
+        if pattern.search(text):
+            return index, pattern.sub(replacement, text, count=count)
+
+    return None, None
+
+
+class _RegexWorker(object):
+    """A sandbox process that evaluates one request at a time."""
+    def __init__(self):
         self._request_queue = multiprocessing.SimpleQueue()
         self._response_queue = multiprocessing.Queue()
-
         self._process = multiprocessing.Process(
             target=self._run_server_loop,
             args=(self._request_queue, self._response_queue))
         self._process.daemon = True
         self._process.start()
 
+    def is_alive(self) -> bool:
+        return self._process.is_alive()
+
     @classmethod
     def _run_server_loop(cls, request_queue, response_queue):
         while True:
-            pattern, text = request_queue.get()
-            match = pattern.search(text)
-            response_queue.put(bool(match))
+            request_type, args = request_queue.get()
 
-    def _stop_server(self):
+            if request_type == 'search':
+                pattern, text = args
+                response_queue.put(('ok', bool(pattern.search(text))))
+            else:
+                try:
+                    response_queue.put(('ok', cls._substitute(*args)))
+                except re.error as error:
+                    response_queue.put(('error', error.args[0]))
+
+    @classmethod
+    def _substitute(cls, pattern_text, flags, replacement, texts, count):
+        pattern = re.compile(pattern_text, flags)
+        return _substitute_texts(pattern, replacement, texts, count)
+
+    def request(self, request_type: str, args, timeout: float):
+        self._request_queue.put((request_type, args))
+
+        try:
+            return self._response_queue.get(timeout=timeout)
+        except queue.Empty as error:
+            raise RegexTimeout() from error
+
+    def terminate(self):
         self._process.terminate()
-        self._process = None
-        self._request_queue = None
-        self._response_queue = None
 
-    def search(self, pattern, text):
-        if not self._process:
-            self._launch_process()
 
-        self._request_queue.put((pattern, text))
+class RegexServer(object):
+    """Runs regexes in a pool of sandbox processes.
+
+    `num_workers` processes take requests, so several corrections can run
+    at once. `num_spares` more are kept started but idle; when a worker is
+    killed after a timeout, a spare takes its place immediately and a new
+    spare is started.
+    """
+    def __init__(self, num_workers: int=2, num_spares: int=1):
+        self._num_workers = num_workers
+        self._num_spares = num_spares
+        self._idle_workers = queue.Queue()
+        self._spares = []
+        self._lock = threading.Lock()
+        self._started = False
+
+        chatbot383.metrics.QUEUE_DEPTH.labels('regex_idle_workers') \
+            .set_function(self._idle_workers.qsize)
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+
+            self._started = True
+
+            for dummy in range(self._num_workers):
+                self._idle_workers.put(_RegexWorker())
+
+            for dummy in range(self._num_spares):
+                self._spares.append(_RegexWorker())
+
+    def stop(self):
+        with self._lock:
+            self._started = False
+
+            for worker in self._spares:
+                worker.terminate()
+
+            self._spares = []
+
+            while True:
+                try:
+                    worker = self._idle_workers.get_nowait()
+                except queue.Empty:
+                    break
+                else:
+                    worker.terminate()
+
+    def _replace_worker(self, worker: _RegexWorker):
+        worker.terminate()
+
+        with self._lock:
+            if not self._started:
+                return
+
+            if self._spares:
+                self._idle_workers.put(self._spares.pop(0))
+                self._spares.append(_RegexWorker())
+            else:
+                self._idle_workers.put(_RegexWorker())
 
+        chatbot383.metrics.REGEX_WORKER_RESPAWNS.inc()
+
+    def _get_idle_worker(self, timeout) -> _RegexWorker:
         try:
-            return self._response_queue.get(timeout=1.0)
+            return self._idle_workers.get(timeout=timeout)
         except queue.Empty as error:
-            self._stop_server()
+            _logger.warning('No regex worker available')
             raise RegexTimeout() from error
+
+    def _request(self, request_type, args, timeout):
+        self.start()
+
+        worker = self._get_idle_worker(timeout)
+
+        if not worker.is_alive():
+            _logger.warning('Regex worker died. Replacing it.')
+            self._replace_worker(worker)
+            worker = self._get_idle_worker(timeout)
+
+        try:
+            status, result = worker.request(request_type, args, timeout)
+        except RegexTimeout:
+            chatbot383.metrics.REGEX_WORKER_KILLS.inc()
+            self._replace_worker(worker)
+            raise
+
+        self._idle_workers.put(worker)
+
+        if status == 'error':
+            raise re.error(result)
+
+        return result
+
+    def search(self, pattern, text, timeout: float=1.0):
+        return self._request('search', (pattern, text), timeout)
+
+    def substitute(self, pattern_text: str, flags: int, replacement: str,
+                   texts, count: int=1, timeout: float=1.0):
+        """Substitute in the first text that matches.
+
+        Texts missing a literal the pattern requires are skipped. Safe
+        patterns run in process; the rest run in a sandbox process under
+        one `timeout`.
+
+        Returns (index, new_text), or (None, None) if nothing matched.
+        Raises RegexTimeout, RegexRejected, or re.error.
+        """
+        try:
+            compiled = compile_pattern(pattern_text, flags)
+        except RegexRejected:
+            chatbot383.metrics.REGEX_EVALUATIONS.labels('rejected').inc()
+            raise
+
+        candidates = [
+            (index, text) for index, text in enumerate(texts)
+            if compiled.may_match(text)
+        ]
+
+        if not candidates:
+            chatbot383.metrics.REGEX_EVALUATIONS.labels('prefiltered').inc()
+            return None, None
+
+        candidate_texts = [text for dummy, text in candidates]
+
+        if compiled.in_process:
+            chatbot383.metrics.REGEX_EVALUATIONS.labels('in_process').inc()
+            result = _substitute_texts(
+                compiled.pattern, replacement, candidate_texts, count)
+        else:
+            chatbot383.metrics.REGEX_EVALUATIONS.labels('sandbox').inc()
+            result = self._request(
+                'substitute',
+                (pattern_text, flags, replacement, candidate_texts, count),
+                timeout
+            )
+
+        candidate_index, new_text = result
+
+        if candidate_index is None:
+            return None, None
+
+        return candidates[candidate_index][0], new_text
@@ -0,0 +1,148 @@
+import re
+import threading
+import unittest
+
+import chatbot383.metrics
+from chatbot383.regex import RegexServer, RegexTimeout, RegexRejected, \
+    compile_pattern
+
+
+class TestRegexServer(unittest.TestCase):
+    def setUp(self):
+        self.server = RegexServer(num_workers=2, num_spares=1)
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_substitute(self):
+        texts = ['no match', 'hello world', 'world world']
+
+        self.assertEqual(
+            (1, 'hello there'),
+            self.server.substitute('world', 0, 'there', texts))
+        self.assertEqual(
+            (0, 'x x'),
+            self.server.substitute('WORLD', re.IGNORECASE, 'x', texts[2:],
+                                   count=0))
+        self.assertEqual(
+            (None, None), self.server.substitute('zzz', 0, 'x', texts))
+
+    def test_error(self):
+        self.assertRaises(
+            re.error, self.server.substitute, 'o', 0, '\\9', ['foo'])
+
+    def test_rejected(self):
+        for pattern_text in ('(a*)*b', '(\\w+\\s?)+$', 'a{1,100000}',
+                             '(x+x+)+y'):
+            self.assertRaises(
+                RegexRejected, self.server.substitute, pattern_text, 0, 'x',
+                ['aaaa'])
+
+        # Nothing ran, so it mustn't be handled like a timeout
+        try:
+            self.server.substitute('(a*)*b', 0, 'x', ['aaaa'])
+        except RegexTimeout:
+            self.fail('RegexRejected raised as a RegexTimeout')
+        except RegexRejected:
+            pass
+
+    def test_timeout(self):
+        kills = chatbot383.metrics.REGEX_WORKER_KILLS.labels().value
+        respawns = chatbot383.metrics.REGEX_WORKER_RESPAWNS.labels().value
+
+        self.assertRaises(
+            RegexTimeout, self.server.substitute, '(a|aa)*[bc]', 0, 'x',
+            ['a' * 40], timeout=0.5)
+
+        self.assertEqual(
+            (0, 'b'), self.server.substitute('a', 0, 'b', ['a']))
+
+        self.assertEqual(
+            kills + 1, chatbot383.metrics.REGEX_WORKER_KILLS.labels().value)
+        self.assertEqual(
+            respawns + 1,
+            chatbot383.metrics.REGEX_WORKER_RESPAWNS.labels().value)
+        self.assertEqual(2, self.server._idle_workers.qsize())
+        self.assertEqual(1, len(self.server._spares))
+
+    def test_no_replacement(self):
+        class NoRespawnServer(RegexServer):
+            def _replace_worker(self, worker):
+                worker.terminate()
+
+        server = NoRespawnServer(num_workers=1, num_spares=0)
+        server.start()
+
+        try:
+            worker = server._idle_workers.get()
+            worker.terminate()
+            worker._process.join()
+            server._idle_workers.put(worker)
+
+            self.assertRaises(
+                RegexTimeout, server.substitute, '(a|aa)*[bc]', 0, 'x',
+                ['ab'], timeout=0.1)
+        finally:
+            server.stop()
+
+    def test_parallel(self):
+        results = []
+
+        def run_slow():
+            try:
+                self.server.substitute('(a|aa)*[bc]', 0, 'x', ['a' * 40],
+                                       timeout=1.0)
+            except RegexTimeout:
+                results.append('timeout')
+
+        thread = threading.Thread(target=run_slow)
+        thread.start()
+
+        # The other worker still answers while one is stuck
+        self.assertEqual(
+            (0, 'z'), self.server.substitute('(x+) (y+)', 0, 'z', ['x y'],
+                                             timeout=0.5))
+
+        thread.join()
+
+        self.assertEqual(['timeout'], results)
+
+
+class TestCompilePattern(unittest.TestCase):
+    def test_in_process(self):
+        self.assertTrue(compile_pattern('world').in_process)
+        self.assertTrue(compile_pattern(r'\bhel+o (\w) x').in_process)
+        self.assertFalse(compile_pattern(r'hel+o x{2,5}').in_process)
+        self.assertFalse(compile_pattern(r'(ab)+').in_process)
+        # Chains of bounded repeats backtrack polynomially
+        self.assertFalse(compile_pattern(
+            r'\w{0,999}\w{0,999}\w{0,999}\w{0,999}!').in_process)
+        self.assertFalse(compile_pattern(
+            r'.{0,999}.{0,999}.{0,999}x').in_process)
+        self.assertFalse(compile_pattern(
+            r'a.*b.{0,999}c.{0,999}d').in_process)
+        self.assertFalse(compile_pattern(r'(\w+) (\w+)').in_process)
+        self.assertFalse(compile_pattern(r'(a|bc)*').in_process)
+        self.assertFalse(compile_pattern(r'(a)\1').in_process)
+
+    def test_literals(self):
+        self.assertEqual(('hello w', 'rld'),
+                         compile_pattern(r'hello wo?rld').literals)
+        self.assertEqual(('ab', 'c'), compile_pattern(r'(ab)\w+c').literals)
+        self.assertEqual((), compile_pattern(r'a|b').literals)
+        self.assertEqual((), compile_pattern(r'abc', re.IGNORECASE).literals)
+        self.assertEqual((), compile_pattern(r'(?i)abc').literals)
+
+    def test_cache(self):
+        self.assertIs(compile_pattern('cache me'), compile_pattern('cache me'))
+
+    def test_no_sandbox(self):
+        server = RegexServer()
+        texts = ['hello world', 'nothing here']
+
+        self.assertEqual(
+            (0, 'hello there'), server.substitute('world', 0, 'there', texts))
+        self.assertEqual(
+            (None, None), server.substitute('(a|b)*zzz', 0, 'x', texts))
+        self.assertFalse(server._started)
@@ -0,0 +1,10 @@
+"""Helpers shared by the tests."""
+
+
+class FakeClock(object):
+    """A clock for `clock=` arguments that only moves when `time` is set."""
+    def __init__(self, time: float=0.0):
+        self.time = time
+
+    def __call__(self):
+        return self.time
@@ -38,3 +38,11 @@ def grouper(iterable, n, fillvalue=None):
 
 def escape_links(text: str) -> str:
     return re.sub(r'(\s|^)(https?\S+)', '\g<1><\g<2>>', text)
+
+
+def percentile(sorted_values, fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+    return sorted_values[index]
@@ -0,0 +1,83 @@
+import collections
+import concurrent.futures
+import logging
+import threading
+
+_logger = logging.getLogger(__name__)
+
+
+class WorkerPoolFullError(RuntimeError):
+    pass
+
+
+class CommandWorkerPool(object):
+    """Runs blocking or CPU heavy command handlers off the bot thread."""
+    def __init__(self, max_workers: int=4, max_queue_size: int=20):
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers)
+        self._max_pending = max_workers + max_queue_size
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def submit(self, func, *args, done_callback=None):
+        with self._lock:
+            if self._pending >= self._max_pending:
+                raise WorkerPoolFullError()
+
+            self._pending += 1
+
+        return self._executor.submit(self._run, func, args, done_callback)
+
+    def _run(self, func, args, done_callback):
+        try:
+            func(*args)
+        except Exception:
+            _logger.exception('Command worker error')
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+            if done_callback:
+                done_callback()
+
+    def shutdown(self, wait: bool=False):
+        self._executor.shutdown(wait=wait)
+
+
+class ReplyBuffer(object):
+    def __init__(self):
+        self.calls = []
+        self.done = False
+
+
+class ReplySequencer(object):
+    """Keeps replies within a channel in the order commands were received.
+
+    Replies of a command are buffered until every earlier command in the
+    same channel has finished.
+    """
+    def __init__(self):
+        self._buffers = collections.defaultdict(collections.deque)
+
+    def has_pending(self, channel: str) -> bool:
+        return channel in self._buffers
+
+    def open(self, channel: str) -> ReplyBuffer:
+        reply_buffer = ReplyBuffer()
+        self._buffers[channel].append(reply_buffer)
+        return reply_buffer
+
+    def close(self, channel: str, reply_buffer: ReplyBuffer):
+        reply_buffer.done = True
+        buffers = self._buffers[channel]
+
+        while buffers and buffers[0].done:
+            for call in buffers.popleft().calls:
+                call()
+
+        if not buffers:
+            del self._buffers[channel]
@@ -0,0 +1,59 @@
+import threading
+import unittest
+
+from chatbot383.workers import ReplySequencer, CommandWorkerPool, \
+    WorkerPoolFullError
+
+
+class TestReplySequencer(unittest.TestCase):
+    def test_order_kept(self):
+        sequencer = ReplySequencer()
+        sent = []
+
+        first = sequencer.open('#a')
+        second = sequencer.open('#a')
+        other = sequencer.open('#b')
+
+        first.calls.append(lambda: sent.append('first'))
+        second.calls.append(lambda: sent.append('second'))
+        other.calls.append(lambda: sent.append('other'))
+
+        sequencer.close('#a', second)
+        sequencer.close('#b', other)
+        self.assertEqual(['other'], sent)
+        self.assertTrue(sequencer.has_pending('#a'))
+
+        sequencer.close('#a', first)
+        self.assertEqual(['other', 'first', 'second'], sent)
+        self.assertFalse(sequencer.has_pending('#a'))
+        self.assertFalse(sequencer.has_pending('#b'))
+
+
+class TestCommandWorkerPool(unittest.TestCase):
+    def test_queue_full(self):
+        pool = CommandWorkerPool(max_workers=1, max_queue_size=1)
+        event = threading.Event()
+
+        futures = [pool.submit(event.wait), pool.submit(event.wait)]
+
+        with self.assertRaises(WorkerPoolFullError):
+            pool.submit(event.wait)
+
+        event.set()
+
+        for future in futures:
+            future.result(timeout=5)
+
+        self.assertEqual(0, pool.pending)
+        pool.shutdown()
+
+    def test_shutdown_wait(self):
+        pool = CommandWorkerPool(max_workers=1)
+        results = []
+
+        for index in range(3):
+            pool.submit(lambda index=index: results.append(index))
+
+        pool.shutdown(wait=True)
+
+        self.assertEqual([0, 1, 2], results)